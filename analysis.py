@@ -0,0 +1,837 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2016, 2019, 2020, 2024, 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import heapq
+from itertools import islice
+import os
+import weakref
+
+import regex as re
+
+from cssselect.parser import CombinedSelector, Element
+from cssselect.xpath import SelectorError
+from lxml import etree
+
+from featureindex import FeatureIndex, RuleHash
+from linkgraph import markup_links
+from selectorcache import CompiledSelectorCache, compiled_selectors, namespaces_key
+from verdictcache import VerdictCache
+
+
+# As from https://cssselect.readthedocs.io/en/latest/#supported-selectors
+NEVER_MATCH = (":hover",
+               ":active",
+               ":focus",
+               ":target",
+               ":visited")
+
+
+def style_rules(rules_collector):
+    """
+    Yields style rules in a css, both at top level and nested inside
+    @media rules (unlimited nesting levels: sooner or later cssutils
+    will support it).
+    """
+    for rule in rules_collector:
+        if rule.typeString == "STYLE_RULE":
+            yield rule
+        elif rule.typeString == "MEDIA_RULE":
+            for nested_rule in style_rules(rule):
+                yield nested_rule
+
+
+def css_namespaces(css):
+    """
+    Returns a dictionary of namespace rules in css.
+    If there is a default/unprefixed namespace (which isn't
+    translatable to XPath), adds an arbitrary prefix to it.
+    """
+    namespaces = dict(css.namespaces)
+    default_prefix = ""
+    if namespaces.get("", None):
+        while True:
+            default_prefix += "a"
+            try:
+                namespaces[default_prefix]
+            except KeyError:
+                namespaces[default_prefix] = namespaces[""]
+                break
+        namespaces.pop("")
+    return namespaces, default_prefix
+
+
+def selector_exists(parsed_code, selector, namespaces_dict, is_xhtml, cache=None,
+                    native=False):
+    """
+    Converts selector's text to XPath and make a search in xhtml file.
+    Returns True if it finds a correspondence or the translation of the
+    selector to XPath is not yet implemented by cssselect, False otherwise.
+    The compiled XPath is taken from cache (by default the one shared
+    by the whole plugin), so every selector is translated only once, and
+    its evaluation stops at the first matching element.
+    If native is True, the selectors supported by the native matcher
+    (see nativematcher.NativeSelector) are searched without XPath.
+    """
+
+    if cache is None:
+        cache = compiled_selectors
+    if native:
+        native_selector = cache.native(selector, namespaces_dict)
+        if native_selector is not None:
+            return native_selector.exists(parsed_code)
+    translator = 'xhtml' if is_xhtml else 'xml'
+    try:
+        return cache.exists(selector, namespaces_dict, translator)(parsed_code)
+    except SelectorError:
+        return True
+
+
+class MarkupDocument:
+    """
+    A markup file of the book. The file is read only once and both its
+    trees (the one built by the html parser and the one built by the xml
+    parser) come from the same bytes. If lazy is False, both trees are
+    built at once (so that malformed files are detected before starting
+    the analysis); otherwise every tree is built the first time a
+    selector needs it (see document_trees()).
+    The digest of the content and the links to stylesheets are computed
+    the first time they're needed, from the raw data: since the raw data
+    of eager documents is freed once their trees are built, they're
+    computed before then if 'digest' or 'stylesheet_links' are in precompute.
+    """
+
+    def __init__(self, file_id, href, is_xhtml, data, xml_parser=None, lazy=False,
+                 precompute=()):
+        self.file_id = file_id
+        self.href = href
+        self.is_xhtml = is_xhtml
+        self.xml_parser = xml_parser
+        self._data = data
+        self._html = None
+        self._xml = None
+        # DocumentFeatures of the indexed trees, set by FeatureIndex.add()
+        self.features = {}
+        self._digest = None
+        self._stylesheet_links = None
+        # True if every element is in a namespace, because the root element
+        # declares a default namespace that is never reset to "no namespace".
+        self.in_default_namespace = bool(
+            re.match(rb'(?:\xef\xbb\xbf)?(?:\s|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>)*<[^\s>]+\s[^>]*?\bxmlns\s*=\s*(["\'])(?!\1)',
+                     data, re.S)
+            and not re.search(rb'\bxmlns\s*=\s*(?:""|\'\')', data)
+        )
+        if not lazy:
+            self.html
+            self.xml
+            for name in precompute:
+                getattr(self, name)
+            self._data = None
+
+    def has_tree(self, tree):
+        """
+        True if the tree ('html' or 'xml') has already been built.
+        """
+        return getattr(self, '_' + tree) is not None
+
+    def _raw_data(self):
+        if self._data is None:
+            raise ValueError('The raw data of {} has been freed'.format(self.href))
+        return self._data
+
+    @property
+    def digest(self):
+        """
+        Identifies the content of the document in a VerdictCache.
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self._raw_data()).hexdigest()
+        return self._digest
+
+    @property
+    def stylesheet_links(self):
+        """
+        Hrefs of the stylesheets it loads (see linkgraph.StylesheetScopes).
+        """
+        if self._stylesheet_links is None:
+            self._stylesheet_links = markup_links(self._raw_data())
+        return self._stylesheet_links
+
+    def release(self):
+        """
+        Frees the memory used by the document: its trees can't be built again.
+        """
+        self._html = self._xml = self._data = None
+
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = etree.HTML(self._data)
+            if self._html is None:
+                # Empty file, or only comments: the html parser gives no
+                # tree at all, where the xml parser raises an error.
+                E = etree.XMLSyntaxError('Document is empty',
+                                         etree.ErrorTypes.ERR_DOCUMENT_EMPTY, 1, 1)
+                E.href = self.href
+                raise E
+        return self._html
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            try:
+                self._xml = etree.XML(self._data, self.xml_parser)
+            except etree.XMLSyntaxError as E:
+                E.href = self.href
+                raise
+        return self._xml
+
+
+def new_xml_parser():
+    """
+    The parser of the xml trees of markup files: entities are not resolved.
+    """
+    return etree.XMLParser(resolve_entities=False)
+
+
+def markup_files(bk, parse_all_xml_files=True):
+    """
+    Returns the list of the tuples (file_id, href, is_xhtml) of the xhtml
+    files in the book (and of the xml files, if parse_all_xml_files is True).
+    """
+    files = []
+    for file_id, href, mime in bk.manifest_iter():
+        if mime == 'application/xhtml+xml':
+            files.append((file_id, href, True))
+        elif parse_all_xml_files and re.search(r'[/+]xml\b', mime):
+            files.append((file_id, href, False))
+    return files
+
+
+def iter_markup(bk, parse_all_xml_files=True, xml_parser=None, lazy=False, precompute=()):
+    """
+    Yields a MarkupDocument for every file returned by markup_files().
+    """
+    for file_id, href, is_xhtml in markup_files(bk, parse_all_xml_files):
+        yield MarkupDocument(
+            file_id, href, is_xhtml,
+            bk.readfile(file_id).encode('utf-8'),
+            xml_parser, lazy, precompute
+        )
+
+
+class AnalysisCancelled(Exception):
+    """
+    Raised when the analysis is stopped by the user.
+    """
+
+
+def monitor_documents(documents, progress=None, cancelled=None, total=0):
+    """
+    Yields the documents, calling progress(n, total) when the n-th one is
+    done with (that is, when the next one is asked for); total is the
+    number of the documents. Raises AnalysisCancelled, before yielding a
+    document, if cancelled() returns True.
+    """
+    done = 0
+    for document in documents:
+        if cancelled is not None and cancelled():
+            raise AnalysisCancelled()
+        yield document
+        done += 1
+        if progress is not None:
+            progress(done, total)
+
+
+def has_namespace_prefix(selector_text):
+    """
+    True if selector_text contains a namespace prefix (e.g. "svg|text"
+    or "[xlink|href]"), once generic prefixes have been removed by
+    clean_generic_prefixes().
+    """
+    selector_text = re.sub(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'', '', selector_text)
+    return bool(re.search(r'(?<!\\)\|(?!=)', selector_text))
+
+
+def requires_type_selector(parsed_selector):
+    """
+    True if at least one of the compound selectors of parsed_selector
+    (a cssselect.Selector) has a type selector (e.g. "p" in "p.ex1 > .ex2").
+    Type selectors inside functional pseudo-classes like :not() don't count.
+    """
+    pending = [parsed_selector.parsed_tree]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, CombinedSelector):
+            pending.append(node.selector)
+            pending.append(node.subselector)
+        elif isinstance(node, Element):
+            if node.element is not None:
+                return True
+        else:
+            pending.append(node.selector)
+    return False
+
+
+def document_trees(document, selector, cache=None):
+    """
+    Returns the names of the trees of document ('html' and/or 'xml', in
+    the order they should be searched) where selector could find a match.
+    - A selector with namespace prefixes can match only in the xml tree:
+      the html parser doesn't know about namespaces.
+    - If every element of the document is in a namespace, an unprefixed
+      type selector can't match anything in the xml tree, so a selector
+      with at least one of them is searched only in the html tree.
+    - Every other selector is searched first in the html tree and then,
+      if it didn't match, in the xml tree.
+    """
+    if cache is None:
+        cache = compiled_selectors
+    if has_namespace_prefix(selector):
+        return ('xml',)
+    if document.in_default_namespace:
+        parsed_selector = cache.parse(selector)
+        if parsed_selector is not None and requires_type_selector(parsed_selector):
+            return ('html',)
+    return ('html', 'xml')
+
+
+def selector_in_document(document, selector, namespaces_dict, cache=None, native=False,
+                         may_match=None):
+    """
+    Returns True if selector_exists() in at least one of the trees
+    of document, as chosen by document_trees(). If given, may_match(tree)
+    is called first for every tree: if it returns False, the tree isn't
+    searched (nor built, if it wasn't yet).
+    """
+    for tree in document_trees(document, selector, cache):
+        if may_match is not None and not may_match(tree):
+            continue
+        if selector_exists(getattr(document, tree), selector, namespaces_dict,
+                           document.is_xhtml, cache, native):
+            return True
+    return False
+
+
+def ignore_selectors(selector_text):
+    """
+    Skip the selectors that can't match anything
+    (pseudo-classes like :hover and the like).
+    """
+    for pseudo_class in NEVER_MATCH:
+        if pseudo_class in selector_text:
+            return True
+    return False
+
+
+def add_default_prefix(prefix, selector_text):
+    """
+    Adds prefix to all unprefixed type selector tokens (tag names)
+    in selector_text. Returns prefixed selector.
+    """
+    # Note: regex here are valid thanks to cssutils's normalization
+    # of selectors text (e.g. spaces around combinators are always added,
+    # sequences of whitespace characters are always reduced to one U+0020).
+    selector_ns = ''
+    # https://www.w3.org/TR/css-syntax-3/#input-preprocessing
+    # states that \r, \f and \r\n  must be replaced by \n
+    # before tokenization.
+    for token in re.split(r'(?<!\\(?:[a-fA-F0-9]{1,6})?)([ \n\t]:not\(|[ \n\t])',
+                          selector_text):
+        if (re.match(r'-?(?:[A-Za-z_]|\\[^\n]|[^\u0000-\u007F])', token)
+                and not re.search(r'(?<!\\)\|', token)):
+            selector_ns += '{}|{}'.format(prefix, token)
+        else:
+            selector_ns += token
+    return selector_ns
+
+
+def clean_generic_prefixes(selector_text):
+    """
+    Removes '|' (no namespace) and '*|' (every namespace)
+    at the beginning of type and attribute selector tokens.
+    If there is at least one '*|' in selector_text, all prefixes
+    will be deleted from the selector. This isn't the formally
+    correct solution, but it's safe to use in combination with
+    html parser which is namespace agnostic.
+    """
+    # Note: regex here are valid thanks to cssutils's normalization
+    # of selectors text (e.g. optional whitespace between
+    # '[' and qualified name of the attribute is removed).
+    selector = ''
+    if re.search(r'(?<!\\)(?:^| )\*\|', selector_text):
+        for token in re.split(r'(?<!\\)([ \n\t]|\[)', selector_text):
+            selector += re.sub(r'^.*?\|', '', token)
+    else:
+        for token in re.split(r'(?<!\\)([ \n\t]|\[)', selector_text):
+            selector += re.sub(r'^\|', '', token)
+    return selector
+
+
+def rule_selectors(css):
+    """
+    Yields (rule, selector, selector_index, selector_text) for every
+    selector of the style rules of css (an item of the dictionary returned
+    by pre_parse_css()). If the stylesheet was only scanned, and not parsed,
+    rule is the index of the rule in the stylesheet and selector is None.
+    """
+    parsed_css = css['stylesheet']
+    if parsed_css is None:
+        for rule_index, selector_texts in enumerate(css['selectors']):
+            for selector_index, selector_text in enumerate(selector_texts):
+                yield rule_index, None, selector_index, selector_text
+        return
+    for rule in style_rules(parsed_css):
+        for selector_index, selector in enumerate(rule.selectorList):
+            # cssutils serializes the selector (looking up the namespaces
+            # of the whole stylesheet) on every access to selectorText
+            yield rule, selector, selector_index, selector.selectorText
+
+
+def collect_selectors(css_to_parse):
+    """
+    Yields every selector of the stylesheets in css_to_parse (as returned
+    by pre_parse_css()) that has to be searched in the markup files, as
+    a tuple (occurrence, selector_ns, namespaces_dict). occurrence is the
+    tuple (css_id, rule, selector, selector_index, parsed_css, selector_text)
+    used to show and delete the selector (see rule_selectors() for the
+    stylesheets that were only scanned: their parsed_css is None),
+    selector_ns is the selector's text ready to be translated to XPath.
+    """
+    for css_id, css in css_to_parse.items():
+        parsed_css = css['stylesheet']
+        namespaces_dict, default_prefix = css['namespaces'], css['default_prefix']
+        for rule, selector, selector_index, selector_text in rule_selectors(css):
+            if ignore_selectors(selector_text):
+                continue
+            # If css specifies a default namespace, the default prefix
+            # must be added to every unprefixed type selector.
+            if default_prefix:
+                selector_ns = add_default_prefix(default_prefix, selector_text)
+            else:
+                selector_ns = selector_text
+            selector_ns = clean_generic_prefixes(selector_ns)
+            yield (
+                (css_id, rule, selector, selector_index, parsed_css, selector_text),
+                selector_ns,
+                namespaces_dict
+            )
+
+
+class SelectorMatcher:
+    """
+    Searches selectors in documents with selector_in_document(), using the
+    compiled selectors in cache. If index (a FeatureIndex) is given, the
+    search is skipped for the trees lacking some of the element names,
+    ids, classes or attributes required by the selector.
+    If use_rule_hash is True, the queries are bucketed in a RuleHash by
+    prepare(), and only the queries whose key is in a tree are searched
+    there.
+    If native is True, selectors are searched with the native matcher
+    whenever it supports them, instead of with their XPath translation.
+    If verdicts (a VerdictCache) is given, a selector already searched in
+    a document with the same content in a previous run isn't searched again.
+    If cancelled is given, every search is preceded by a call to it and
+    AnalysisCancelled is raised if it returns True.
+    If scopes (a linkgraph.StylesheetScopes) is given and restrict() is
+    called, every query is searched only in the documents loading its
+    stylesheet: candidates() and skip() tell which ones.
+    """
+
+    def __init__(self, cache=None, index=None, use_rule_hash=False, native=False,
+                 verdicts=None, cancelled=None, scopes=None):
+        self.cache = compiled_selectors if cache is None else cache
+        self.index = index
+        self.use_rule_hash = use_rule_hash
+        self.native = native
+        self.verdicts = verdicts
+        self.cancelled = cancelled
+        self.scopes = scopes
+        self.rule_hash = None
+        # document -> {tree: indexes of the queries in the buckets of the
+        # rule hash found in the tree}
+        self._hashed = weakref.WeakKeyDictionary()
+        # css_id of the stylesheet of every query, and indexes of the
+        # queries of every stylesheet (see restrict())
+        self.query_stylesheets = None
+        self._stylesheet_queries = None
+        self.scope_avoided = 0
+        self._selector_keys = {}
+        # Statistics of the matchers of other processes (see match_in_parallel())
+        self._merged_statistics = {}
+
+    def prepare(self, queries):
+        if self.use_rule_hash:
+            self.rule_hash = RuleHash(queries, self.cache)
+            self._hashed.clear()
+            if self.index is None:
+                # Features of the trees are needed by the rule hash anyway
+                self._features = FeatureIndex()
+            else:
+                self._features = self.index
+
+    def restrict(self, query_stylesheets):
+        """
+        Limits the search of every query to the documents loading the
+        stylesheet of the query, whose css_id is in query_stylesheets.
+        """
+        self.query_stylesheets = query_stylesheets
+        self._stylesheet_queries = {}
+        for query_index, css_id in enumerate(query_stylesheets):
+            self._stylesheet_queries.setdefault(css_id, set()).add(query_index)
+
+    def candidates(self, document):
+        """
+        Returns the set of the indexes of the queries in scope for document,
+        or None if every query has to be searched in it.
+        """
+        if self._stylesheet_queries is None:
+            return None
+        in_scope = set()
+        for css_id in self.scopes.loaded_by(document):
+            in_scope |= self._stylesheet_queries.get(css_id, set())
+        return in_scope
+
+    def skip(self, query_index, candidates):
+        """
+        True if the query can be skipped for the document with candidates.
+        """
+        if candidates is None or query_index in candidates:
+            return False
+        self.scope_avoided += 1
+        return True
+
+    def _in_rule_hash(self, document, tree, query_index):
+        try:
+            hashed = self._hashed[document]
+        except KeyError:
+            hashed = self._hashed[document] = {}
+        if tree not in hashed:
+            hashed[tree] = self.rule_hash.candidates(self._features.add(document, tree))
+        if query_index in hashed[tree]:
+            return True
+        self.rule_hash.avoided += 1
+        return False
+
+    def matches(self, document, selector, namespaces_dict, query_index=None):
+        """
+        True if selector matches in document. query_index (the index of
+        the query in the list given to prepare()) is needed by the rule
+        hash: without it, every tree is searched.
+        """
+        if self.cancelled is not None and self.cancelled():
+            raise AnalysisCancelled()
+        if self.verdicts is None:
+            return self._search(document, selector, namespaces_dict, query_index)
+        document_key = self.verdicts.document_key(document)
+        try:
+            selector_key = self._selector_keys[selector, namespaces_key(namespaces_dict)]
+        except KeyError:
+            selector_key = self.verdicts.selector_key(selector, namespaces_dict,
+                                                      'native' if self.native else '')
+            self._selector_keys[selector, namespaces_key(namespaces_dict)] = selector_key
+        matched = self.verdicts.get(document_key, selector_key)
+        if matched is None:
+            matched = self._search(document, selector, namespaces_dict, query_index)
+            self.verdicts.set(document_key, selector_key, matched)
+        return matched
+
+    def _search(self, document, selector, namespaces_dict, query_index):
+        def may_match(tree):
+            if (self.rule_hash is not None and query_index is not None
+                    and not self._in_rule_hash(document, tree, query_index)):
+                return False
+            return self.index is None or self.index.may_match(
+                document, tree, selector, namespaces_dict, self.cache)
+        return selector_in_document(document, selector, namespaces_dict, self.cache,
+                                    self.native, may_match)
+
+    def statistics(self):
+        """
+        Counters about the work done (and avoided) by the matcher.
+        """
+        info = self.cache.info()
+        statistics = {
+            'compiled selectors': info.currsize,
+            'compiled selectors cache hits': info.hits,
+        }
+        if self.native:
+            statistics['natively matched selectors'] = self.cache.native_count()
+        if self.rule_hash is not None:
+            statistics['searches avoided by rule hash'] = self.rule_hash.avoided
+        if self._stylesheet_queries is not None:
+            statistics['searches avoided by scope'] = self.scope_avoided
+        if self.verdicts is not None:
+            statistics['verdicts from previous runs'] = self.verdicts.hits
+        for name, value in self._merged_statistics.items():
+            statistics[name] = statistics.get(name, 0) + value
+        return statistics
+
+    def merge_statistics(self, statistics):
+        """
+        Adds the statistics of another matcher to the ones of this matcher.
+        """
+        for name, value in statistics.items():
+            self._merged_statistics[name] = self._merged_statistics.get(name, 0) + value
+
+
+def match_by_selector(queries, documents, matcher=None, progress=None):
+    """
+    Searches every query (a tuple (selector_ns, namespaces_dict)) in the
+    documents, one document after the other, until a match is found.
+    documents must be a sequence, since it's scanned once for every query.
+    If matcher has a FeatureIndex and the trees of the documents are
+    already built (see FeatureIndex.add_book()), every document is indexed
+    first and the queries that can't match anywhere in the book are not
+    searched at all.
+    If given, progress(n, len(queries)) is called when the n-th query is done.
+    Returns the set of the indexes of the queries that found a match.
+    """
+    if matcher is None:
+        matcher = SelectorMatcher()
+    matcher.prepare(queries)
+    index = matcher.index
+    if index is not None:
+        index.add_book(documents)
+    candidates = [matcher.candidates(document) for document in documents]
+    matched = set()
+    for query_index, (selector, namespaces_dict) in enumerate(queries):
+        if index is None or index.book_may_match(selector, namespaces_dict, matcher.cache):
+            for document, document_candidates in zip(documents, candidates):
+                if matcher.skip(query_index, document_candidates):
+                    continue
+                if matcher.matches(document, selector, namespaces_dict, query_index):
+                    matched.add(query_index)
+                    break
+        if progress is not None:
+            progress(query_index + 1, len(queries))
+    return matched
+
+
+def match_by_document(queries, documents, matcher=None, batch_size=1):
+    """
+    Like match_by_selector(), but every document is visited only once:
+    documents are taken batch_size at a time, all the queries that haven't
+    found a match yet are searched in the batch and those that match are
+    dropped from the set of the unresolved ones. Then the documents of the
+    batch are released and the next batch is taken.
+    documents can be an iterator (like the one returned by iter_markup()):
+    it isn't consumed any further once every query has found a match.
+    Since no more than batch_size documents (each with its raw text and
+    its html and xml trees) are alive at the same time, the memory used
+    for the markup doesn't depend on the number of files in the book.
+    """
+    if matcher is None:
+        matcher = SelectorMatcher()
+    matcher.prepare(queries)
+    unresolved = list(range(len(queries)))
+    matched = set()
+    documents = iter(documents)
+    while unresolved:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        candidates = [matcher.candidates(document) for document in batch]
+        still_unresolved = []
+        for index in unresolved:
+            selector, namespaces_dict = queries[index]
+            for document, document_candidates in zip(batch, candidates):
+                if matcher.skip(index, document_candidates):
+                    continue
+                if matcher.matches(document, selector, namespaces_dict, index):
+                    matched.add(index)
+                    break
+            else:
+                still_unresolved.append(index)
+        unresolved = still_unresolved
+        for document in batch:
+            document.release()
+        del batch, candidates
+    return matched
+
+
+def _match_shard(queries, shard, use_index, use_rule_hash, native, verdicts_config=None,
+                 scopes=None, query_stylesheets=None):
+    """
+    Runs in a worker process of match_in_parallel(): searches the queries
+    in the documents of shard (tuples (file_id, href, is_xhtml, data)).
+    Returns the matched queries as a bitset (bit i is set if the query
+    with index i found a match) and the statistics of the matcher.
+    verdicts_config is the VerdictCache.config() of the cache of the
+    main process, if any; scopes and query_stylesheets restrict the search
+    as in the matcher of the main process.
+    """
+    verdicts = None if verdicts_config is None else VerdictCache(*verdicts_config)
+    matcher = SelectorMatcher(CompiledSelectorCache(), FeatureIndex() if use_index else None,
+                              use_rule_hash, native, verdicts, scopes=scopes)
+    if query_stylesheets is not None:
+        matcher.restrict(query_stylesheets)
+    documents = (
+        MarkupDocument(file_id, href, is_xhtml, data, new_xml_parser(), lazy=True)
+        for file_id, href, is_xhtml, data in shard
+    )
+    matched = 0
+    for index in match_by_document(queries, documents, matcher):
+        matched |= 1 << index
+    if verdicts is not None:
+        verdicts.close(evict=False)
+    return matched, matcher.statistics()
+
+
+def shard_documents(documents, shards):
+    """
+    Splits documents (lazy MarkupDocuments, still holding their raw data)
+    in no more than shards lists of tuples (file_id, href, is_xhtml, data),
+    each with about the same amount of markup. The order of the documents
+    in a shard is the order they have in documents.
+    """
+    loads = [(0, shard_index) for shard_index in range(shards)]
+    assigned = [[] for _ in range(shards)]
+    for position, document in sorted(enumerate(documents), key=lambda d: -len(d[1]._data)):
+        load, shard_index = heapq.heappop(loads)
+        assigned[shard_index].append(position)
+        heapq.heappush(loads, (load + len(document._data), shard_index))
+    return [
+        [(documents[position].file_id, documents[position].href,
+          documents[position].is_xhtml, documents[position]._data)
+         for position in sorted(positions)]
+        for positions in assigned if positions
+    ]
+
+
+def match_in_parallel(queries, documents, matcher=None, workers=None, progress=None):
+    """
+    Like match_by_document(), but documents are split in shards searched
+    at the same time by a pool of workers processes (os.cpu_count() if
+    workers is None or less than 1). Every worker parses the documents of
+    its shard and returns the set of the queries that found a match there,
+    then the results of the workers are merged.
+    documents must be lazy MarkupDocuments (their trees are built by the
+    workers from their raw data). If the pool can't be used (e.g. the
+    processes can't be started) or a worker fails (e.g. for a malformed
+    file), the search is done again by match_by_document() in this process,
+    which reports the error as the serial search does.
+    If given, progress(n, len(documents)) is called when the workers are
+    done with n documents.
+    """
+    if matcher is None:
+        matcher = SelectorMatcher()
+    documents = list(documents)
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(documents))
+    if workers > 1 and all(document._data is not None for document in documents):
+        try:
+            with ProcessPoolExecutor(workers) as executor:
+                futures = {
+                    executor.submit(_match_shard, queries, shard, matcher.index is not None,
+                                    matcher.use_rule_hash, matcher.native,
+                                    None if matcher.verdicts is None else matcher.verdicts.config(),
+                                    matcher.scopes, matcher.query_stylesheets): len(shard)
+                    for shard in shard_documents(documents, workers)
+                }
+                results = []
+                done = 0
+                for future in as_completed(futures):
+                    results.append(future.result())
+                    done += futures[future]
+                    if progress is not None:
+                        progress(done, len(documents))
+        except Exception:
+            pass
+        else:
+            matched = 0
+            for shard_matched, statistics in results:
+                matched |= shard_matched
+                matcher.merge_statistics(statistics)
+            return {index for index in range(len(queries)) if matched >> index & 1}
+    if progress is not None:
+        documents = monitor_documents(documents, progress, total=len(documents))
+    return match_by_document(queries, documents, matcher)
+
+
+def distinct_queries(selectors, scoped=False):
+    """
+    Groups the selectors yielded by collect_selectors() by their text
+    (ready to be translated to XPath) and namespaces, since the same
+    selector often appears in more rules and stylesheets. If scoped is
+    True, the selectors of different stylesheets are never grouped, since
+    they can be used by different documents.
+    Returns the list of the distinct queries (tuples (selector_ns,
+    namespaces_dict)) and the list of the index of the query of every
+    selector.
+    """
+    queries = []
+    query_of = []
+    indexes = {}
+    for occurrence, selector_ns, namespaces_dict in selectors:
+        key = (selector_ns.strip(), namespaces_key(namespaces_dict))
+        if scoped:
+            key += (occurrence[0],)
+        try:
+            query_index = indexes[key]
+        except KeyError:
+            query_index = indexes[key] = len(queries)
+            queries.append((selector_ns, namespaces_dict))
+        query_of.append(query_index)
+    return queries, query_of
+
+
+def find_orphaned_selectors(css_to_parse, documents, mode='selectors', matcher=None,
+                            batch_size=1, workers=None, progress=None):
+    """
+    Returns the list of the occurrences (see collect_selectors()) of the
+    selectors in css_to_parse that don't match anything in documents.
+    mode is the name of the search strategy: 'selectors' for
+    match_by_selector(), 'documents' for match_by_document() with one
+    document at a time, 'streaming' for match_by_document() with
+    batch_size documents at a time, 'parallel' for match_in_parallel()
+    with workers processes.
+    Every distinct selector (see distinct_queries()) is searched only once.
+    If matcher has scopes, the selectors of every stylesheet are searched
+    only in the documents loading it.
+    In 'selectors' and 'parallel' modes, progress (if given) is called as
+    match_by_selector() and match_in_parallel() do; in the other modes,
+    the documents are searched in order, so they can report the progress
+    themselves (see monitor_documents()).
+    """
+    if matcher is None:
+        matcher = SelectorMatcher()
+    selectors = list(collect_selectors(css_to_parse))
+    scoped = matcher.scopes is not None
+    queries, query_of = distinct_queries(selectors, scoped)
+    if scoped:
+        query_stylesheets = [None] * len(queries)
+        for (occurrence, _, _), query_index in zip(selectors, query_of):
+            query_stylesheets[query_index] = occurrence[0]
+        matcher.restrict(query_stylesheets)
+    if mode == 'documents':
+        matched = match_by_document(queries, documents, matcher)
+    elif mode == 'streaming':
+        matched = match_by_document(queries, documents, matcher, batch_size)
+    elif mode == 'parallel':
+        matched = match_in_parallel(queries, documents, matcher, workers, progress)
+    else:
+        matched = match_by_selector(queries, list(documents), matcher, progress)
+    return [
+        occurrence for (occurrence, _, _), query_index in zip(selectors, query_of)
+        if query_index not in matched
+    ]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compares the search of selectors with lxml.cssselect.CSSSelector (which
+builds the list of every matching element) and with the existence-only
+XPath of selectorcache.existence_xpath(), on a large generated document.
+
+Run from the root of the repository:
+
+    python -m benchmarks.existence [paragraphs]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from lxml import etree
+
+from selectorcache import CompiledSelectorCache
+
+
+SELECTORS = ['p', 'span', 'div.c3 > p', 'div p', 'p + p.a', 'div ~ div.c49 span', 'p.missing']
+
+
+def document(paragraphs):
+    body = ''.join(
+        '<div class="c{}"><p>x <span>y</span></p><p class="a">z</p></div>'.format(i % 50)
+        for i in range(paragraphs // 2)
+    )
+    return etree.HTML('<html><body>{}</body></html>'.format(body))
+
+
+def measure(function, tree, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(tree)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    function(tree)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return bool(result), elapsed, peak
+
+
+def main(paragraphs=5000, repeat=5):
+    tree = document(paragraphs)
+    cache = CompiledSelectorCache()
+    print('{:<22}{:>14}{:>14}{:>16}{:>16}'.format(
+        'selector', 'list (ms)', 'exists (ms)', 'list (bytes)', 'exists (bytes)'))
+    for selector in SELECTORS:
+        select = cache.get(selector, {}, 'xhtml')
+        exists = cache.exists(selector, {}, 'xhtml')
+        found, list_time, list_peak = measure(select, tree, repeat)
+        exists_found, exists_time, exists_peak = measure(exists, tree, repeat)
+        assert found == exists_found, selector
+        print('{:<22}{:>14.2f}{:>14.2f}{:>16}{:>16}'.format(
+            selector, list_time * 1000, exists_time * 1000, list_peak, exists_peak))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compares the serialization of a large generated stylesheet by the default
+serializer and by customcssutils.MyCSSSerializer (which reuses the text
+of the rules and selectors not changed since the last serialization),
+after reading the text of every selector (as the analysis does) and after
+deleting one selector every ten.
+
+Run from the root of the repository:
+
+    python -m benchmarks.serializer [rules]
+"""
+
+import logging
+import sys
+import time
+
+try:
+    import css_parser as cssutils
+except ImportError:
+    import cssutils
+
+from analysis import style_rules
+import customcssutils
+
+
+def stylesheet(rules):
+    css = ''.join(
+        'p.c{0}, div.d{0} > span, a[href$=".x{0}"] {{ color: red; margin: 0 {0}px }}\n'
+        '@media print {{ .m{0} {{ display: none }} }}\n'.format(i)
+        for i in range(rules // 2)
+    )
+    return cssutils.CSSParser(raiseExceptions=True, validate=False).parseString(css)
+
+
+def measure(serializer, rules):
+    cssutils.setSerializer(serializer)
+    sheet = stylesheet(rules)
+    start = time.perf_counter()
+    for rule in style_rules(sheet):
+        for selector in rule.selectorList:
+            selector.selectorText
+    analysis = time.perf_counter() - start
+    for rule in list(style_rules(sheet))[::10]:
+        del rule.selectorList[0]
+    start = time.perf_counter()
+    text = sheet.cssText
+    return analysis, time.perf_counter() - start, text
+
+
+def main(rules=2000):
+    cssutils.log.setLevel(logging.CRITICAL)
+    default = cssutils.ser
+    print('{:<22}{:>18}{:>22}'.format('serializer', 'selectors (s)', 'stylesheet (s)'))
+    results = []
+    for name, serializer in (('default', default), ('MyCSSSerializer', customcssutils.MyCSSSerializer())):
+        analysis, serialization, text = measure(serializer, rules)
+        results.append(text)
+        print('{:<22}{:>18.3f}{:>22.3f}'.format(name, analysis, serialization))
+    cssutils.setSerializer(default)
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measures the time needed to import the plugin, which must not import Qt,
+and the time needed to import the dialogs (and so Qt) when they are shown.
+Every import is timed in a new interpreter.
+
+Run from the root of the repository:
+
+    python -m benchmarks.startup [repeat]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+
+QT_PACKAGES = ('PySide6', 'PyQt5', 'PyQt6', 'PySide2')
+
+CODE = '''
+import sys, time
+start = time.perf_counter()
+import {modules}
+elapsed = time.perf_counter() - start
+qt = any(name.split('.')[0] in {qt!r} for name in sys.modules)
+print(elapsed, int(qt))
+'''
+
+
+def import_time(modules, root):
+    code = CODE.format(modules=modules, qt=QT_PACKAGES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                            capture_output=True, text=True).stdout.split()
+    return float(output[-2]), bool(int(output[-1]))
+
+
+def main(repeat=5):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print('{:<20}{:>12}{:>12}'.format('imports', 'time (ms)', 'qt loaded'))
+    for modules in ('plugin', 'plugin, dialogs'):
+        results = [import_time(modules, root) for _ in range(repeat)]
+        qt_loaded = results[0][1]
+        if modules == 'plugin':
+            assert not qt_loaded, 'importing the plugin imports Qt'
+        print('{:<20}{:>12.1f}{:>12}'.format(
+            modules, statistics.median(elapsed for elapsed, qt in results) * 1000, str(qt_loaded)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
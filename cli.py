@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Removes the unused selectors from the stylesheets of epub files or of
+unpacked epub directories, without Sigil and without Qt:
+
+    python cli.py [--prefs cssRemoveUnusedSelectors.json] [--dry-run] book.epub ...
+
+Every selector found unused is deleted (as with the "quiet" preference
+of the plugin). The preferences file has the same format of the one
+saved by Sigil for the plugin. Many books can be processed at the same
+time by a pool of processes (--jobs), and a summary of every book can
+be written as a line of json in a log file (--log).
+"""
+
+
+from abc import ABC, abstractmethod
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+import zipfile
+
+from lxml import etree
+try:
+    import css_parser as cssutils
+except ImportError:
+    import cssutils
+
+from analysis import compiled_selectors
+from cssparsing import ParsedStylesheetCache
+import customcssutils
+from pipeline import (
+    read_css, pre_parse_css, set_css_output_prefs, get_prefs, open_verdicts, find_orphans,
+    delete_selectors
+)
+
+
+CONTAINER_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
+OPF_NS = 'http://www.idpf.org/2007/opf'
+
+
+class Prefs(dict):
+    """
+    Like the preferences returned by Sigil's bk.getPrefs(): the values
+    missing from the dictionary are taken from self.defaults.
+    """
+
+    def __init__(self, values=None, file_path=None):
+        super().__init__(values or {})
+        self.defaults = {}
+        self.file_path = file_path
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            return self.defaults[key]
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, encoding='utf-8') as f:
+            return cls(json.load(f), os.path.abspath(file_path))
+
+
+def is_text(mime):
+    return mime.startswith('text/') or bool(re.search(r'[/+]xml\b', mime))
+
+
+class Book(ABC):
+    """
+    The subset of Sigil's BookContainer API used by the plugin, on top of
+    the files of an epub. Every file is read from the container (see the
+    subclasses) and the files written by writefile() are kept in memory
+    until save() is called.
+    """
+
+    def __init__(self, path, prefs=None):
+        self.path = path
+        self.prefs = prefs if prefs is not None else Prefs()
+        # file id -> bytes
+        self.changed = OrderedDict()
+        container = etree.fromstring(self._read('META-INF/container.xml'))
+        rootfile = container.find('.//{{{0}}}rootfile[@full-path]'.format(CONTAINER_NS))
+        if rootfile is None:
+            raise ValueError('no rootfile in META-INF/container.xml')
+        opf_path = rootfile.get('full-path')
+        opf_dir = posixpath.dirname(opf_path)
+        opf = etree.fromstring(self._read(opf_path))
+        # file id -> (href relative to the opf, path in the container, mime)
+        self._manifest = OrderedDict()
+        for item in opf.iterfind('{{{0}}}manifest/{{{0}}}item'.format(OPF_NS)):
+            href = unquote(item.get('href'))
+            self._manifest[item.get('id')] = (
+                href, posixpath.normpath(posixpath.join(opf_dir, href)), item.get('media-type', '')
+            )
+
+    @abstractmethod
+    def _read(self, name):
+        """
+        Returns the bytes of the file at name (a path in the container).
+        """
+
+    def css_iter(self):
+        for file_id, (href, name, mime) in self._manifest.items():
+            if mime == 'text/css':
+                yield file_id, href
+
+    def manifest_iter(self):
+        for file_id, (href, name, mime) in self._manifest.items():
+            yield file_id, href, mime
+
+    def id_to_href(self, file_id):
+        return self._manifest[file_id][0]
+
+    def readfile(self, file_id):
+        href, name, mime = self._manifest[file_id]
+        data = self.changed.get(file_id)
+        if data is None:
+            data = self._read(name)
+        if is_text(mime):
+            return data.decode('utf-8')
+        return data
+
+    def writefile(self, file_id, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.changed[file_id] = data
+
+    def getPrefs(self):
+        return self.prefs
+
+    def savePrefs(self, prefs):
+        pass
+
+    @abstractmethod
+    def save(self, output=None):
+        """
+        Writes the changed files in the book or, if output is given,
+        in a copy of the book saved there.
+        """
+
+    def close(self):
+        pass
+
+
+class DirectoryBook(Book):
+    """
+    An unpacked epub.
+    """
+
+    def _read(self, name):
+        with open(os.path.join(self.path, *name.split('/')), 'rb') as f:
+            return f.read()
+
+    def save(self, output=None):
+        root = self.path
+        if output is not None:
+            shutil.copytree(self.path, output)
+            root = output
+        for file_id, data in self.changed.items():
+            with open(os.path.join(root, *self._manifest[file_id][1].split('/')), 'wb') as f:
+                f.write(data)
+
+
+class EpubBook(Book):
+    """
+    An epub file.
+    """
+
+    def __init__(self, path, prefs=None):
+        self._zip = zipfile.ZipFile(path)
+        try:
+            super().__init__(path, prefs)
+        except Exception:
+            self._zip.close()
+            raise
+
+    def _read(self, name):
+        return self._zip.read(name)
+
+    def save(self, output=None):
+        # The new file is written next to the final one and then moved there,
+        # so that the book is never left half written.
+        output = output or self.path
+        changed = {self._manifest[file_id][1]: data for file_id, data in self.changed.items()}
+        fd, temp_path = tempfile.mkstemp(suffix='.epub', dir=os.path.dirname(os.path.abspath(output)))
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(temp_path, 'w') as target:
+                # The mimetype file must be the first one, and not compressed
+                for info in sorted(self._zip.infolist(), key=lambda info: info.filename != 'mimetype'):
+                    data = changed.get(info.filename)
+                    if data is None:
+                        data = self._zip.read(info)
+                    if info.filename == 'mimetype':
+                        info.compress_type = zipfile.ZIP_STORED
+                    target.writestr(info, data)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._zip.close()
+        os.replace(temp_path, output)
+        self._zip = zipfile.ZipFile(output)
+        self.path = output
+
+    def close(self):
+        self._zip.close()
+
+
+def open_book(path, prefs=None):
+    if os.path.isdir(path):
+        return DirectoryBook(path, prefs)
+    return EpubBook(path, prefs)
+
+
+def use_custom_serializer():
+    # css-parser (bundled with Sigil 0.9.18 and higher) has its own serializer
+    if cssutils.__name__ == 'cssutils' and not isinstance(cssutils.ser, customcssutils.MyCSSSerializer):
+        cssutils.setSerializer(customcssutils.MyCSSSerializer())
+
+
+def process_book(path, prefs, dry_run=False, output=None, log=print, css_cache=None):
+    """
+    Removes the unused selectors from the stylesheets of the epub (file or
+    directory) in path, like the plugin in quiet mode. If dry_run is True,
+    the selectors are only searched. Stylesheets are looked up in
+    css_cache (a ParsedStylesheetCache), if given, before being parsed.
+    Returns a dictionary with the number of unused selectors, of removed
+    selectors and of bytes saved in the stylesheets.
+    Raises etree.XMLSyntaxError if a markup file is malformed.
+    """
+    use_custom_serializer()
+    book = open_book(path, prefs)
+    try:
+        prefs = get_prefs(book)
+        set_css_output_prefs(book, prefs, save_on_file=False)
+        css_parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+        css_to_skip, css_to_parse, css_warnings = pre_parse_css(
+            book, css_parser, prefs['parallelWorkers'] if prefs['parallelCssParsing'] else 1, css_cache,
+            prefs['scanOnlyCss']
+        )
+        for css_id, E in css_to_skip.items():
+            log('{}: skipped, the stylesheet can\'t be parsed ({})'.format(book.id_to_href(css_id), E))
+        for css_id, (atkeyword, line) in css_warnings.items():
+            log('{}: unknown rule {} at line {}'.format(book.id_to_href(css_id), atkeyword, line))
+
+        verdicts = open_verdicts(book, prefs)
+        try:
+            orphaned_selectors, matcher = find_orphans(book, prefs, css_to_parse, verdicts)
+        finally:
+            if verdicts is not None:
+                verdicts.close()
+        if prefs['printStatistics']:
+            for name, value in matcher.statistics().items():
+                log('{}: {}'.format(name.capitalize(), value))
+        for selector_tuple in orphaned_selectors:
+            log('{} ({})'.format(selector_tuple[5], book.id_to_href(selector_tuple[0])))
+
+        summary = {'unused': len(orphaned_selectors), 'removed': 0, 'bytes_saved': 0}
+        if not dry_run:
+            old_sizes = {css_id: len(read_css(book, css_id).encode('utf-8')) for css_id in css_to_parse}
+            css_to_change, deleted, css_not_changed = delete_selectors(
+                book, orphaned_selectors, css_to_parse, prefs['sourceEditing'])
+            for css_id, E in css_not_changed.items():
+                log('{}: not changed, the stylesheet can\'t be parsed ({})'.format(
+                    book.id_to_href(css_id), E))
+            if book.changed or output is not None:
+                book.save(output)
+            summary['removed'] = len(deleted)
+            summary['bytes_saved'] = sum(old_sizes[css_id] - len(book.changed[css_id])
+                                         for css_id in css_to_change)
+    finally:
+        book.close()
+    return summary
+
+
+# Caches shared by the books processed one after the other in the same
+# process: stylesheets are often the same in many books (e.g. from the
+# same publisher). Compiled selectors are kept by analysis.compiled_selectors.
+parsed_stylesheets = ParsedStylesheetCache()
+# The compiled selectors are dropped when there are more than these
+MAX_COMPILED_SELECTORS = 100000
+
+
+def book_summary(path, prefs, dry_run=False, output=None):
+    """
+    Runs process_book() with the caches of this process. Returns the
+    summary of the book, with its path, status ("ok" or "error", with the
+    error message) and time spent, and the list of the lines of its report.
+    """
+    lines = []
+    summary = {'book': path, 'status': 'ok', 'unused': 0, 'removed': 0, 'bytes_saved': 0}
+    start = time.perf_counter()
+    try:
+        summary.update(process_book(path, prefs, dry_run, output, lines.append, parsed_stylesheets))
+    except etree.XMLSyntaxError as E:
+        summary['status'] = 'error'
+        summary['error'] = '{} is not well formed ({}). The book is left untouched.'.format(
+            getattr(E, 'href', None) or path, E)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as E:
+        summary['status'] = 'error'
+        summary['error'] = '{} is not a valid epub ({}).'.format(path, E)
+    except Exception as E:
+        summary['status'] = 'error'
+        summary['error'] = failure_message(path, E)
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    if compiled_selectors.info().currsize > MAX_COMPILED_SELECTORS:
+        compiled_selectors.clear()
+    return summary, lines
+
+
+def failure_message(path, E):
+    return '{} can\'t be processed ({}: {}).'.format(path, type(E).__name__, E)
+
+
+def iter_summaries(paths, prefs, dry_run=False, output=None, workers=1):
+    """
+    Yields the results of book_summary() for every book in paths. If
+    workers is greater than 1 (or less than 1, meaning one worker per cpu
+    core), the books are queued to a pool of worker processes and the
+    results are yielded as soon as the books are done; each worker keeps
+    its caches from one book to the next one. A book whose worker fails
+    (e.g. because the process is killed) gets an error summary: it isn't
+    processed again, since the worker may have already changed it.
+    If the pool can't be started, the books are processed in this process.
+    """
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(paths))
+    if workers > 1:
+        executor = None
+        try:
+            executor = ProcessPoolExecutor(workers)
+            futures = {executor.submit(book_summary, path, prefs, dry_run, output): path
+                       for path in paths}
+        except (OSError, NotImplementedError):
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        else:
+            with executor:
+                for future in as_completed(futures):
+                    try:
+                        yield future.result()
+                    except Exception as E:
+                        path = futures[future]
+                        yield {'book': path, 'status': 'error', 'unused': 0, 'removed': 0,
+                               'bytes_saved': 0, 'error': failure_message(path, E)}, []
+            return
+    for path in paths:
+        yield book_summary(path, prefs, dry_run, output)
+
+
+def process_books(paths, prefs, dry_run=False, output=None, workers=1, log_file=None, report=print):
+    """
+    Processes the books in paths (see iter_summaries()), reporting on each
+    of them with report() and writing its summary as a line of json in
+    log_file, if given. Returns the list of the summaries.
+    """
+    summaries = []
+    for summary, lines in iter_summaries(paths, prefs, dry_run, output, workers):
+        report('{}:'.format(summary['book']))
+        for line in lines:
+            report(line)
+        if summary['status'] == 'error':
+            report('Error: {}'.format(summary['error']))
+        if log_file is not None:
+            log_file.write(json.dumps(summary) + '\n')
+            log_file.flush()
+        summaries.append(summary)
+    return summaries
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Remove unused selectors from the stylesheets of epub files.'
+    )
+    parser.add_argument('books', nargs='+', metavar='BOOK',
+                        help='an epub file or an unpacked epub directory')
+    parser.add_argument('-p', '--prefs', help='the preferences file of the plugin (json)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='list the unused selectors without removing them')
+    parser.add_argument('-o', '--output',
+                        help='save the changed book here instead of overwriting it (only one BOOK)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='process the books with this many processes (0: one per cpu core)')
+    parser.add_argument('-l', '--log',
+                        help='write a summary line (json) for every book in this file')
+    args = parser.parse_args(argv)
+    if args.output is not None and len(args.books) > 1:
+        parser.error('--output can be used only with one book')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prefs = Prefs.load(args.prefs) if args.prefs else Prefs()
+    if args.log is None:
+        summaries = process_books(args.books, prefs, args.dry_run, args.output, args.jobs)
+    else:
+        with open(args.log, 'w', encoding='utf-8') as log_file:
+            summaries = process_books(args.books, prefs, args.dry_run, args.output, args.jobs, log_file)
+    return int(any(summary['status'] == 'error' for summary in summaries))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
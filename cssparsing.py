@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import copyreg
+import hashlib
+import os
+import pickle
+import re
+
+try:
+    import css_parser as cssutils
+except ImportError:
+    import cssutils
+
+from sourcespans import scan_stylesheet
+
+
+def _set_rule_list_state(rules, state):
+    items, attributes = state
+    list.extend(rules, items)
+    rules.__dict__.update(attributes)
+
+
+def _reduce_rule_list(rules):
+    # CSSRuleList is a list whose append() and extend() raise
+    # NotImplementedError (until a stylesheet or a @media rule replaces
+    # them), so the default list unpickling can't be used.
+    return (cssutils.css.CSSRuleList, (), (list(rules), rules.__dict__), None, None,
+            _set_rule_list_state)
+
+
+# Parsed stylesheets are sent by worker processes to the main one.
+copyreg.pickle(cssutils.css.CSSRuleList, _reduce_rule_list)
+
+
+def parse_css_string(parser, css_string):
+    """
+    Returns the tuple (stylesheet, None) if parser can parse css_string,
+    or (None, exception) if parsing raised an exception.
+    """
+    try:
+        return parser.parseString(css_string), None
+    except Exception as E: # cssutils.xml.dom.HierarchyRequestErr as E:
+        return None, E
+
+
+class ParsedStylesheetCache:
+    """
+    The results of parse_css_string() for the stylesheets already parsed,
+    by the digest of their text, so that a stylesheet shared by many books
+    is parsed only once. Since the deletion of selectors changes the
+    stylesheets, they are kept pickled and every get() returns a new copy.
+    Only the max_entries most recently used stylesheets are kept.
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(css_string):
+        return hashlib.sha1(css_string.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def get(self, css_string):
+        """
+        Returns the result of parse_css_string() for css_string, or None
+        if it isn't in the cache.
+        """
+        key = self.key(css_string)
+        try:
+            pickled, E = self._results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        return (None if pickled is None else pickle.loads(pickled)), E
+
+    def set(self, css_string, result):
+        parsed, E = result
+        try:
+            pickled = None if parsed is None else pickle.dumps(parsed, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Not worth failing for: the stylesheet will be parsed again
+            return
+        self._results[self.key(css_string)] = (pickled, E)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_IDENT = r'-?[A-Za-z_][A-Za-z0-9_-]*'
+_COMPOUND = r'(?:(?:\*|{0})(?:[.#]{0})*|(?:[.#]{0})+)'.format(_IDENT)
+# Selectors made only of type, class and id selectors and of combinators
+_SIMPLE_SELECTOR = re.compile(r'{0}(?:(?:\s*[>+~]\s*|\s+){0})*'.format(_COMPOUND))
+
+
+def selector_text(text, namespaces):
+    """
+    The selectorText that cssutils gives to the selector text (as written
+    in a stylesheet whose namespaces are {prefix: uri}). Raises an
+    exception if cssutils can't parse it.
+    """
+    if _SIMPLE_SELECTOR.fullmatch(text) and cssutils.ser.prefs.selectorCombinatorSpacer == ' ':
+        # cssutils only puts a space around the combinators
+        return re.sub(r'\s+', ' ', re.sub(r'\s*([>+~])\s*', r' \1 ', text))
+    return cssutils.css.Selector(selectorText=(text, namespaces)).selectorText
+
+
+def scan_css_string(css_string):
+    """
+    Returns the tuple (scanned, selector_texts, None), where scanned is
+    the ScannedStylesheet of css_string and selector_texts the list of the
+    selectorText (see selector_text()) of the selectors of every style
+    rule, or (None, None, exception) if a selector can't be parsed.
+    Unlike parse_css_string(), declarations aren't parsed (nor checked).
+    """
+    scanned = scan_stylesheet(css_string)
+    try:
+        selector_texts = [
+            [selector_text(text, scanned.namespaces) for text in scanned.selector_texts(rule)]
+            for rule in scanned.rules
+        ]
+    except Exception as E:
+        return None, None, E
+    return scanned, selector_texts, None
+
+
+def parse_css_strings(parser, css_strings, workers=1, cache=None):
+    """
+    Returns the list of the results of parse_css_string() for every string
+    in css_strings, in the same order. If workers is greater than 1 (or less
+    than 1, meaning one worker per cpu core), stylesheets are parsed at the
+    same time by a pool of worker processes. A stylesheet whose parsing
+    can't be completed by a worker (e.g. because the processes can't be
+    started) is parsed again in this process.
+    If cache (a ParsedStylesheetCache) is given, only the stylesheets
+    missing from it are parsed, and then added to it.
+    """
+    if cache is not None:
+        results = [cache.get(css_string) for css_string in css_strings]
+        missing = [i for i, result in enumerate(results) if result is None]
+        parsed = parse_css_strings(parser, [css_strings[i] for i in missing], workers)
+        for i, result in zip(missing, parsed):
+            cache.set(css_strings[i], result)
+            results[i] = result
+        return results
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(css_strings))
+    if workers <= 1:
+        return [parse_css_string(parser, css_string) for css_string in css_strings]
+    results = []
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(parse_css_string, parser, css_string)
+                       for css_string in css_strings]
+            for future, css_string in zip(futures, css_strings):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    results.append(parse_css_string(parser, css_string))
+    except Exception:
+        pass
+    for css_string in css_strings[len(results):]:
+        results.append(parse_css_string(parser, css_string))
+    return results
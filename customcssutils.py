@@ -22,6 +22,9 @@
 # copyright 2005 - 2013 Christof Hoeke
 
 
+import io
+import weakref
+
 try:
     import css_parser as cssutils
     from css_parser.stylesheets.mediaquery import MediaQuery
@@ -34,27 +37,87 @@ MediaQuery.MEDIA_TYPES.extend(('amzn-mobi', 'amzn-kf8'))
 
 
 class MyCSSSerializer(cssutils.CSSSerializer):
+    """
+    The serializer used with cssutils (before Sigil 0.9.18). The text of
+    every style rule and selector is kept and reused until it changes:
+    changing the selectors (e.g. deleting some of them, the only change
+    made by the plugin) or the declarations of a rule renders it again, as
+    does any change of the prefs. Only the declarations are serialized
+    again every time, to find out if they changed: the selectors, the
+    slowest part, are not. Changes to the @namespace rules need
+    invalidate().
+    Selectors are serialized (and cached) already by the analysis, which
+    reads their selectorText.
+    """
 
     def __init__(self):
         super().__init__()
         self.prefs.linesAfterRules = 0 * '\n'
         self.prefs.formatUnknownAtRules = False
+        # rule or selector -> (state of the serializer and of the rule, text)
+        self._texts = weakref.WeakKeyDictionary()
+
+    def invalidate(self, item=None):
+        """
+        Drops the cached text of item (a rule or a selector), or of
+        everything if item is None.
+        """
+        if item is None:
+            self._texts.clear()
+        else:
+            self._texts.pop(item, None)
+
+    def _cached(self, item, state, serialize):
+        cached = self._texts.get(item)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        text = serialize(item)
+        self._texts[item] = (state, text)
+        return text
+
+    def _prefs_state(self):
+        return tuple(vars(self.prefs).values())
+
+    def do_CSSStyleRule(self, rule):
+        if self.prefs.indentSpecificities:
+            # The text depends on the rules serialized before
+            return super().do_CSSStyleRule(rule)
+        # Weak references, not ids, which are reused by new objects. The
+        # sequence of a selector is replaced when its text is set.
+        state = (self._prefs_state(), self._level,
+                 tuple(weakref.ref(selector.seq) for selector in rule.selectorList.seq),
+                 rule.style.cssText)
+        return self._cached(rule, state, super().do_CSSStyleRule)
+
+    def do_css_Selector(self, selector):
+        # Setting selectorText replaces the sequence of the selector
+        state = (self._prefs_state(), weakref.ref(selector.seq))
+        return self._cached(selector, state, super().do_css_Selector)
 
     def do_CSSStyleSheet(self, stylesheet):
         """serializes a complete CSSStyleSheet"""
-        useduris = stylesheet._getUsedURIs()
-        out = []
+        useduris = None
+        out = io.StringIO()
+        first = True
         for rule in stylesheet.cssRules:
             if self.prefs.keepUsedNamespaceRulesOnly and\
-               rule.NAMESPACE_RULE == rule.type and\
-               rule.namespaceURI not in useduris and (
-                    rule.prefix or None not in useduris):
-                continue
+               rule.NAMESPACE_RULE == rule.type:
+                if useduris is None:
+                    useduris = stylesheet._getUsedURIs()
+                if rule.namespaceURI not in useduris and (
+                        rule.prefix or None not in useduris):
+                    continue
 
             cssText = rule.cssText
             if cssText:
-                out.append(cssText+self.prefs.linesAfterRules)
-        text = self._linenumnbers(self.prefs.lineSeparator.join(out))
+                if not first:
+                    out.write(self.prefs.lineSeparator)
+                out.write(cssText)
+                out.write(self.prefs.linesAfterRules)
+                first = False
+        # The name of the method has a typo in cssutils, fixed in css-parser
+        linenumbers = getattr(self, '_linenumnbers', None) or self._linenumbers
+        text = linenumbers(out.getvalue())
 
         # get encoding of sheet, defaults to UTF-8
         try:
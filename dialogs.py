@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2016, 2019, 2020, 2024, 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The dialogs of the plugin. Importing this module imports Qt, so plugin.py
+imports it only when a dialog has to be shown.
+"""
+
+
+from collections import OrderedDict
+import sys
+import threading
+
+from plugin_utils import QtWidgets, QtCore, Qt, QtGui, Signal, Slot
+from pipeline import set_css_output_prefs, get_prefs, href_to_basename
+from wrappingcheckbox import WrappingCheckBox, WrappingItemDelegate
+
+
+class PrefsDialog(QtWidgets.QDialog):
+    """
+    Dialog to set and save preferences about css formatting.
+    """
+    def __init__(self, parent=None, bk=None, prefs=None):
+        if prefs:
+            self.prefs = prefs
+        else:
+            self.prefs = get_prefs(bk)
+        super().__init__(parent)
+        self.setWindowTitle('Preferences')
+
+        self.labelIndent = QtWidgets.QLabel('Indent:')
+        self.indent = QtWidgets.QComboBox()
+        self.indent.addItems(
+            (
+                'No indentation',
+                '1 space',
+                '2 spaces',
+                '3 spaces',
+                '4 spaces',
+                '1 tab',
+            )
+        )
+        p = self.indent.sizePolicy()
+        p.setHorizontalPolicy(QtWidgets.QSizePolicy.MinimumExpanding)
+        self.indent.setSizePolicy(p)
+        indentLayout = QtWidgets.QHBoxLayout()
+        indentLayout.addWidget(self.labelIndent)
+        indentLayout.addWidget(self.indent)
+        self.indentLastBrace = QtWidgets.QCheckBox("Indent rules's last brace")
+        self.keepEmptyRules = QtWidgets.QCheckBox('Keep empty rules (e.g. "p { }")')
+        self.omitLastSemicolon = QtWidgets.QCheckBox(
+            "Omit semicolon after rules's last declaration " +
+            '(e.g. "p { font-size: 1.2em; text-indent: .5em }")'
+        )
+        self.omitLeadingZero = QtWidgets.QCheckBox(
+            'Omit leading zero (e.g. ".5em" vs "0.5em")'
+        )
+        self.formatUnknownAtRules = QtWidgets.QCheckBox(
+            "Use settings to reformat css inside not recognized " +
+            "@rules, too (not completely safe)"
+        )
+        self.linesAfterRules = QtWidgets.QCheckBox("Add a blank line after every rule")
+        self.sourceEditing = QtWidgets.QCheckBox(
+            "Only cut the deleted selectors out of the stylesheets, " +
+            "leaving the rest as it is (the settings above are ignored)"
+        )
+        self.sourceEditing.toggled.connect(self.enable_formatting)
+
+        self.get_initial_values()
+
+        buttonBox = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Cancel)
+        cont_button = buttonBox.addButton("Save and Continue", QtWidgets.QDialogButtonBox.AcceptRole)
+        buttonBox.accepted.connect(self.save_and_go)
+        buttonBox.rejected.connect(self.reject)
+
+        mainLayout = QtWidgets.QVBoxLayout()
+        mainLayout.addLayout(indentLayout)
+        mainLayout.addWidget(self.indentLastBrace)
+        mainLayout.addWidget(self.keepEmptyRules)
+        mainLayout.addWidget(self.omitLastSemicolon)
+        mainLayout.addWidget(self.omitLeadingZero)
+        mainLayout.addWidget(self.formatUnknownAtRules)
+        mainLayout.addWidget(self.linesAfterRules)
+        mainLayout.addWidget(self.sourceEditing)
+        mainLayout.addWidget(buttonBox)
+        self.setLayout(mainLayout)
+
+    def get_initial_values(self):
+        if self.prefs['indent'] == "\t":
+            self.indent.setCurrentText('1 tab')
+        else:
+            self.indent.setCurrentIndex(len(self.prefs['indent']))
+        self.indentLastBrace.setChecked(self.prefs['indentClosingBrace'])
+        self.keepEmptyRules.setChecked(self.prefs['keepEmptyRules'])
+        self.omitLastSemicolon.setChecked(self.prefs['omitLastSemicolon'])
+        self.omitLeadingZero.setChecked(self.prefs['omitLeadingZero'])
+        self.formatUnknownAtRules.setChecked(self.prefs['formatUnknownAtRules'])
+        self.linesAfterRules.setChecked(bool(self.prefs['linesAfterRules']))
+        self.sourceEditing.setChecked(self.prefs['sourceEditing'])
+        self.enable_formatting(self.prefs['sourceEditing'])
+
+    def enable_formatting(self, source_editing):
+        for widget in (self.labelIndent, self.indent, self.indentLastBrace, self.keepEmptyRules,
+                       self.omitLastSemicolon, self.omitLeadingZero, self.formatUnknownAtRules,
+                       self.linesAfterRules):
+            widget.setEnabled(not source_editing)
+
+    def save_and_go(self):
+        if self.indent.currentText() == '1 tab':
+            self.prefs['indent'] = '\t'
+        else:
+            self.prefs['indent'] = self.indent.currentIndex() * ' '
+        self.prefs['indentClosingBrace'] = self.indentLastBrace.isChecked()
+        self.prefs['keepEmptyRules'] = self.keepEmptyRules.isChecked()
+        self.prefs['omitLastSemicolon'] = self.omitLastSemicolon.isChecked()
+        self.prefs['omitLeadingZero'] = self.omitLeadingZero.isChecked()
+        self.prefs['formatUnknownAtRules'] = self.formatUnknownAtRules.isChecked()
+        self.prefs['linesAfterRules'] = '\n' if self.linesAfterRules.isChecked() else ''
+        self.prefs['sourceEditing'] = self.sourceEditing.isChecked()
+        self.accept()
+
+
+class InfoDialog(QtWidgets.QWidget):
+
+    stop_plugin = True
+
+    def __init__(self, bk, prefs, css_to_skip=None, css_to_parse=None, css_warnings=None):
+        super().__init__()
+        self.setWindowTitle('Preparing to parse...')
+
+        self.labelInfo = QtWidgets.QLabel(
+            self.parse_errors(bk, css_to_skip, css_to_parse, css_warnings)
+        )
+        self.labelInfo.setWordWrap(True)
+
+        self.checkParseAllXMLFiles = QtWidgets.QCheckBox(
+            'Parse every xml file, not only xhtml.'
+        )
+
+        buttonBox = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok|QtWidgets.QDialogButtonBox.Cancel
+        )
+        # ResetRole is mostly for cross-platform positioning:
+        # there isn't a standard role exactly adequate for this button,
+        # and the connected slot is entirely custom anyway
+        pref_button = buttonBox.addButton(
+            "Set preferences",
+            QtWidgets.QDialogButtonBox.ResetRole
+        )
+        pref_button.clicked.connect(lambda: self.prefs_dlg(bk, prefs))
+        buttonBox.accepted.connect(lambda: self.proceed(bk, prefs))
+        buttonBox.rejected.connect(self.close)
+        buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setAutoDefault(True)
+        buttonBox.button(QtWidgets.QDialogButtonBox.Cancel).setAutoDefault(True)
+        pref_button.setAutoDefault(True)
+
+        mainLayout = QtWidgets.QVBoxLayout()
+        mainLayout.setContentsMargins(12, 12, 12, 12)
+        mainLayout.setSpacing(5)
+        mainLayout.addWidget(self.labelInfo)
+        mainLayout.addWidget(self.checkParseAllXMLFiles)
+        mainLayout.addWidget(buttonBox)
+
+        self.setLayout(mainLayout)
+        self.get_initial_values(prefs)
+        self.show()
+        buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setFocus()
+
+    def parse_errors(self, bk, css_to_skip=None, css_to_parse=None, css_warnings=None):
+        par_msg = ""
+        if css_to_skip:
+            for file_, err in css_to_skip.items():
+                filename = href_to_basename(bk.id_to_href(file_))
+                par_msg += "I couldn't parse {} due to\n{}\n\n".format(filename, err)
+        if css_warnings:
+            for file_, warn in css_warnings.items():
+                filename = href_to_basename(bk.id_to_href(file_))
+                par_msg += ("Warning: Found unknown @rule in {} at line {}: {}. "
+                            "Text of unknown rules might not be preserved.\n\n".format(
+                                                    filename, warn[1], warn[0]))
+        if css_to_parse:
+            files_to_parse = ", ".join(css_to_parse)
+            par_msg += "Analysis will be done on {}".format(files_to_parse)
+        if not par_msg:
+            par_msg = "No css found."
+        return par_msg
+
+    def prefs_dlg(self, bk, prefs):
+        dlg = PrefsDialog(self, bk, prefs)
+        dlg.open()
+
+    def get_initial_values(self, prefs):
+        self.checkParseAllXMLFiles.setChecked(prefs['parseAllXMLFiles'])
+
+    def proceed(self, bk, prefs):
+        prefs['parseAllXMLFiles'] = self.checkParseAllXMLFiles.isChecked()
+        set_css_output_prefs(bk, prefs)
+        bk.savePrefs(prefs)
+        InfoDialog.stop_plugin = False
+        self.close()
+
+
+class SelectorsModel(QtCore.QAbstractListModel):
+    """
+    The orphaned selectors shown by SelectorsDialog: a checkable row for
+    every selector, displayed as "selector (file)". groups are the ids of
+    the stylesheets of the rows.
+    """
+
+    def __init__(self, texts, groups=None, parent=None):
+        super().__init__(parent)
+        self._texts = texts
+        self._groups = groups if groups is not None else [None] * len(texts)
+        self._checked = [True] * len(texts)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._texts)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self._texts[index.row()]
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self._checked[index.row()] else Qt.Unchecked
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        self._checked[index.row()] = Qt.CheckState(value) == Qt.Checked
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+
+    def set_checked(self, checked, rows=None):
+        """
+        Checks or unchecks rows (every row if rows is None) with a single
+        dataChanged signal, so that the view is repainted only once.
+        """
+        rows = range(len(self._checked)) if rows is None else list(rows)
+        if not rows:
+            return
+        for row in rows:
+            self._checked[row] = checked
+        self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), [Qt.CheckStateRole])
+
+    def group_rows(self, group):
+        return [row for row, row_group in enumerate(self._groups) if row_group == group]
+
+    def group(self, row):
+        return self._groups[row]
+
+    def checked_rows(self):
+        """
+        The check state of every row, as a list of booleans.
+        """
+        return list(self._checked)
+
+
+class SelectorsDialog(QtWidgets.QWidget):
+    """
+    Dialog to show the list of css "orphaned" selectors (those without
+    corresponding tags in xhtml files) and let the user choose the ones
+    to delete.
+    The selectors are the rows of a list view: only the visible ones are
+    painted and have their text laid out (see WrappingItemDelegate), so
+    that even thousands of them are shown at once.
+    """
+
+    orphaned_dict = OrderedDict()
+    stop_plugin = True
+
+    def __init__(self, bk, orphaned_selectors=None):
+        super().__init__()
+        self.setWindowTitle("Remove unused Selectors")
+        self.setMinimumWidth(360)
+
+        mainLayout = QtWidgets.QVBoxLayout(self)
+
+        frameLayout = QtWidgets.QVBoxLayout()
+        frameLayout.setSpacing(0)
+        frameLayout.setContentsMargins(0, 0, 0, 0)
+        frame = QtWidgets.QFrame()
+        frame.setFrameShape(QtWidgets.QFrame.StyledPanel)
+        frame.setLayout(frameLayout)
+
+        orphaned = SelectorsDialog.orphaned_dict
+        orphaned.clear()
+        if orphaned_selectors:
+
+            labelInfo = QtWidgets.QLabel('Choose the selectors you want to delete')
+            labelInfo.setWordWrap(True)
+            mainLayout.addWidget(labelInfo)
+
+            self.toggleAll = WrappingCheckBox(
+                'Select / Unselect all', margins=(8, 8, 8, 8), fillBackground=True
+            )
+            self.toggleAll.setChecked(True)
+            self.toggleAll.stateChanged().connect(self.toggle_all)
+            frameLayout.addWidget(self.toggleAll)
+
+            separator = QtWidgets.QFrame()
+            separator.setFrameShape(QtWidgets.QFrame.HLine)
+            separator.setFrameShadow(QtWidgets.QFrame.Sunken)
+            frameLayout.addWidget(separator)
+
+            texts, groups = [], []
+            self.css_filenames = {}
+            for index, selector_tuple in enumerate(orphaned_selectors):
+                css_id = selector_tuple[0]
+                if css_id not in self.css_filenames:
+                    self.css_filenames[css_id] = href_to_basename(bk.id_to_href(css_id))
+                texts.append(f'{selector_tuple[5]} ({self.css_filenames[css_id]})')
+                groups.append(css_id)
+                selector_key = selector_tuple[5]+"_"+str(index)
+                orphaned[selector_key] = [selector_tuple, True]
+            self.model = SelectorsModel(texts, groups, self)
+
+            self.view = QtWidgets.QListView()
+            self.view.setModel(self.model)
+            self.view.setItemDelegate(WrappingItemDelegate(self.view))
+            self.view.setFrameShape(QtWidgets.QFrame.NoFrame)
+            self.view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+            self.view.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+            self.view.setResizeMode(QtWidgets.QListView.Adjust)
+            # Rows are laid out a batch at a time, while the dialog is already shown
+            self.view.setLayoutMode(QtWidgets.QListView.Batched)
+            self.view.setBatchSize(200)
+            self.view.setAlternatingRowColors(True)
+            self.view.setContextMenuPolicy(Qt.CustomContextMenu)
+            self.view.customContextMenuRequested.connect(self.show_group_menu)
+            palette = self.view.palette()
+            if palette.color(QtGui.QPalette.Base).getRgb() == palette.color(QtGui.QPalette.AlternateBase).getRgb():
+                palette.setColor(QtGui.QPalette.AlternateBase, palette.color(QtGui.QPalette.Window))
+                self.view.setPalette(palette)
+            frameLayout.addWidget(self.view)
+        else:
+            # Nothing to choose, but proceed() still reads the model
+            self.model = SelectorsModel([], [], self)
+            labelInfo = QtWidgets.QLabel("I didn't find any unused selector.")
+            labelInfo.setContentsMargins(16, 12, 16, 12)
+            frameLayout.addWidget(labelInfo)
+            frameLayout.addStretch()
+
+        buttonBox = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok|QtWidgets.QDialogButtonBox.Cancel
+        )
+        buttonBox.accepted.connect(self.proceed)
+        buttonBox.rejected.connect(self.close)
+        buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setAutoDefault(True)
+        buttonBox.button(QtWidgets.QDialogButtonBox.Cancel).setAutoDefault(True)
+
+        mainLayout.addWidget(frame)
+        mainLayout.addWidget(buttonBox)
+
+        self.show()
+        buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setFocus()
+
+    def proceed(self):
+        for value, checked in zip(SelectorsDialog.orphaned_dict.values(), self.model.checked_rows()):
+            value[1] = checked
+        SelectorsDialog.stop_plugin = False
+        self.close()
+
+    def toggle_all(self):
+        self.model.set_checked(self.toggleAll.isChecked())
+
+    def toggle_group(self, css_id, checked):
+        self.model.set_checked(checked, self.model.group_rows(css_id))
+
+    def show_group_menu(self, position):
+        index = self.view.indexAt(position)
+        if not index.isValid():
+            return
+        css_id = self.model.group(index.row())
+        css_filename = self.css_filenames[css_id]
+        menu = QtWidgets.QMenu(self)
+        menu.addAction(f'Select all in {css_filename}').triggered.connect(
+            lambda: self.toggle_group(css_id, True))
+        menu.addAction(f'Unselect all in {css_filename}').triggered.connect(
+            lambda: self.toggle_group(css_id, False))
+        menu.exec(self.view.viewport().mapToGlobal(position))
+
+
+class ErrorDlg(QtWidgets.QWidget):
+
+    def __init__(self, filename):
+        super().__init__()
+        self.setWindowTitle('Error while parsing {}'.format(filename))
+
+        icon = QtWidgets.QLabel()
+        icon.setPixmap(
+            self.style()
+                .standardIcon(QtWidgets.QStyle.SP_MessageBoxCritical)
+                .pixmap(QtCore.QSize(32, 32))
+        )
+        msg = QtWidgets.QLabel(f'Type: {sys.exc_info()[0]}\nMessage: {sys.exc_info()[1]}')
+        msg.setMinimumWidth(300)
+        msg.setWordWrap(True)
+        msgLayout = QtWidgets.QHBoxLayout()
+        msgLayout.addWidget(icon)
+        msgLayout.addWidget(msg)
+        msgLayout.setSpacing(20)
+
+        buttonBox = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok)
+        buttonBox.accepted.connect(self.close)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(msgLayout)
+        layout.addWidget(buttonBox)
+        self.setLayout(layout)
+        self.show()
+
+
+class NotChangedDlg(QtWidgets.QWidget):
+    """
+    Tells which stylesheets (only scanned before the analysis) couldn't
+    be parsed when their selectors were about to be deleted.
+    """
+
+    def __init__(self, bk, css_not_changed):
+        super().__init__()
+        self.setWindowTitle('Stylesheets not changed')
+
+        icon = QtWidgets.QLabel()
+        icon.setPixmap(
+            self.style()
+                .standardIcon(QtWidgets.QStyle.SP_MessageBoxWarning)
+                .pixmap(QtCore.QSize(32, 32))
+        )
+        msg_text = ''
+        for file_, err in css_not_changed.items():
+            filename = href_to_basename(bk.id_to_href(file_))
+            msg_text += "I couldn't parse {} due to\n{}\n\n".format(filename, err)
+        msg_text += 'No selector was deleted from {}.'.format(
+            'it' if len(css_not_changed) == 1 else 'them')
+        msg = QtWidgets.QLabel(msg_text)
+        msg.setMinimumWidth(300)
+        msg.setWordWrap(True)
+        msgLayout = QtWidgets.QHBoxLayout()
+        msgLayout.addWidget(icon)
+        msgLayout.addWidget(msg)
+        msgLayout.setSpacing(20)
+
+        buttonBox = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok)
+        buttonBox.accepted.connect(self.close)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(msgLayout)
+        layout.addWidget(buttonBox)
+        self.setLayout(layout)
+        self.show()
+
+
+class AnalysisWorker(QtCore.QObject):
+    """
+    Calls function(progress, cancelled) in the thread it's moved to (see
+    run_in_background()), emitting progress with the steps done and the
+    total steps, and finished when the function returns or raises.
+    """
+
+    progress = Signal(int, int)
+    finished = Signal()
+
+    def __init__(self, function, cancel_event):
+        super().__init__()
+        self.function = function
+        self.cancel_event = cancel_event
+        self.result = None
+        self.error = None
+
+    @Slot()
+    def run(self):
+        try:
+            self.result = self.function(self.progress.emit, self.cancel_event.is_set)
+        except Exception as E:
+            self.error = E
+        finally:
+            self.finished.emit()
+
+
+def run_in_background(function):
+    """
+    Calls function(progress, cancelled) in a worker thread, showing a
+    progress dialog with a Cancel button, so that the user interface stays
+    responsive. function must call progress(n, total) when n of total
+    steps are done (the dialog shows a busy indicator until the first
+    call) and stop (raising AnalysisCancelled) when cancelled() returns True.
+    Returns what function returns, or raises the exception it raised.
+    """
+    cancel_event = threading.Event()
+    dialog = QtWidgets.QProgressDialog('Searching the selectors in the markup files...',
+                                       'Cancel', 0, 0)
+    dialog.setWindowTitle('Remove unused Selectors')
+    dialog.setWindowModality(Qt.ApplicationModal)
+    dialog.setMinimumDuration(500)
+    dialog.setAutoReset(False)
+    dialog.canceled.connect(cancel_event.set)
+
+    thread = QtCore.QThread()
+    worker = AnalysisWorker(function, cancel_event)
+    worker.moveToThread(thread)
+    def show_progress(done, total):
+        dialog.setMaximum(total)
+        dialog.setValue(done)
+    worker.progress.connect(show_progress)
+    worker.finished.connect(thread.quit)
+    thread.started.connect(worker.run)
+    loop = QtCore.QEventLoop()
+    thread.finished.connect(loop.quit)
+    thread.start()
+    loop.exec()
+    thread.wait()
+    dialog.close()
+    if worker.error is not None:
+        raise worker.error
+    return worker.result
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import namedtuple
+
+import regex as re
+from cssselect.parser import Attrib, Class, CombinedSelector, Element, Hash
+from cssselect.xpath import SelectorError
+
+
+# Names that cssselect translates to simple XPath name tests: every other
+# name is compared with name(), which doesn't behave like a name test
+# in documents with namespaces.
+SAFE_NAME = re.compile(r'[a-zA-Z_][a-zA-Z0-9_.-]*')
+# normalize-space() in XPath only knows about these whitespace characters
+XML_WHITESPACE = re.compile(r'[ \t\n\r]+')
+
+
+class DocumentFeatures:
+    """
+    Element names, ids, classes, attribute names and (name, value) pairs
+    of the attributes found in one or more markup trees.
+    Names are stored as lxml reports them: elements and attributes
+    in a namespace have the namespace URI in braces before their name.
+    """
+
+    __slots__ = ('tags', 'ids', 'classes', 'attributes', 'attribute_values')
+
+    def __init__(self):
+        self.tags = set()
+        self.ids = set()
+        self.classes = set()
+        self.attributes = set()
+        self.attribute_values = set()
+
+    def add_tree(self, tree):
+        for element in tree.iter():
+            # Comments, processing instructions and entities
+            # don't have a string as tag.
+            if not isinstance(element.tag, str):
+                continue
+            self.tags.add(element.tag)
+            for name, value in element.items():
+                self.attributes.add(name)
+                self.attribute_values.add((name, value))
+                if name == 'id':
+                    self.ids.add(value)
+                elif name == 'class':
+                    self.classes.update(XML_WHITESPACE.split(value))
+
+    def update(self, other):
+        self.tags |= other.tags
+        self.ids |= other.ids
+        self.classes |= other.classes
+        self.attributes |= other.attributes
+        self.attribute_values |= other.attribute_values
+
+
+class SelectorRequirements(namedtuple(
+        'SelectorRequirements',
+        ['tags', 'ids', 'classes', 'attributes', 'attribute_values'])):
+    """
+    What must be present in a document for a selector to match there:
+    every compound selector of the selector must match an element.
+    """
+
+    def satisfied_by(self, features):
+        return (self.tags <= features.tags
+                and self.ids <= features.ids
+                and self.classes <= features.classes
+                and self.attributes <= features.attributes
+                and self.attribute_values <= features.attribute_values)
+
+
+def selector_requirements(parsed_selector):
+    """
+    Returns the SelectorRequirements of parsed_selector (a cssselect.Selector)
+    or None if they can't be known without searching the document
+    (e.g. namespace prefixes, pseudo-elements, escaped names).
+    Only type, id, class and attribute selectors outside of functional
+    pseudo-classes like :not() are taken into account.
+    """
+    if parsed_selector is None or parsed_selector.pseudo_element is not None:
+        return None
+    tags, ids, classes, attributes, attribute_values = set(), set(), set(), set(), set()
+    pending = [parsed_selector.parsed_tree]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, CombinedSelector):
+            pending.append(node.selector)
+            pending.append(node.subselector)
+            continue
+        if isinstance(node, Element):
+            if node.namespace is not None:
+                return None
+            if node.element is not None:
+                if not SAFE_NAME.fullmatch(node.element):
+                    return None
+                tags.add(node.element)
+            continue
+        if isinstance(node, Hash):
+            ids.add(node.id)
+        elif isinstance(node, Class):
+            if XML_WHITESPACE.search(node.class_name):
+                return None
+            classes.add(node.class_name)
+        elif isinstance(node, Attrib):
+            if node.namespace is not None or not SAFE_NAME.fullmatch(node.attrib):
+                return None
+            value = getattr(node.value, 'value', node.value)
+            if node.operator == 'exists':
+                attributes.add(node.attrib)
+            elif node.operator == '=' and getattr(node, 'flag', None) is None:
+                attributes.add(node.attrib)
+                attribute_values.add((node.attrib, value))
+            elif node.operator != '!=':
+                attributes.add(node.attrib)
+        pending.append(node.selector)
+    return SelectorRequirements(
+        frozenset(tags), frozenset(ids), frozenset(classes),
+        frozenset(attributes), frozenset(attribute_values)
+    )
+
+
+class FeatureIndex:
+    """
+    Index of the DocumentFeatures of the trees of the documents and, if
+    add_book() is called, of the whole book (the union of the features of
+    all the trees). Used to rule out a selector for a tree, or for the
+    whole book, when one of its requirements is missing, without searching
+    the trees.
+    Every tree is indexed only when a selector is about to be searched
+    there, so no tree is built just for the index.
+    """
+
+    def __init__(self):
+        self.book = None
+        self.translators = set()
+        self._requirements = {}
+
+    def add(self, document, tree):
+        """
+        Returns the features of the tree ('html' or 'xml') of document,
+        indexing it if needed.
+        """
+        features = document.features.get(tree)
+        if features is None:
+            features = document.features[tree] = DocumentFeatures()
+            features.add_tree(getattr(document, tree))
+        return features
+
+    def add_book(self, documents):
+        """
+        Builds the features of the whole book from the trees of documents,
+        for book_may_match(). Only the trees already built are indexed:
+        if some of them aren't (see MarkupDocument), the features of the
+        book are unknown and book_may_match() rules out nothing.
+        """
+        documents = list(documents)
+        if not all(document.has_tree(tree) for document in documents for tree in ('html', 'xml')):
+            return
+        self.book = DocumentFeatures()
+        for document in documents:
+            for tree in ('html', 'xml'):
+                self.book.update(self.add(document, tree))
+            self.translators.add('xhtml' if document.is_xhtml else 'xml')
+
+    def requirements(self, selector, cache):
+        try:
+            return self._requirements[selector]
+        except KeyError:
+            requirements = selector_requirements(cache.parse(selector))
+            self._requirements[selector] = requirements
+            return requirements
+
+    def may_match(self, document, tree, selector, namespaces_dict, cache):
+        """
+        False if selector surely doesn't match anything in the tree ('html'
+        or 'xml') of document.
+        Selectors that cssselect can't translate to XPath are always kept.
+        """
+        requirements = self.requirements(selector, cache)
+        if requirements is None:
+            return True
+        try:
+            cache.get(selector, namespaces_dict, 'xhtml' if document.is_xhtml else 'xml')
+        except SelectorError:
+            return True
+        return requirements.satisfied_by(self.add(document, tree))
+
+    def book_may_match(self, selector, namespaces_dict, cache):
+        """
+        Like may_match(), but for the whole book: True for every selector
+        unless add_book() has indexed every document of the book.
+        """
+        requirements = self.requirements(selector, cache)
+        if requirements is None or self.book is None:
+            return True
+        for translator in self.translators:
+            try:
+                cache.get(selector, namespaces_dict, translator)
+            except SelectorError:
+                return True
+        return requirements.satisfied_by(self.book)
+
+
+def key_selector(parsed_selector):
+    """
+    Returns the key of parsed_selector (a cssselect.Selector), chosen among
+    the simple selectors of its rightmost compound selector: an id if there
+    is one, otherwise a class, otherwise an element name, as a tuple
+    ('ids', id), ('classes', class) or ('tags', name).
+    Returns None if no key can be used (e.g. "*", "[lang]", "svg|text").
+    """
+    if parsed_selector is None or parsed_selector.pseudo_element is not None:
+        return None
+    node = parsed_selector.parsed_tree
+    if isinstance(node, CombinedSelector):
+        node = node.subselector
+    key = None
+    while not isinstance(node, Element):
+        if isinstance(node, CombinedSelector):
+            return key
+        if isinstance(node, Hash):
+            key = ('ids', node.id)
+        elif (isinstance(node, Class) and (key is None or key[0] != 'ids')
+                and not XML_WHITESPACE.search(node.class_name)):
+            key = ('classes', node.class_name)
+        node = node.selector
+    if (key is None and node.namespace is None and node.element is not None
+            and SAFE_NAME.fullmatch(node.element)):
+        key = ('tags', node.element)
+    return key
+
+
+class RuleHash:
+    """
+    Selectors bucketed by their key selector (see key_selector()), like
+    browsers do with style rules: a selector can match in a document only
+    if its key is among the ids, classes or element names of the document,
+    so the selectors of the other buckets don't need to be searched there.
+    Selectors without a key, and selectors that cssselect can't translate
+    (always kept), are candidates for every document.
+    """
+
+    def __init__(self, queries, cache):
+        self.buckets = {'ids': {}, 'classes': {}, 'tags': {}}
+        self.universal = set()
+        # Number of searches of a selector in a document avoided
+        self.avoided = 0
+        for index, (selector, namespaces_dict) in enumerate(queries):
+            key = key_selector(cache.parse(selector))
+            if key is not None:
+                try:
+                    for translator in ('xhtml', 'xml'):
+                        cache.get(selector, namespaces_dict, translator)
+                except SelectorError:
+                    key = None
+            if key is None:
+                self.universal.add(index)
+            else:
+                self.buckets[key[0]].setdefault(key[1], set()).add(index)
+
+    def candidates(self, features):
+        """
+        Returns the set of the indexes of the selectors that can match
+        in a document with the given DocumentFeatures.
+        """
+        candidates = set(self.universal)
+        for kind, bucket in self.buckets.items():
+            values = getattr(features, kind)
+            if len(bucket) < len(values):
+                for value, indexes in bucket.items():
+                    if value in values:
+                        candidates |= indexes
+            else:
+                for value in values:
+                    indexes = bucket.get(value)
+                    if indexes:
+                        candidates |= indexes
+        return candidates
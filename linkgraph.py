@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Which stylesheets are loaded by every markup file: the ones linked with
+<link rel="stylesheet"> or <?xml-stylesheet?>, the ones imported by its
+<style> elements and, recursively, the ones imported by them.
+Links are found in the raw text of the files, without parsing it: a link
+commented out is still counted, so that a selector is never searched in
+fewer documents than those that can use it.
+"""
+
+
+import posixpath
+import re
+from urllib.parse import unquote
+
+
+_LINK = re.compile(rb'<(?:link|\?xml-stylesheet)\b[^>]*>', re.I)
+_STYLE = re.compile(rb'<style\b[^>]*>(.*?)</style\s*>', re.I | re.S)
+_ATTRIBUTE = re.compile(rb'''([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+_IMPORT = re.compile(
+    r'''@import\s+(?:url\(\s*(?:"([^"]*)"|'([^']*)'|([^)\s]*))\s*\)|"([^"]*)"|'([^']*)')''', re.I)
+
+
+def css_imports(css_string):
+    """
+    Returns the list of the urls imported by css_string with @import.
+    """
+    return [next(url for url in match.groups() if url is not None)
+            for match in _IMPORT.finditer(css_string)]
+
+
+def markup_links(data):
+    """
+    Returns the hrefs of the stylesheets linked or imported by the markup
+    file whose raw content is data (bytes).
+    """
+    hrefs = []
+    for tag in _LINK.finditer(data):
+        attributes = {
+            name.lower(): (double if double is not None else single)
+            for name, double, single in _ATTRIBUTE.findall(tag.group())
+        }
+        href = attributes.get(b'href')
+        if href is None:
+            continue
+        if tag.group().startswith(b'<?'):
+            if attributes.get(b'type', b'text/css').strip().lower() != b'text/css':
+                continue
+        elif b'stylesheet' not in attributes.get(b'rel', b'').lower().split():
+            continue
+        hrefs.append(href.decode('utf-8', 'replace'))
+    for style in _STYLE.finditer(data):
+        hrefs.extend(css_imports(style.group(1).decode('utf-8', 'replace')))
+    return hrefs
+
+
+def resolve_href(base_href, href):
+    """
+    The href (relative to the same directory of base_href) of the file at
+    href in a file whose href is base_href, or None if href points
+    outside of the book.
+    """
+    href = href.strip().split('#')[0].split('?')[0]
+    if not href or re.match(r'[a-zA-Z][\w+.-]*:|/', href):
+        return None
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_href), unquote(href)))
+
+
+class StylesheetScopes:
+    """
+    Tells which stylesheets of the book (given as {css_id: (href, text)})
+    are loaded by a markup document, following the @import rules of the
+    stylesheets.
+    """
+
+    def __init__(self, stylesheets):
+        self._ids = {href: css_id for css_id, (href, text) in stylesheets.items()}
+        imports = {
+            css_id: self._resolve(href, css_imports(text))
+            for css_id, (href, text) in stylesheets.items()
+        }
+        # Every stylesheet with the ones imported by it, directly or not
+        self._closures = {}
+        for css_id in stylesheets:
+            closure = {css_id}
+            pending = [css_id]
+            while pending:
+                for imported in imports[pending.pop()]:
+                    if imported not in closure:
+                        closure.add(imported)
+                        pending.append(imported)
+            self._closures[css_id] = frozenset(closure)
+
+    def _resolve(self, base_href, hrefs):
+        css_ids = []
+        for href in hrefs:
+            css_id = self._ids.get(resolve_href(base_href, href))
+            if css_id is not None:
+                css_ids.append(css_id)
+        return css_ids
+
+    def loaded_by(self, document):
+        """
+        The set of the ids of the stylesheets loaded by document (a
+        MarkupDocument).
+        """
+        loaded = set()
+        for css_id in self._resolve(document.href, document.stylesheet_links):
+            loaded |= self._closures[css_id]
+        return loaded
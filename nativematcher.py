@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import regex as re
+from cssselect.parser import CombinedSelector, Element, parse_series
+from lxml import etree
+
+from featureindex import SAFE_NAME, XML_WHITESPACE
+
+
+NON_WHITESPACE = re.compile(r'[^ \t\r\n\f]+')
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+class UnsupportedSelector(Exception):
+    """
+    The selector uses something the native matcher can't evaluate
+    (e.g. :has(), :lang(), pseudo-elements, escaped names): it must be
+    searched through cssselect and XPath.
+    """
+
+
+class NativeSelector:
+    """
+    A selector compiled to a Python function testing lxml elements,
+    to be used instead of the XPath translation made by cssselect.
+    Supported: type, universal, class, id and attribute selectors
+    (with or without namespace prefixes), descendant, child and sibling
+    combinators, :not(), :is(), :where(), the structural pseudo-classes
+    (:root, :empty, :first-child, :nth-child() and the like, *-of-type
+    included) and :contains().
+    The results are the same of the XPath built by cssselect, except that
+    *:first-of-type and the like (not implemented by cssselect) are
+    evaluated instead of being reported as matching.
+    """
+
+    def __init__(self, parsed_selector, namespaces_dict=None):
+        if parsed_selector.pseudo_element is not None:
+            raise UnsupportedSelector('pseudo-element ::{}'.format(parsed_selector.pseudo_element))
+        self.namespaces = namespaces_dict or {}
+        self.match = self._compile(parsed_selector.parsed_tree)
+        self.tag = self._subject_tag(parsed_selector.parsed_tree)
+
+    def exists(self, tree):
+        """
+        True if at least one element of tree (root included) matches.
+        """
+        match = self.match
+        for element in tree.iter(self.tag):
+            if match(element):
+                return True
+        return False
+
+    def _subject_tag(self, node):
+        """
+        The tag every matching element must have, as lxml reports it,
+        or etree.Element if it isn't known.
+        """
+        if isinstance(node, CombinedSelector):
+            node = node.subselector
+        while not isinstance(node, Element):
+            node = node.selector
+        if node.element is None or node.namespace == '*':
+            return etree.Element
+        return self._qualified_name(node.namespace, node.element)
+
+    def _qualified_name(self, prefix, name):
+        if not SAFE_NAME.fullmatch(name):
+            raise UnsupportedSelector('escaped name {}'.format(name))
+        if not prefix:
+            return name
+        try:
+            return '{{{}}}{}'.format(self.namespaces[prefix], name)
+        except KeyError:
+            raise UnsupportedSelector('undeclared prefix {}'.format(prefix))
+
+    def _compile(self, node):
+        method = getattr(self, '_compile_' + type(node).__name__.lower(), None)
+        if method is None:
+            raise UnsupportedSelector(type(node).__name__)
+        return method(node)
+
+    def _compile_combinedselector(self, node):
+        left = self._compile(node.selector)
+        right = self._compile(node.subselector)
+        if node.combinator == ' ':
+            def match(element):
+                if not right(element):
+                    return False
+                for ancestor in element.iterancestors():
+                    if left(ancestor):
+                        return True
+                return False
+        elif node.combinator == '>':
+            def match(element):
+                if not right(element):
+                    return False
+                parent = element.getparent()
+                return parent is not None and left(parent)
+        elif node.combinator == '+':
+            def match(element):
+                if not right(element):
+                    return False
+                for sibling in element.itersiblings(etree.Element, preceding=True):
+                    return left(sibling)
+                return False
+        elif node.combinator == '~':
+            def match(element):
+                if not right(element):
+                    return False
+                for sibling in element.itersiblings(etree.Element, preceding=True):
+                    if left(sibling):
+                        return True
+                return False
+        else:
+            raise UnsupportedSelector('combinator {}'.format(node.combinator))
+        return match
+
+    def _compile_element(self, node):
+        if node.namespace == '*':
+            if node.element is None:
+                return lambda element: True
+            if not SAFE_NAME.fullmatch(node.element):
+                raise UnsupportedSelector('escaped name {}'.format(node.element))
+            local_name = node.element
+            suffix = '}' + local_name
+            return lambda element: element.tag == local_name or element.tag.endswith(suffix)
+        if node.element is None:
+            if node.namespace is None:
+                return lambda element: True
+            prefix = self._qualified_name(node.namespace, 'a')[:-1]
+            return lambda element: element.tag.startswith(prefix)
+        tag = self._qualified_name(node.namespace, node.element)
+        return lambda element: element.tag == tag
+
+    def _compile_hash(self, node):
+        inner = self._compile(node.selector)
+        value = node.id
+        return lambda element: element.get('id') == value and inner(element)
+
+    def _compile_class(self, node):
+        inner = self._compile(node.selector)
+        if not NON_WHITESPACE.fullmatch(node.class_name):
+            return lambda element: False
+        token = ' {} '.format(node.class_name)
+        def match(element):
+            value = element.get('class')
+            return (value is not None
+                    and token in ' {} '.format(' '.join(XML_WHITESPACE.split(value)))
+                    and inner(element))
+        return match
+
+    def _compile_attrib(self, node):
+        inner = self._compile(node.selector)
+        value = getattr(node.value, 'value', node.value)
+        ignore_case = getattr(node, 'flag', None) == 'i' and bool(value)
+        if ignore_case:
+            value = value.translate(ASCII_LOWER)
+        if node.namespace == '*':
+            raise UnsupportedSelector('attribute in any namespace')
+        name = self._qualified_name(node.namespace, node.attrib)
+        operator = node.operator
+        if operator == 'exists':
+            test = lambda actual: True
+        elif operator == '=':
+            test = lambda actual: actual == value
+        elif operator == '!=':
+            if value:
+                test = None
+            else:
+                test = lambda actual: actual != value
+        elif operator == '~=':
+            if not value or not NON_WHITESPACE.fullmatch(value):
+                return lambda element: False
+            token = ' {} '.format(value)
+            test = lambda actual: token in ' {} '.format(' '.join(XML_WHITESPACE.split(actual)))
+        elif operator == '|=':
+            prefix = value + '-'
+            test = lambda actual: actual == value or actual.startswith(prefix)
+        elif operator == '^=':
+            if not value:
+                return lambda element: False
+            test = lambda actual: actual.startswith(value)
+        elif operator == '$=':
+            if not value:
+                return lambda element: False
+            test = lambda actual: actual.endswith(value)
+        elif operator == '*=':
+            if not value:
+                return lambda element: False
+            test = lambda actual: value in actual
+        else:
+            raise UnsupportedSelector('attribute operator {}'.format(operator))
+        if test is None:
+            # [name!=value] matches elements without the attribute, too
+            def match(element):
+                actual = element.get(name)
+                if actual is not None and ignore_case:
+                    actual = actual.translate(ASCII_LOWER)
+                return (actual is None or actual != value) and inner(element)
+            return match
+        def match(element):
+            actual = element.get(name)
+            if actual is None:
+                return False
+            if ignore_case:
+                actual = actual.translate(ASCII_LOWER)
+            return test(actual) and inner(element)
+        return match
+
+    def _compile_negation(self, node):
+        inner = self._compile(node.selector)
+        negated = self._compile(node.subselector)
+        return lambda element: not negated(element) and inner(element)
+
+    def _compile_matching(self, node):
+        inner = self._compile(node.selector)
+        alternatives = [self._compile(selector) for selector in node.selector_list]
+        return lambda element: (any(alternative(element) for alternative in alternatives)
+                                and inner(element))
+
+    _compile_specificityadjustment = _compile_matching
+
+    def _compile_pseudo(self, node):
+        inner = self._compile(node.selector)
+        name = node.ident.lower()
+        if name == 'root':
+            test = lambda element: element.getparent() is None
+        elif name == 'empty':
+            test = is_empty
+        elif name in ('first-child', 'last-child', 'only-child',
+                      'first-of-type', 'last-of-type', 'only-of-type'):
+            position, _, kind = name.partition('-')
+            of_type = kind == 'of-type'
+            before = position in ('first', 'only')
+            after = position in ('last', 'only')
+            def test(element):
+                tag = element.tag if of_type else etree.Element
+                return ((not before or count_siblings(element, tag, True, 1) == 0)
+                        and (not after or count_siblings(element, tag, False, 1) == 0))
+        else:
+            raise UnsupportedSelector('pseudo-class :{}'.format(name))
+        return lambda element: test(element) and inner(element)
+
+    def _compile_function(self, node):
+        inner = self._compile(node.selector)
+        name = node.name.lower()
+        if name in ('nth-child', 'nth-last-child', 'nth-of-type', 'nth-last-of-type'):
+            try:
+                a, b = parse_series(node.arguments)
+            except ValueError:
+                raise UnsupportedSelector('invalid series')
+            of_type = name.endswith('of-type')
+            preceding = not name.startswith('nth-last')
+            def test(element):
+                count = count_siblings(element, element.tag if of_type else etree.Element,
+                                       preceding)
+                # Is there an n >= 0 such that a*n + b - 1 == count?
+                if a == 0:
+                    return count == b - 1
+                n, remainder = divmod(count - b + 1, a)
+                return remainder == 0 and n >= 0
+        elif name == 'contains':
+            if node.argument_types() not in (['STRING'], ['IDENT']):
+                raise UnsupportedSelector('invalid argument of :contains()')
+            # Case insensitive, like in lxml.cssselect
+            text = node.arguments[0].value.lower()
+            test = lambda element: text in ''.join(element.itertext()).lower()
+        else:
+            raise UnsupportedSelector('function :{}()'.format(name))
+        return lambda element: test(element) and inner(element)
+
+
+def count_siblings(element, tag, preceding, limit=None):
+    """
+    Number of the element siblings of element with the given tag
+    (etree.Element for every element) before it (or after it, if
+    preceding is False). Counting stops at limit.
+    """
+    count = 0
+    for sibling in element.itersiblings(tag, preceding=preceding):
+        count += 1
+        if count == limit:
+            break
+    return count
+
+
+def is_empty(element):
+    """
+    True if element has neither children elements nor text (text inside
+    comments and processing instructions doesn't count, like in XPath).
+    """
+    if element.text:
+        return False
+    for child in element:
+        if isinstance(child.tag, str) or child.tail:
+            return False
+    return True
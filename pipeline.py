@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2016, 2019, 2020, 2024, 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The steps of the plugin that don't need a user interface: parsing of the
+stylesheets, search of the orphaned selectors and their deletion. Used both
+by the Sigil plugin (plugin.py) and by the command line interface (cli.py).
+"""
+
+
+from collections import OrderedDict
+import os
+import sqlite3
+
+from lxml import etree
+try:
+    import css_parser as cssutils
+except ImportError:
+    import cssutils
+
+from analysis import (
+    css_namespaces, style_rules, iter_markup, find_orphaned_selectors, SelectorMatcher,
+    new_xml_parser, markup_files, monitor_documents, AnalysisCancelled
+)
+from cssparsing import parse_css_strings, scan_css_string
+from featureindex import FeatureIndex
+from linkgraph import StylesheetScopes
+from sourcespans import scan_stylesheet, spans_match, remove_selectors
+from verdictcache import VerdictCache, analysis_version
+
+
+SCRIPT_DIR = os.path.normpath(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Sigil 0.9.7 broke compatibility in reading css and js files.
+def read_css(bk, css):
+    css_string = bk.readfile(css)
+    try:
+        return css_string.decode()
+    except AttributeError:
+        return css_string
+
+
+def pre_parse_css(bk, parser, workers=1, cache=None, scan_only=False):
+    """
+    Parses every stylesheet of the book once. Returns the stylesheets
+    that can't be parsed (with the exception raised), the stylesheets
+    containing unknown @rules and an OrderedDict of the successfully
+    parsed ones, each with its CSSStyleSheet object, the namespaces
+    declared in it and its text, ready to be used by the analysis and
+    deletion phases.
+    For safety reason, every exception raised during css parsing
+    will cause the css to be left untouched.
+    Stylesheets are parsed by workers processes, and looked up first in
+    cache, if given (see parse_css_strings()).
+    If scan_only is True, the stylesheets are only scanned to find their
+    selectors (see cssparsing.scan_css_string()): their CSSStyleSheet is
+    None, and they are parsed by delete_selectors() only if changed.
+    """
+    css_to_skip = {}
+    css_warnings = {}
+    css_to_parse = OrderedDict()
+    css_ids = [css_id for css_id, css_href in bk.css_iter()]
+    css_strings = [read_css(bk, css_id) for css_id in css_ids]
+    if scan_only:
+        for css_id, css_string in zip(css_ids, css_strings):
+            scanned, selector_texts, E = scan_css_string(css_string)
+            if E is not None:
+                css_to_skip[css_id] = E
+                continue
+            if scanned.unknown_rules:
+                css_warnings[css_id] = scanned.unknown_rules[0]
+            namespaces_dict, default_prefix = css_namespaces(scanned)
+            css_to_parse[css_id] = {
+                'stylesheet': None,
+                'namespaces': namespaces_dict,
+                'default_prefix': default_prefix,
+                'text': css_string,
+                'scanned': scanned,
+                'selectors': selector_texts,
+                'parser': parser
+            }
+        return css_to_skip, css_to_parse, css_warnings
+    results = parse_css_strings(parser, css_strings, workers, cache)
+    for css_id, css_string, (parsed, E) in zip(css_ids, css_strings, results):
+        if E is not None:
+            css_to_skip[css_id] = E
+        else:
+            # 0 means UNKNOWN_RULE, as from cssutils.css.cssrule.CSSRule
+            for unknown_rule in parsed.cssRules.rulesOfType(0):
+                line = css_string[:css_string.find(unknown_rule.atkeyword)].count('\n')+1
+                css_warnings[css_id] = (unknown_rule.atkeyword, line)
+                break
+            namespaces_dict, default_prefix = css_namespaces(parsed)
+            css_to_parse[css_id] = {
+                'stylesheet': parsed,
+                'namespaces': namespaces_dict,
+                'default_prefix': default_prefix,
+                'text': css_string
+            }
+    return css_to_skip, css_to_parse, css_warnings
+
+
+def set_css_output_prefs(bk, prefs, save_on_file=True):
+    """
+    As from https://pythonhosted.org/cssutils/docs/serialize.html
+    """
+    cssutils.ser.prefs.indent = prefs['indent']
+    cssutils.ser.prefs.indentClosingBrace = prefs['indentClosingBrace']
+    cssutils.ser.prefs.keepEmptyRules = prefs['keepEmptyRules']
+    cssutils.ser.prefs.omitLastSemicolon = prefs['omitLastSemicolon']
+    cssutils.ser.prefs.omitLeadingZero = prefs['omitLeadingZero']
+
+    # custom prefs, not in cssutils
+    cssutils.ser.prefs.linesAfterRules = prefs['linesAfterRules']
+    cssutils.ser.prefs.formatUnknownAtRules = prefs['formatUnknownAtRules']
+
+    if save_on_file:
+        bk.savePrefs(prefs)
+
+
+def get_prefs(bk):
+    prefs = bk.getPrefs()
+
+    # CSS output prefs
+    prefs.defaults['indent'] = "\t"  # 2 * ' '
+    prefs.defaults['indentClosingBrace'] = False
+    prefs.defaults['keepEmptyRules'] = True
+    prefs.defaults['omitLastSemicolon'] = False
+    prefs.defaults['omitLeadingZero'] = False
+    prefs.defaults['linesAfterRules'] = 1 * '\n'
+    prefs.defaults['formatUnknownAtRules'] = False
+    # Delete the selectors from the original text of the stylesheets,
+    # leaving the rest untouched, instead of serializing them again with
+    # the prefs above
+    prefs.defaults['sourceEditing'] = False
+
+    # Update pref names to make them uniform with new css-parser pref names
+    if prefs.get('blankLinesAfterRules'):
+        prefs['linesAfterRules'] = prefs['blankLinesAfterRules']
+        del prefs['blankLinesAfterRules']
+    if prefs.get('formatUnknownRules'):
+        prefs['formatUnknownAtRules'] = prefs['formatUnknownRules']
+        del prefs['formatUnknownRules']
+
+    # Other prefs
+    prefs.defaults['parseAllXMLFiles'] = True
+    # Build the html and xml trees of markup files only when needed
+    prefs.defaults['lazyMarkupTrees'] = False
+    # 'selectors': every selector is searched in every document in turn;
+    # 'documents': every document is searched for every selector still
+    # unmatched, and no other document is parsed once all selectors matched;
+    # 'streaming': like 'documents', but streamingBatchSize documents at a time
+    # 'parallel': documents are split among parallelWorkers processes
+    prefs.defaults['analysisMode'] = 'selectors'
+    prefs.defaults['streamingBatchSize'] = 20
+    # 0: as many processes as the cpu cores
+    prefs.defaults['parallelWorkers'] = 0
+    # Parse the stylesheets with parallelWorkers processes
+    prefs.defaults['parallelCssParsing'] = False
+    # Only scan the stylesheets for their selectors, without parsing the
+    # declarations: the stylesheets are parsed only if some of their
+    # selectors are deleted
+    prefs.defaults['scanOnlyCss'] = False
+    # Keep the results of the analysis in the prefs directory and reuse them
+    # for the markup files and selectors that didn't change since then
+    prefs.defaults['verdictCache'] = False
+    # Days after which unused results are deleted
+    prefs.defaults['verdictCacheMaxAge'] = 30
+    prefs.defaults['verdictCacheMaxEntries'] = 1000000
+    # Don't search selectors in documents lacking some of the element names,
+    # ids, classes and attributes they require
+    prefs.defaults['useFeatureIndex'] = True
+    # Search in a document only the selectors whose rightmost id, class
+    # or element name is present in it
+    prefs.defaults['useRuleHash'] = True
+    # Search the most common selectors directly in the trees, without
+    # translating them to XPath
+    prefs.defaults['nativeMatcher'] = True
+    # Search the selectors of every stylesheet only in the markup files
+    # linking it (directly or through @import rules)
+    prefs.defaults['scopedMatching'] = False
+    # Print the work done and avoided by the analysis (see
+    # SelectorMatcher.statistics())
+    prefs.defaults['printStatistics'] = False
+    prefs.defaults['quiet'] = False
+
+    return prefs
+
+
+def plugin_version():
+    with open(os.path.join(SCRIPT_DIR, 'plugin.xml'), encoding='utf-8') as f:
+        return etree.parse(f).findtext('version')
+
+
+def prefs_directory(bk, prefs):
+    """
+    The directory where Sigil saves the preferences of the plugin.
+    """
+    file_path = getattr(prefs, 'file_path', None)
+    if file_path:
+        return os.path.dirname(file_path)
+    return os.path.join(os.path.dirname(bk._w.plugin_dir), 'plugins_prefs', bk._w.plugin_name)
+
+
+def open_verdicts(bk, prefs):
+    """
+    Returns the VerdictCache in the prefs directory, or None if it's
+    disabled in prefs or the database can't be opened.
+    """
+    if not prefs['verdictCache']:
+        return None
+    try:
+        return VerdictCache(prefs_directory(bk, prefs), analysis_version(plugin_version()),
+                            prefs['verdictCacheMaxAge'], prefs['verdictCacheMaxEntries'])
+    except (sqlite3.Error, OSError) as E:
+        print('Verdict cache not available: {}'.format(E))
+        return None
+
+
+def stylesheet_scopes(bk, css_to_parse):
+    """
+    Returns the StylesheetScopes of the stylesheets of bk, reusing the text
+    of the ones in css_to_parse. The stylesheets that can't be parsed are
+    included, too, since they can import the others.
+    """
+    stylesheets = {}
+    for css_id, css_href in bk.css_iter():
+        css = css_to_parse.get(css_id)
+        stylesheets[css_id] = (css_href, read_css(bk, css_id) if css is None else css['text'])
+    return StylesheetScopes(stylesheets)
+
+
+def markup_precompute(prefs, verdicts):
+    """
+    The attributes of the markup documents needed by the analysis that
+    must be computed before their raw data is freed (see MarkupDocument).
+    """
+    precompute = ()
+    if verdicts is not None:
+        precompute += ('digest',)
+    if prefs['scopedMatching']:
+        precompute += ('stylesheet_links',)
+    return precompute
+
+
+def find_orphans(bk, prefs, css_to_parse, verdicts=None, progress=None, cancelled=None):
+    """
+    Searches the selectors of the stylesheets in css_to_parse (as returned
+    by pre_parse_css()) in the markup files of bk, with the analysis options
+    in prefs. Returns the list of the orphaned selectors (see
+    find_orphaned_selectors()) and the SelectorMatcher used for the search.
+    If given, progress(n, total) is called as the search goes on: in
+    'selectors' mode when n of the total distinct selectors have been
+    searched, in the other modes when n of the total markup files have
+    been searched (see find_orphaned_selectors()). cancelled() is checked
+    before every search: when it returns True, AnalysisCancelled is raised
+    (in parallel mode, not before the worker processes are done).
+    Raises etree.XMLSyntaxError if a markup file is malformed.
+    """
+    # In parallel mode the trees are built by the worker processes
+    documents = iter_markup(bk, prefs['parseAllXMLFiles'], new_xml_parser(),
+                            prefs['lazyMarkupTrees'] or prefs['analysisMode'] == 'parallel',
+                            markup_precompute(prefs, verdicts))
+    if prefs['analysisMode'] in ('documents', 'streaming'):
+        documents = monitor_documents(documents, progress, cancelled,
+                                      len(markup_files(bk, prefs['parseAllXMLFiles'])))
+        matching_progress = None
+    else:
+        documents = monitor_documents(documents, cancelled=cancelled)
+        matching_progress = progress
+    matcher = SelectorMatcher(
+        index=FeatureIndex() if prefs['useFeatureIndex'] else None,
+        use_rule_hash=prefs['useRuleHash'],
+        native=prefs['nativeMatcher'],
+        verdicts=verdicts,
+        cancelled=cancelled,
+        scopes=stylesheet_scopes(bk, css_to_parse) if prefs['scopedMatching'] else None
+    )
+    orphaned_selectors = find_orphaned_selectors(
+        css_to_parse, documents, prefs['analysisMode'], matcher,
+        prefs['streamingBatchSize'], prefs['parallelWorkers'], matching_progress
+    )
+    if cancelled is not None and cancelled():
+        raise AnalysisCancelled()
+    return orphaned_selectors, matcher
+
+
+def delete_selectors(bk, selectors, css_to_parse=None, source_editing=False):
+    """
+    Deletes the selectors (items of the list returned by
+    find_orphaned_selectors()) from their rules and writes the changed
+    stylesheets in bk. The selector list of every rule is rebuilt once,
+    and every changed stylesheet is serialized once.
+    The stylesheets that were only scanned by pre_parse_css() are parsed
+    now, from their text in css_to_parse: if they can't be parsed, or their
+    rules don't match the scanned ones, they are left untouched and
+    returned with the exception that prevented the change.
+    If source_editing is True, the selectors are instead cut out of the
+    original text of the stylesheets in css_to_parse (see
+    sourcespans.remove_selectors()), unless the rules found in the text
+    don't match the parsed ones.
+    Returns the dictionary {css_id: new css text} of the changed stylesheets,
+    the list of the selectors actually deleted and the dictionary
+    {css_id: exception} of the stylesheets left untouched.
+    """
+    css_not_changed = {}
+    selectors = parse_scanned(selectors, css_to_parse, css_not_changed)
+    # id(rule) -> (rule, indexes of the selectors to delete)
+    rules = OrderedDict()
+    stylesheets = OrderedDict()
+    for css_id, rule, selector, selector_index, parsed_css, *_ in selectors:
+        rules.setdefault(id(rule), (rule, set()))[1].add(selector_index)
+        stylesheets[css_id] = parsed_css
+    css_to_change = {}
+    if source_editing:
+        for css_id, parsed_css in stylesheets.items():
+            css_text = edit_source(css_to_parse[css_id]['text'], parsed_css, rules)
+            if css_text is not None:
+                css_to_change[css_id] = css_text
+    for rule, indexes in rules.values():
+        selector_list = rule.selectorList
+        selector_list.seq[:] = [
+            selector for index, selector in enumerate(selector_list.seq) if index not in indexes
+        ]
+    for css_id, parsed_css in stylesheets.items():
+        if css_id not in css_to_change:
+            css_to_change[css_id] = parsed_css.cssText
+    for css_id, css_text in css_to_change.items():
+        bk.writefile(css_id, css_text)
+    return css_to_change, selectors, css_not_changed
+
+
+def parse_scanned(selectors, css_to_parse, css_not_changed):
+    """
+    Returns selectors with the occurrences from the stylesheets that were
+    only scanned (see analysis.rule_selectors()) replaced by those of the
+    parsed stylesheets. The occurrences of the stylesheets that can't be
+    parsed, or whose rules don't match the scanned ones, are dropped, and
+    the stylesheets are added to css_not_changed with the exception.
+    """
+    parsed_rules = {}
+    result = []
+    for occurrence in selectors:
+        css_id, rule_index, _, selector_index, parsed_css, selector_text = occurrence
+        if parsed_css is not None:
+            result.append(occurrence)
+            continue
+        if css_id not in parsed_rules:
+            css = css_to_parse[css_id]
+            parsed_rules[css_id] = None
+            try:
+                parsed = css['parser'].parseString(css['text'])
+            except Exception as E:
+                css_not_changed[css_id] = E
+                continue
+            rules = list(style_rules(parsed))
+            if not spans_match(css['text'], css['scanned'].rules, rules):
+                css_not_changed[css_id] = ValueError(
+                    'the rules of the parsed stylesheet don\'t match the scanned ones')
+                continue
+            css['stylesheet'] = parsed
+            parsed_rules[css_id] = rules
+        rules = parsed_rules[css_id]
+        if rules is not None:
+            rule = rules[rule_index]
+            result.append((css_id, rule, rule.selectorList[selector_index], selector_index,
+                           css_to_parse[css_id]['stylesheet'], selector_text))
+    return result
+
+
+def edit_source(css_string, parsed_css, rules):
+    """
+    Returns css_string without the selectors to delete in rules (as built
+    by delete_selectors()) and without the rules and @media rules left
+    empty, or None if the style rules in css_string don't match those of
+    parsed_css (see sourcespans.spans_match()).
+    """
+    scanned = scan_stylesheet(css_string)
+    spans = scanned.rules
+    parsed_rules = list(style_rules(parsed_css))
+    if not spans_match(css_string, spans, parsed_rules):
+        return None
+    removals = {}
+    for rule_index, rule in enumerate(parsed_rules):
+        try:
+            removals[rule_index] = rules[id(rule)][1]
+        except KeyError:
+            pass
+    return remove_selectors(css_string, spans, removals, scanned.groups)
+
+
+def href_to_basename(href, ow=None):
+    """
+    From the bookcontainer's API. There's a typo until Sigil 0.9.5.
+    """
+    if href is not None:
+        return href.split('/')[-1]
+    return ow
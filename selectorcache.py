@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import namedtuple
+
+import cssselect as cssselect_parser
+from cssselect.parser import CombinedSelector
+from cssselect.xpath import SelectorError
+from lxml import cssselect, etree
+
+from nativematcher import NativeSelector, UnsupportedSelector
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+
+# The translators used by lxml.cssselect.CSSSelector
+TRANSLATORS = {
+    'xml': cssselect.LxmlTranslator(),
+    'html': cssselect.LxmlHTMLTranslator(),
+    'xhtml': cssselect.LxmlHTMLTranslator(xhtml=True),
+}
+
+
+def namespaces_key(namespaces_dict):
+    """
+    Hashable, order independent representation of a namespaces dictionary.
+    """
+    if not namespaces_dict:
+        return ()
+    return tuple(sorted(namespaces_dict.items()))
+
+
+# Axes from an element to the one matched by the left side of a combinator
+REVERSE_AXES = {
+    ' ': 'ancestor::*',
+    '>': 'parent::*',
+    '+': 'preceding-sibling::*[1]',
+    '~': 'preceding-sibling::*',
+}
+
+
+def match_condition(translator, parsed_tree):
+    """
+    Returns an XPath condition that is true for the elements matching
+    parsed_tree (a cssselect parsed selector), with the combinators
+    translated to reverse axes from the matching element, or None if
+    every element matches. Returns False if the selector can't be
+    translated this way (positional conditions like the one of :scope
+    can't be moved out of the step they are in).
+    """
+    if isinstance(parsed_tree, CombinedSelector):
+        left = match_condition(translator, parsed_tree.selector)
+        right = match_condition(translator, parsed_tree.subselector)
+        if left is False or right is False:
+            return False
+        axis = REVERSE_AXES[parsed_tree.combinator]
+        if left is not None:
+            axis = '{}[{}]'.format(axis, left)
+        return axis if right is None else '({}) and {}'.format(right, axis)
+    xpath = translator.xpath(parsed_tree)
+    if xpath.path or 'position()' in xpath.condition:
+        return False
+    conditions = [condition for condition in (
+        '' if xpath.element == '*' else 'self::{}'.format(xpath.element),
+        xpath.condition
+    ) if condition]
+    if len(conditions) > 1:
+        return ' and '.join('({})'.format(condition) for condition in conditions)
+    return conditions[0] if conditions else None
+
+
+def existence_xpath(css, translator='xml'):
+    """
+    Translates css to an XPath expression that is true if at least one
+    element matches css, and that libxml2 can stop evaluating as soon as
+    the first matching element is found: the last step of every path has
+    a [1] predicate (so no node-set with every matching element is built)
+    and combinators are translated to conditions on the matching element
+    itself (see match_condition()), so that elements are tested in
+    document order, e.g. "div p" becomes
+    boolean(descendant-or-self::*[(self::p) and ancestor::*[self::div]][1]).
+    Raises SelectorError like lxml.cssselect.CSSSelector does.
+    """
+    translator = TRANSLATORS[translator]
+    paths = []
+    for parsed_selector in cssselect_parser.parse(css):
+        path = translator.selector_to_xpath(parsed_selector, translate_pseudo_elements=True)
+        if isinstance(parsed_selector.parsed_tree, CombinedSelector):
+            condition = match_condition(translator, parsed_selector.parsed_tree)
+            if condition:
+                path = 'descendant-or-self::*[{}]'.format(condition)
+        paths.append(path + '[1]')
+    return 'boolean({})'.format(' | '.join(paths))
+
+
+# Prefix of the extension functions of lxml.cssselect (e.g. the lower-case()
+# used by :contains())
+EXTENSION_PREFIX = '__lxml_internal_css:'
+
+
+class FreshXPath:
+    """
+    An XPath expression compiled again every time it is evaluated. A
+    compiled XPath calling extension functions can't be evaluated safely
+    once the tree it was first evaluated on has been freed (lxml may fail
+    to find the function), so only its text is kept.
+    """
+
+    def __init__(self, path, namespaces_dict):
+        self.path = path
+        self.namespaces = namespaces_dict
+
+    def __call__(self, tree):
+        return etree.XPath(self.path, namespaces=self.namespaces)(tree)
+
+
+class CompiledSelectorCache:
+    """
+    Keeps the compiled XPath (a lxml.cssselect.CSSSelector) of every
+    selector translated during a run, so that the translation from css
+    to XPath and the compilation of the XPath expression are done once
+    per selector and not once per selector per document.
+    Selectors whose XPath calls extension functions (like :contains())
+    are kept as FreshXPath objects: they are translated once, but
+    compiled for every document.
+    Selectors that cssselect is not able to translate are cached too,
+    together with the exception raised by the translation.
+    """
+
+    def __init__(self):
+        self._compiled = {}
+        self._parsed = {}
+        self._native = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, selector, namespaces_dict, translator):
+        """
+        Returns the compiled selector. Raises SelectorError if cssselect
+        can't translate the selector to XPath.
+        """
+        return self._compiled_xpath(
+            selector, namespaces_dict, translator, 'select',
+            lambda css: cssselect.CSSSelector(css, translator=translator,
+                                              namespaces=namespaces_dict)
+        )
+
+    def exists(self, selector, namespaces_dict, translator):
+        """
+        Like get(), but the compiled XPath returns True if at least one
+        element matches the selector and False otherwise (see existence_xpath()).
+        As with get(), the XPath of a selector calling extension functions
+        is compiled again for every document (see FreshXPath).
+        """
+        return self._compiled_xpath(
+            selector, namespaces_dict, translator, 'exists',
+            lambda css: etree.XPath(existence_xpath(css, translator),
+                                    namespaces=namespaces_dict)
+        )
+
+    def _compiled_xpath(self, selector, namespaces_dict, translator, kind, compile_xpath):
+        key = (selector.strip(), namespaces_key(namespaces_dict), translator, kind)
+        try:
+            compiled = self._compiled[key]
+        except KeyError:
+            self.misses += 1
+            try:
+                compiled = compile_xpath(key[0])
+            except SelectorError as E:
+                compiled = E
+            else:
+                if EXTENSION_PREFIX in compiled.path:
+                    compiled = FreshXPath(compiled.path, namespaces_dict)
+            self._compiled[key] = compiled
+        else:
+            self.hits += 1
+        if isinstance(compiled, SelectorError):
+            raise compiled.with_traceback(None)
+        return compiled
+
+    def parse(self, selector):
+        """
+        Returns the cssselect.Selector object parsed from selector's text,
+        or None if cssselect can't parse it.
+        """
+        selector = selector.strip()
+        try:
+            return self._parsed[selector]
+        except KeyError:
+            try:
+                parsed = cssselect_parser.parse(selector)[0]
+            except (SelectorError, IndexError):
+                parsed = None
+            self._parsed[selector] = parsed
+            return parsed
+
+    def native(self, selector, namespaces_dict):
+        """
+        Returns the NativeSelector compiled from selector, or None if
+        the native matcher doesn't support it (or cssselect can't parse it).
+        """
+        key = (selector.strip(), namespaces_key(namespaces_dict))
+        try:
+            return self._native[key]
+        except KeyError:
+            parsed = self.parse(selector)
+            try:
+                native = None if parsed is None else NativeSelector(parsed, namespaces_dict)
+            except UnsupportedSelector:
+                native = None
+            self._native[key] = native
+            return native
+
+    def native_count(self):
+        """
+        Number of the selectors compiled by the native matcher.
+        """
+        return sum(1 for native in self._native.values() if native is not None)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, len(self._compiled))
+
+    def clear(self):
+        self._compiled.clear()
+        self._parsed.clear()
+        self._native.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Cache shared by every selector_exists() call that doesn't provide its own.
+compiled_selectors = CompiledSelectorCache()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Positions of the style rules and of their selectors in the text of a
+stylesheet, to delete selectors by editing only the text around them
+instead of serializing the whole parsed stylesheet again, and to find
+the selectors to search without parsing the declarations.
+"""
+
+
+from collections import namedtuple
+import re
+
+
+# start and end of the rule (from its first selector to its closing
+# brace) and the list of the (start, end) of its selectors
+RuleSpan = namedtuple('RuleSpan', ['start', 'end', 'selectors'])
+
+# start and end of an @media rule, start and end of its block (without the
+# braces) and the indexes of the style rules and @media rules right inside it
+GroupSpan = namedtuple('GroupSpan', ['start', 'end', 'body_start', 'body_end', 'rules', 'groups'])
+
+WHITESPACE = ' \t\r\n\f'
+
+# @rules parsed by cssutils: the others are kept as unknown rules
+KNOWN_AT_RULES = {'charset', 'import', 'namespace', 'media', 'page', 'font-face', 'variables'}
+
+_PRELUDE_CHARS = re.compile(r'[\\"\'()\[\]{};,]|/\*')
+_BLOCK_CHARS = re.compile(r'[\\"\'{}]|/\*')
+_COMMENT = re.compile(r'/\*.*?(?:\*/|$)', re.S)
+_ESCAPE = re.compile(r'\\(?:([0-9a-fA-F]{1,6})[ \t\r\n\f]?|(.))', re.S)
+_PSEUDO = re.compile(r'::?[\w-]+')
+_SPACE_AROUND = re.compile(r' ?([~^$*|]?=|[>+~(),\[\]]) ?')
+_NAMESPACE = re.compile(
+    r'\s*(?:([^\s\'"]+)\s+)?(?:url\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^)\s]*))\s*\)|"([^"]*)"|\'([^\']*)\')\s*$',
+    re.IGNORECASE
+)
+
+
+class ScannedStylesheet:
+    """
+    What the analysis needs to know about a stylesheet, found by scanning
+    its text: the style rules (RuleSpan objects, see style_rule_spans()),
+    the @media rules (GroupSpan objects), the namespaces ({prefix: uri}, like CSSStyleSheet.namespaces) and the
+    unknown @rules at top level (as (atkeyword, line)).
+    """
+
+    def __init__(self, text, rules, namespaces, unknown_rules, groups=()):
+        self.text = text
+        self.rules = rules
+        self.groups = groups
+        self.namespaces = namespaces
+        self.unknown_rules = unknown_rules
+
+    def selector_texts(self, rule):
+        return [self.text[start:end] for start, end in rule.selectors]
+
+
+class _Scanner:
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+        self.spans = []
+        self.groups = []
+        # Indexes of the rules and groups found in the @media rules being scanned
+        self._open_groups = []
+        self.namespace_rules = []
+        self.unknown_rules = []
+
+    def skip_comment(self, pos):
+        end = self.text.find('*/', pos + 2)
+        return self.length if end == -1 else end + 2
+
+    def skip_string(self, pos):
+        quote = self.text[pos]
+        pos += 1
+        while pos < self.length:
+            char = self.text[pos]
+            if char == '\\':
+                pos += 2
+            elif char == quote or char == '\n':
+                return pos + 1
+            else:
+                pos += 1
+        return pos
+
+    def skip_space(self, pos):
+        text = self.text
+        while pos < self.length:
+            if text[pos] in WHITESPACE:
+                pos += 1
+            elif text.startswith('/*', pos):
+                pos = self.skip_comment(pos)
+            elif text.startswith('<!--', pos):
+                pos += 4
+            elif text.startswith('-->', pos):
+                pos += 3
+            else:
+                break
+        return pos
+
+    def find_prelude_end(self, pos, stop_chars):
+        """
+        Returns the position of the first character in stop_chars outside
+        comments, strings and brackets, and the positions of the commas
+        outside brackets met before it.
+        """
+        text = self.text
+        depth = 0
+        commas = []
+        search = _PRELUDE_CHARS.search
+        while True:
+            match = search(text, pos)
+            if match is None:
+                return self.length, commas
+            pos = match.start()
+            char = text[pos]
+            if char == '\\':
+                pos += 2
+                continue
+            if char in '"\'':
+                pos = self.skip_string(pos)
+                continue
+            if char == '/':
+                pos = self.skip_comment(pos)
+                continue
+            if char in '([':
+                depth += 1
+            elif char in ')]':
+                depth = max(depth - 1, 0)
+            elif depth == 0:
+                if char in stop_chars:
+                    return pos, commas
+                if char == ',':
+                    commas.append(pos)
+            pos += 1
+
+    def skip_block(self, pos):
+        """
+        pos is the position of an opening brace: returns the position
+        after the matching closing brace.
+        """
+        text = self.text
+        depth = 0
+        search = _BLOCK_CHARS.search
+        while True:
+            match = search(text, pos)
+            if match is None:
+                return self.length
+            pos = match.start()
+            char = text[pos]
+            if char == '\\':
+                pos += 2
+                continue
+            if char in '"\'':
+                pos = self.skip_string(pos)
+                continue
+            if char == '/':
+                pos = self.skip_comment(pos)
+                continue
+            if char == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos += 1
+
+    def trim(self, start, end):
+        """
+        start and end of text[start:end] without the surrounding whitespace.
+        """
+        while start < end and self.text[start] in WHITESPACE:
+            start += 1
+        while end > start and self.text[end - 1] in WHITESPACE:
+            end -= 1
+        return start, end
+
+    def scan_rules(self, pos, top_level=True):
+        """
+        Scans the rules up to the end of the text or to the closing brace
+        of the block containing them. Returns the position after it.
+        """
+        text = self.text
+        while True:
+            pos = self.skip_space(pos)
+            if pos >= self.length:
+                return pos
+            if text[pos] == '}':
+                return pos + 1
+            if text[pos] == '@':
+                pos = self.scan_at_rule(pos, top_level)
+                continue
+            brace, commas = self.find_prelude_end(pos, '{}')
+            if brace >= self.length or text[brace] == '}':
+                # Not a rule: cssutils would have refused the stylesheet
+                return brace + 1
+            bounds = [pos, *commas, brace]
+            selectors = [self.trim(bounds[0], bounds[1])]
+            selectors.extend(self.trim(start + 1, end) for start, end in zip(bounds[1:-1], bounds[2:]))
+            end = self.skip_block(brace)
+            if self._open_groups:
+                self._open_groups[-1][0].append(len(self.spans))
+            self.spans.append(RuleSpan(pos, end, selectors))
+            pos = end
+
+    def scan_at_rule(self, pos, top_level):
+        text = self.text
+        name_end = pos + 1
+        while name_end < self.length and (text[name_end].isalnum() or text[name_end] in '-_'):
+            name_end += 1
+        name = text[pos + 1:name_end].lower()
+        if top_level and name not in KNOWN_AT_RULES:
+            self.unknown_rules.append((text[pos:name_end], text.count('\n', 0, pos) + 1))
+        stop, _ = self.find_prelude_end(name_end, ';{}')
+        if name == 'namespace' and stop < self.length and text[stop] == ';':
+            match = _NAMESPACE.match(text, name_end, stop)
+            if match:
+                uri = next(group for group in match.groups()[1:] if group is not None)
+                self.namespace_rules.append((match.group(1) or '', uri))
+        if stop >= self.length or text[stop] == ';':
+            return stop + 1
+        if text[stop] == '}':
+            return stop
+        if name == 'media':
+            # Style rules inside @media rules are found by analysis.style_rules(), too
+            self._open_groups.append(([], []))
+            end = self.scan_rules(stop + 1, top_level=False)
+            rules, groups = self._open_groups.pop()
+            if self._open_groups:
+                self._open_groups[-1][1].append(len(self.groups))
+            body_end = end - 1 if text[end - 1:end] == '}' else end
+            self.groups.append(GroupSpan(pos, end, stop + 1, body_end, rules, groups))
+            return end
+        return self.skip_block(stop)
+
+    def namespaces(self):
+        # As CSSStyleSheet.namespaces: the last rule of every uri wins
+        namespaces = {}
+        for prefix, uri in reversed(self.namespace_rules):
+            if uri not in namespaces.values():
+                namespaces[prefix] = uri
+        return namespaces
+
+
+def style_rule_spans(css_string):
+    """
+    Returns a RuleSpan for every style rule of css_string (at top level or
+    inside @media rules), in the same order of analysis.style_rules().
+    """
+    scanner = _Scanner(css_string)
+    scanner.scan_rules(0)
+    return scanner.spans
+
+
+def scan_stylesheet(css_string):
+    """
+    Returns the ScannedStylesheet of css_string.
+    """
+    scanner = _Scanner(css_string)
+    scanner.scan_rules(0)
+    return ScannedStylesheet(css_string, scanner.spans, scanner.namespaces(), scanner.unknown_rules,
+                             scanner.groups)
+
+
+def _unescape(match):
+    if match.group(1) is None:
+        return match.group(2)
+    code = int(match.group(1), 16)
+    return chr(code) if 0 < code <= 0x10FFFF else '\uFFFD'
+
+
+def _selector_key(selector_text):
+    """
+    selector_text with the differences between the text in the stylesheet
+    and the one serialized by cssutils (comments, escapes, quotes, case of
+    the pseudo-classes, whitespace) smoothed out.
+    """
+    text = _COMMENT.sub(' ', selector_text)
+    text = _ESCAPE.sub(_unescape, text)
+    text = _PSEUDO.sub(lambda m: m.group().lower(), text.replace("'", '"'))
+    text = ' '.join(text.split())
+    return _SPACE_AROUND.sub(r'\1', text)
+
+
+def spans_match(css_string, spans, rules):
+    """
+    True if spans (from style_rule_spans(css_string)) describe the parsed
+    style rules in rules (from analysis.style_rules()): the same number of
+    rules, each with the same selectors.
+    """
+    rules = list(rules)
+    if len(spans) != len(rules):
+        return False
+    for span, rule in zip(spans, rules):
+        if len(span.selectors) != len(rule.selectorList):
+            return False
+        for (start, end), selector in zip(span.selectors, rule.selectorList):
+            if _selector_key(css_string[start:end]) != _selector_key(selector.selectorText):
+                return False
+    return True
+
+
+def _line_bounds(text, start, end):
+    """
+    Extends [start, end) to the whole lines containing it, if there is
+    only whitespace around it on those lines.
+    """
+    line_start = start
+    while line_start > 0 and text[line_start - 1] in ' \t':
+        line_start -= 1
+    if line_start > 0 and text[line_start - 1] not in '\r\n':
+        return start, end
+    line_end = end
+    while line_end < len(text) and text[line_end] in ' \t':
+        line_end += 1
+    if line_end < len(text) and text[line_end] not in '\r\n':
+        return start, end
+    if text.startswith('\r\n', line_end):
+        return line_start, line_end + 2
+    return line_start, min(line_end + 1, len(text))
+
+
+def _emptied_groups(css_string, spans, groups, removed_rules):
+    """
+    The indexes of the groups left with nothing but whitespace once the
+    rules in removed_rules are removed (those with comments or other
+    @rules are kept, as cssutils does).
+    """
+    emptied = set()
+    # Nested groups come before the groups containing them
+    for group_index, group in enumerate(groups):
+        if not (all(rule_index in removed_rules for rule_index in group.rules)
+                and all(nested in emptied for nested in group.groups)):
+            continue
+        if not group.rules and not group.groups:
+            # Empty already: not our business
+            continue
+        items = sorted([(spans[i].start, spans[i].end) for i in group.rules]
+                       + [(groups[i].start, groups[i].end) for i in group.groups])
+        pos = group.body_start
+        rest = []
+        for start, end in items:
+            rest.append(css_string[pos:start])
+            pos = end
+        rest.append(css_string[pos:group.body_end])
+        if not ''.join(rest).strip(WHITESPACE):
+            emptied.add(group_index)
+    return emptied
+
+
+def remove_selectors(css_string, spans, removals, groups=()):
+    """
+    Returns css_string without the selectors in removals, a dictionary
+    {index of the rule in spans: set of indexes of its selectors}. Rules
+    left without selectors are removed (with their lines, if nothing else
+    is on them), as well as the @media rules in groups (see
+    scan_stylesheet()) left without rules; the rest of the text is left
+    untouched.
+    """
+    removed_rules = {
+        rule_index for rule_index, indexes in removals.items()
+        if all(i in indexes for i in range(len(spans[rule_index].selectors)))
+    }
+    emptied = _emptied_groups(css_string, spans, groups, removed_rules)
+    # (start, end) of the emptied groups not inside other emptied groups
+    cut = []
+    for group_index in sorted(emptied, key=lambda i: groups[i].start):
+        group = groups[group_index]
+        if not cut or group.start >= cut[-1][1]:
+            cut.append((group.start, group.end))
+    edits = [_line_bounds(css_string, start, end) + ('',) for start, end in cut]
+    for rule_index in removals:
+        span = spans[rule_index]
+        if any(start <= span.start < end for start, end in cut):
+            continue
+        if rule_index in removed_rules:
+            edits.append(_line_bounds(css_string, span.start, span.end) + ('',))
+            continue
+        selectors = span.selectors
+        kept = [i for i in range(len(selectors)) if i not in removals[rule_index]]
+        pieces = []
+        for n, i in enumerate(kept):
+            if n:
+                # The separator that came before the kept selector
+                pieces.append(css_string[selectors[i - 1][1]:selectors[i][0]])
+            pieces.append(css_string[selectors[i][0]:selectors[i][1]])
+        edits.append((span.start, selectors[-1][1], ''.join(pieces)))
+    pieces = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(css_string[pos:start])
+        pieces.append(replacement)
+        pos = end
+    pieces.append(css_string[pos:])
+    return ''.join(pieces)
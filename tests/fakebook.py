@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+class FakeBook:
+    """
+    Minimal stand-in for Sigil's BookContainer: files are kept in memory
+    as {id: (href, mime, text)} and every readfile() call is counted.
+    """
+
+    def __init__(self, files):
+        self.files = OrderedDict(files)
+        self.reads = {}
+        self.written = {}
+
+    def css_iter(self):
+        for file_id, (href, mime, text) in self.files.items():
+            if mime == 'text/css':
+                yield file_id, href
+
+    def manifest_iter(self):
+        for file_id, (href, mime, text) in self.files.items():
+            yield file_id, href, mime
+
+    def readfile(self, file_id):
+        self.reads[file_id] = self.reads.get(file_id, 0) + 1
+        return self.files[file_id][2]
+
+    def writefile(self, file_id, data):
+        self.written[file_id] = data
+
+    def id_to_href(self, file_id):
+        return self.files[file_id][0]
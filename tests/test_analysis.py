@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import gc
+import unittest
+import weakref
+
+from lxml import etree
+
+try:
+    import css_parser as cssutils
+except ModuleNotFoundError:
+    import cssutils
+
+import analysis as a
+from featureindex import FeatureIndex
+from linkgraph import StylesheetScopes
+from tests.fakebook import FakeBook
+
+
+CSS = '''@namespace svg "http://www.w3.org/2000/svg";
+p.first, p.second, p.unused { }
+@media print { div > p { } span.unused { } }
+svg|text, svg|circle { }
+a:hover { }
+'''
+
+CHAPTER = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{0}</title></head>
+<body>{1}</body></html>'''
+
+
+LINKED_CHAPTER = '''<?xml version="1.0" encoding="utf-8"?>{0}
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Linked</title>{1}</head>
+<body>{2}</body></html>'''
+
+
+def parse_stylesheets(**stylesheets):
+    css_to_parse = OrderedDict()
+    for css_id, css_string in stylesheets.items():
+        parsed = cssutils.CSSParser(raiseExceptions=True, validate=False).parseString(css_string)
+        namespaces_dict, default_prefix = a.css_namespaces(parsed)
+        css_to_parse[css_id] = {
+            'stylesheet': parsed,
+            'namespaces': namespaces_dict,
+            'default_prefix': default_prefix,
+        }
+    return css_to_parse
+
+
+def orphaned_texts(orphaned_selectors):
+    return [occurrence[2].selectorText for occurrence in orphaned_selectors]
+
+
+class TestAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.bk = FakeBook([
+            ('text1', ('Text/c1.xhtml', 'application/xhtml+xml',
+                       CHAPTER.format('1', '<p class="first"/><div><p class="second"/></div>'))),
+            ('text2', ('Text/c2.xhtml', 'application/xhtml+xml',
+                       CHAPTER.format('2', '<svg xmlns="http://www.w3.org/2000/svg"><text/></svg>'))),
+            ('text3', ('Text/c3.xhtml', 'application/xhtml+xml', CHAPTER.format('3', '<p/>'))),
+        ])
+
+    def test_collect_selectors(self):
+        css_to_parse = parse_stylesheets(css1=CSS)
+        selectors = [s[1] for s in a.collect_selectors(css_to_parse)]
+        self.assertEqual(selectors, ['p.first', 'p.second', 'p.unused', 'div > p',
+                                     'span.unused', 'svg|text', 'svg|circle'])
+        occurrence = next(a.collect_selectors(css_to_parse))[0]
+        self.assertEqual(occurrence[0], 'css1')
+        self.assertIs(occurrence[2], occurrence[1].selectorList[occurrence[3]])
+
+    def test_distinct_queries(self):
+        css_to_parse = parse_stylesheets(
+            css1=CSS, css2='@namespace svg "http://www.w3.org/2000/svg";\n'
+                           'p.unused, svg|text { } @media amzn-kf8 { p.unused { } }',
+            css3='@namespace svg "http://www.w3.org/2000/svg2";\nsvg|text { }'
+        )
+        selectors = list(a.collect_selectors(css_to_parse))
+        queries, query_of = a.distinct_queries(selectors)
+        self.assertEqual(len(selectors), 11)
+        self.assertEqual(len(queries), 8)
+        self.assertEqual(query_of[7:], [2, 5, 2, 7])
+        orphaned = a.find_orphaned_selectors(css_to_parse, a.iter_markup(self.bk, lazy=True))
+        self.assertEqual([(o[0], o[2].selectorText) for o in orphaned], [
+            ('css1', 'p.unused'), ('css1', 'span.unused'), ('css1', 'svg|circle'),
+            ('css2', 'p.unused'), ('css2', 'p.unused'), ('css3', 'svg|text'),
+        ])
+
+    def test_modes(self):
+        expected = ['p.unused', 'span.unused', 'svg|circle']
+        for mode in ('selectors', 'documents'):
+            with self.subTest(mode=mode):
+                documents = a.iter_markup(self.bk, lazy=True)
+                orphaned = a.find_orphaned_selectors(parse_stylesheets(css1=CSS), documents, mode)
+                self.assertEqual(orphaned_texts(orphaned), expected)
+
+    def test_match_by_document_stops_early(self):
+        queries = [('p.first', {}), ('div > p', {})]
+        documents = a.iter_markup(self.bk, lazy=True)
+        self.assertEqual(a.match_by_document(queries, documents), {0, 1})
+        self.assertEqual(self.bk.reads, {'text1': 1})
+
+    def test_streaming(self):
+        seen = []
+        def documents():
+            for document in a.iter_markup(self.bk, lazy=True):
+                # No more than a batch of documents is alive at the same time
+                self.assertLessEqual(len([d for d in seen if d._data is not None]), 2)
+                seen.append(document)
+                yield document
+        orphaned = a.find_orphaned_selectors(parse_stylesheets(css1=CSS), documents(),
+                                             'streaming', batch_size=2)
+        self.assertEqual(orphaned_texts(orphaned), ['p.unused', 'span.unused', 'svg|circle'])
+        self.assertEqual(len(seen), 3)
+        self.assertEqual([d for d in seen if d._data is not None], [])
+
+    def test_streaming_keeps_no_document(self):
+        # With the default analysis options, nothing holds a document after its batch
+        alive = []
+        def documents():
+            for document in a.iter_markup(self.bk, lazy=True):
+                alive.append(weakref.ref(document))
+                yield document
+                gc.collect()
+                self.assertLessEqual(len([ref for ref in alive if ref() is not None]), 2)
+        matcher = a.SelectorMatcher(index=FeatureIndex(), use_rule_hash=True)
+        orphaned = a.find_orphaned_selectors(parse_stylesheets(css1=CSS), documents(),
+                                             'streaming', matcher, batch_size=1)
+        self.assertEqual(orphaned_texts(orphaned), ['p.unused', 'span.unused', 'svg|circle'])
+        self.assertIsNone(matcher.index.book)
+
+    def test_progress_and_cancel(self):
+        done = []
+        documents = a.monitor_documents(a.iter_markup(self.bk, lazy=True),
+                                        lambda n, total: done.append((n, total)), total=3)
+        a.find_orphaned_selectors(parse_stylesheets(css1=CSS), documents, 'documents')
+        self.assertEqual(done, [(1, 3), (2, 3), (3, 3)])
+        for mode in ('selectors', 'documents'):
+            with self.subTest(mode=mode):
+                searches = []
+                def cancelled():
+                    searches.append(None)
+                    return len(searches) > 3
+                matcher = a.SelectorMatcher(cancelled=cancelled)
+                with self.assertRaises(a.AnalysisCancelled):
+                    a.find_orphaned_selectors(parse_stylesheets(css1=CSS),
+                                              a.iter_markup(self.bk, lazy=True), mode, matcher)
+                self.assertEqual(len(searches), 4)
+
+    def test_progress_while_matching(self):
+        for mode in ('selectors', 'parallel'):
+            with self.subTest(mode=mode):
+                events = []
+                def cancelled():
+                    events.append('search')
+                    return False
+                matcher = a.SelectorMatcher(cancelled=cancelled)
+                a.find_orphaned_selectors(parse_stylesheets(css1=CSS),
+                                          a.iter_markup(self.bk, lazy=True), mode, matcher,
+                                          workers=1, progress=lambda n, total: events.append((n, total)))
+                progress = [event for event in events if event != 'search']
+                # 7 distinct selectors in 'selectors' mode, 3 documents in 'parallel' mode
+                total = 7 if mode == 'selectors' else 3
+                self.assertEqual(progress, [(n, total) for n in range(1, total + 1)])
+                # Full only after the last search, and not before the first one
+                self.assertEqual(events[-1], (total, total))
+                self.assertEqual(events[0], 'search')
+        # With worker processes, the documents of a shard are done when the shard is
+        progress = []
+        a.find_orphaned_selectors(parse_stylesheets(css1=CSS), a.iter_markup(self.bk, lazy=True),
+                                  'parallel', workers=2,
+                                  progress=lambda n, total: progress.append((n, total)))
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(progress[-1], (3, 3))
+
+    def test_parallel(self):
+        self.bk.files['svg1'] = ('Images/a.svg', 'image/svg+xml',
+                                 '<svg xmlns="http://www.w3.org/2000/svg"><circle/></svg>')
+        for parse_all_xml_files in (False, True):
+            with self.subTest(parse_all_xml_files=parse_all_xml_files):
+                serial = a.find_orphaned_selectors(
+                    parse_stylesheets(css1=CSS),
+                    a.iter_markup(self.bk, parse_all_xml_files, lazy=True), 'documents')
+                matcher = a.SelectorMatcher(use_rule_hash=True)
+                parallel = a.find_orphaned_selectors(
+                    parse_stylesheets(css1=CSS),
+                    a.iter_markup(self.bk, parse_all_xml_files, lazy=True), 'parallel',
+                    matcher, workers=2)
+                self.assertEqual(orphaned_texts(parallel), orphaned_texts(serial))
+                self.assertIn('searches avoided by rule hash', matcher.statistics())
+        self.assertEqual(orphaned_texts(parallel), ['p.unused', 'span.unused'])
+
+    def test_scoped(self):
+        bk = FakeBook([
+            ('text1', ('Text/c1.xhtml', 'application/xhtml+xml', LINKED_CHAPTER.format(
+                '', '<link rel="Stylesheet" type="text/css" href="../Styles/a.css#x"/>',
+                '<p class="first imported"/>'))),
+            ('text2', ('Text/c2.xhtml', 'application/xhtml+xml', LINKED_CHAPTER.format(
+                '<?xml-stylesheet href="../Styles/c%2Ecss" type="text/css"?>',
+                '<style>@import url("../Styles/a.css");</style>', '<p class="shared"/>'))),
+            ('text3', ('Text/c3.xhtml', 'application/xhtml+xml', LINKED_CHAPTER.format(
+                '', '<link rel="alternate" href="../Styles/c.css"/>', '<p class="nowhere"/>'))),
+        ])
+        stylesheets = {
+            'css1': ('Styles/a.css', '@import "b.css";\np.first, p.shared { }'),
+            'css2': ('Styles/b.css', '.imported { }'),
+            'css3': ('Styles/c.css', 'p.first, p.shared { } .nowhere { }'),
+        }
+        scopes = StylesheetScopes(stylesheets)
+        self.assertEqual([scopes.loaded_by(document) for document in a.iter_markup(bk, lazy=True)],
+                         [{'css1', 'css2'}, {'css1', 'css2', 'css3'}, set()])
+        css_to_parse = parse_stylesheets(**{css_id: text for css_id, (href, text) in stylesheets.items()})
+        documents = list(a.iter_markup(bk, lazy=True))
+        unscoped = a.find_orphaned_selectors(css_to_parse, documents)
+        self.assertEqual(orphaned_texts(unscoped), [])
+        # Links are looked for only by scoped searches
+        self.assertEqual([d._stylesheet_links for d in documents], [None, None, None])
+        for mode in ('selectors', 'documents', 'parallel'):
+            with self.subTest(mode=mode):
+                matcher = a.SelectorMatcher(use_rule_hash=True, scopes=scopes)
+                orphaned = a.find_orphaned_selectors(css_to_parse, a.iter_markup(bk, lazy=True),
+                                                     mode, matcher, workers=2)
+                self.assertEqual([(o[0], o[2].selectorText) for o in orphaned],
+                                 [('css3', 'p.first'), ('css3', '.nowhere')])
+                self.assertIn('searches avoided by scope', matcher.statistics())
+        # Eager documents free their raw data: their links are found before
+        matcher = a.SelectorMatcher(scopes=scopes)
+        orphaned = a.find_orphaned_selectors(
+            css_to_parse, a.iter_markup(bk, precompute=('stylesheet_links',)), matcher=matcher)
+        self.assertEqual(orphaned_texts(orphaned), ['p.first', '.nowhere'])
+
+    def test_contains_in_released_documents(self):
+        # Every document is freed before the selectors are searched in the next one
+        bk = FakeBook([
+            ('text{}'.format(i), ('Text/c{}.xhtml'.format(i), 'application/xhtml+xml',
+                                  CHAPTER.format(i, '<p>Chapter {}</p>'.format(i))))
+            for i in range(30)
+        ])
+        css_to_parse = parse_stylesheets(css1='p:contains("chapter 29") { } p:contains("missing") { }')
+        for native in (True, False):
+            for mode in ('documents', 'streaming'):
+                with self.subTest(native=native, mode=mode):
+                    orphaned = a.find_orphaned_selectors(
+                        css_to_parse, a.iter_markup(bk), mode, a.SelectorMatcher(native=native))
+                    self.assertEqual(orphaned_texts(orphaned), ['p:contains("missing")'])
+
+    def test_shard_documents(self):
+        documents = list(a.iter_markup(self.bk, lazy=True))
+        shards = a.shard_documents(documents, 2)
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(sorted(d[0] for shard in shards for d in shard), ['text1', 'text2', 'text3'])
+        self.assertEqual(len(a.shard_documents(documents[:1], 2)), 1)
+
+    def test_parallel_malformed_markup(self):
+        self.bk.files['bad'] = ('Text/bad.xhtml', 'application/xhtml+xml', '<html><p></html>')
+        with self.assertRaises(etree.XMLSyntaxError) as cm:
+            a.find_orphaned_selectors(parse_stylesheets(css1=CSS), a.iter_markup(self.bk, lazy=True),
+                                      'parallel', workers=2)
+        self.assertEqual(cm.exception.href, 'Text/bad.xhtml')
+
+    def test_parallel_empty_markup(self):
+        self.bk.files['empty'] = ('Text/empty.xhtml', 'application/xhtml+xml', '<!-- nothing -->')
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                with self.assertRaises(etree.XMLSyntaxError) as cm:
+                    a.find_orphaned_selectors(parse_stylesheets(css1=CSS),
+                                              a.iter_markup(self.bk, lazy=True),
+                                              'parallel', workers=workers)
+                self.assertEqual(cm.exception.href, 'Text/empty.xhtml')
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+import cli
+
+
+CONTAINER = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = '''<?xml version="1.0" encoding="utf-8"?>
+<package version="3.0" unique-identifier="uid" xmlns="http://www.idpf.org/2007/opf">
+  <manifest>
+    <item id="c1" href="Text/c1.xhtml" media-type="application/xhtml+xml"/>
+    <item id="c2" href="Text/chapter%202.xhtml" media-type="application/xhtml+xml"/>
+    <item id="css" href="Styles/style.css" media-type="text/css"/>
+  </manifest>
+  <spine><itemref idref="c1"/><itemref idref="c2"/></spine>
+</package>'''
+
+CHAPTER = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Chapter</title></head>
+<body>{}</body>
+</html>'''
+
+CSS = '''p.used, p.unused {
+    color: red
+    }
+.gone {
+    color: blue
+    }
+'''
+
+FILES = {
+    'mimetype': 'application/epub+zip',
+    'META-INF/container.xml': CONTAINER,
+    'OEBPS/content.opf': OPF,
+    'OEBPS/Text/c1.xhtml': CHAPTER.format('<p class="used">1</p>'),
+    'OEBPS/Text/chapter 2.xhtml': CHAPTER.format('<div>2</div>'),
+    'OEBPS/Styles/style.css': CSS,
+}
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.unpacked = os.path.join(self.directory, 'book')
+        for name, text in FILES.items():
+            path = os.path.join(self.unpacked, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        self.epub = os.path.join(self.directory, 'book.epub')
+        with zipfile.ZipFile(self.epub, 'w', zipfile.ZIP_DEFLATED) as epub:
+            for name, text in FILES.items():
+                epub.writestr(name, text)
+
+    def run_cli(self, *args):
+        return cli.main(list(args))
+
+    def css_in_directory(self, root):
+        with open(os.path.join(root, 'OEBPS', 'Styles', 'style.css'), encoding='utf-8') as f:
+            return f.read()
+
+    def test_book_api(self):
+        book = cli.open_book(self.epub)
+        self.assertEqual(list(book.css_iter()), [('css', 'Styles/style.css')])
+        self.assertEqual(book.id_to_href('c2'), 'Text/chapter 2.xhtml')
+        self.assertEqual(book.readfile('c2'), FILES['OEBPS/Text/chapter 2.xhtml'])
+        book.close()
+
+    def test_directory(self):
+        self.assertEqual(self.run_cli(self.unpacked), 0)
+        css = self.css_in_directory(self.unpacked)
+        self.assertIn('p.used', css)
+        self.assertNotIn('p.unused', css)
+        self.assertNotIn('.gone', css)
+
+    def test_epub(self):
+        self.assertEqual(self.run_cli(self.epub), 0)
+        with zipfile.ZipFile(self.epub) as epub:
+            infos = epub.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(sorted(epub.namelist()), sorted(FILES))
+            css = epub.read('OEBPS/Styles/style.css').decode('utf-8')
+            self.assertEqual(epub.read('OEBPS/Text/c1.xhtml').decode('utf-8'),
+                             FILES['OEBPS/Text/c1.xhtml'])
+        self.assertIn('p.used', css)
+        self.assertNotIn('p.unused', css)
+
+    def test_dry_run_and_output(self):
+        self.assertEqual(self.run_cli('--dry-run', self.epub, self.unpacked), 0)
+        self.assertEqual(self.css_in_directory(self.unpacked), CSS)
+        output = os.path.join(self.directory, 'copy')
+        self.assertEqual(self.run_cli('-o', output, self.unpacked), 0)
+        self.assertEqual(self.css_in_directory(self.unpacked), CSS)
+        self.assertNotIn('p.unused', self.css_in_directory(output))
+
+    def test_prefs(self):
+        prefs_path = os.path.join(self.directory, 'prefs.json')
+        with open(prefs_path, 'w', encoding='utf-8') as f:
+            json.dump({'analysisMode': 'documents', 'verdictCache': True}, f)
+        self.assertEqual(self.run_cli('--prefs', prefs_path, self.unpacked), 0)
+        self.assertNotIn('p.unused', self.css_in_directory(self.unpacked))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'verdicts.sqlite')))
+
+    def test_scan_only_not_parsed(self):
+        css = CSS.replace('color: blue', 'color: blue !importan')
+        with open(os.path.join(self.unpacked, 'OEBPS', 'Styles', 'style.css'), 'w', encoding='utf-8') as f:
+            f.write(css)
+        summary, lines = cli.book_summary(self.unpacked, cli.Prefs({'scanOnlyCss': True}))
+        # The unused selectors are found, but the stylesheet can't be changed
+        self.assertEqual((summary['unused'], summary['removed'], summary['bytes_saved']), (2, 0, 0))
+        self.assertEqual(self.css_in_directory(self.unpacked), css)
+        self.assertIn('Styles/style.css: not changed', '\n'.join(lines))
+        self.assertFalse(any(line.startswith('Compiled selectors') for line in lines))
+        summary, lines = cli.book_summary(self.unpacked, cli.Prefs({'printStatistics': True}), True)
+        self.assertIn('Compiled selectors', '\n'.join(lines))
+
+    def test_malformed_markup(self):
+        with open(os.path.join(self.unpacked, 'OEBPS', 'Text', 'c1.xhtml'), 'a', encoding='utf-8') as f:
+            f.write('<p>')
+        self.assertEqual(self.run_cli(self.unpacked), 1)
+        self.assertEqual(self.css_in_directory(self.unpacked), CSS)
+
+    def test_batch(self):
+        books = [self.epub, self.unpacked, os.path.join(self.directory, 'missing.epub')]
+        log = os.path.join(self.directory, 'log.jsonl')
+        self.assertEqual(self.run_cli('--jobs', '2', '--log', log, *books), 1)
+        with open(log, encoding='utf-8') as f:
+            summaries = {summary['book']: summary for summary in map(json.loads, f)}
+        self.assertEqual(set(summaries), set(books))
+        for book in books[:2]:
+            self.assertEqual(summaries[book]['status'], 'ok')
+            self.assertEqual(summaries[book]['removed'], 2)
+            self.assertGreater(summaries[book]['bytes_saved'], 0)
+            self.assertIn('seconds', summaries[book])
+        self.assertEqual(summaries[books[2]]['status'], 'error')
+        self.assertNotIn('p.unused', self.css_in_directory(self.unpacked))
+
+    def test_unexpected_error(self):
+        process_book = cli.process_book
+        def fail_on_epub(path, *args):
+            if path == self.epub:
+                raise RuntimeError('unexpected')
+            return process_book(path, *args)
+        with mock.patch('cli.process_book', fail_on_epub):
+            summaries = cli.process_books([self.epub, self.unpacked], cli.Prefs(),
+                                          report=lambda line: None)
+        self.assertEqual([summary['status'] for summary in summaries], ['error', 'ok'])
+        self.assertIn('RuntimeError: unexpected', summaries[0]['error'])
+        self.assertEqual(summaries[1]['removed'], 2)
+
+    def test_shared_caches(self):
+        cli.parsed_stylesheets.clear()
+        summaries = cli.process_books([self.epub, self.unpacked], cli.Prefs(), dry_run=True,
+                                      report=lambda line: None)
+        self.assertEqual([summary['unused'] for summary in summaries], [2, 2])
+        # The stylesheet is the same in both books
+        self.assertEqual((cli.parsed_stylesheets.hits, cli.parsed_stylesheets.misses), (1, 1))
+
+    def test_no_qt(self):
+        code = ('import sys, cli; '
+                'sys.exit(any(name.split(".")[0] in ("PySide6", "PyQt6", "PyQt5", "PySide2")'
+                ' for name in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.run([sys.executable, '-c', code], cwd=root).returncode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
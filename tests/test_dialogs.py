@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+try:
+    from plugin_utils import Qt, QtCore, QtWidgets
+except ImportError:
+    # The bindings of the Qt version in SIGIL_QT_RUNTIME_VERSION
+    raise unittest.SkipTest('Qt bindings not available')
+
+import analysis as a
+from analysis import AnalysisCancelled
+import dialogs
+from tests.fakebook import FakeBook
+from tests.test_analysis import parse_stylesheets
+
+
+class TestRunInBackground(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def test_result(self):
+        threads = []
+        values = []
+        def function(progress, cancelled):
+            threads.append(QtCore.QThread.currentThread())
+            for n in range(1, 4):
+                progress(n, 3)
+                time.sleep(0.05)
+            return 'result'
+        def read_progress():
+            for widget in self.app.topLevelWidgets():
+                if isinstance(widget, QtWidgets.QProgressDialog):
+                    values.append((widget.value(), widget.maximum()))
+        QtCore.QTimer.singleShot(75, read_progress)
+        self.assertEqual(dialogs.run_in_background(function), 'result')
+        self.assertIsNot(threads[0], QtCore.QThread.currentThread())
+        # The total comes from the function, and the dialog isn't full before it returns
+        self.assertEqual(len(values), 1)
+        self.assertEqual(values[0][1], 3)
+        self.assertLess(values[0][0], 3)
+
+    def test_error(self):
+        def function(progress, cancelled):
+            raise ValueError('error')
+        with self.assertRaises(ValueError):
+            dialogs.run_in_background(function)
+
+    def test_cancel(self):
+        def function(progress, cancelled):
+            while not cancelled():
+                time.sleep(0.01)
+            raise AnalysisCancelled()
+        def click_cancel():
+            for widget in self.app.topLevelWidgets():
+                if isinstance(widget, QtWidgets.QProgressDialog):
+                    widget.findChild(QtWidgets.QPushButton).click()
+        QtCore.QTimer.singleShot(700, click_cancel)
+        with self.assertRaises(AnalysisCancelled):
+            dialogs.run_in_background(function)
+
+
+class TestSelectorsDialog(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def test_checked_selectors(self):
+        bk = FakeBook([('css1', ('Styles/style.css', 'text/css', ''))])
+        css = parse_stylesheets(css1='p.a, p.b { color: red }\n.c { color: blue }')
+        occurrences = [occurrence for occurrence, _, _ in a.collect_selectors(css)]
+        dialog = dialogs.SelectorsDialog(bk, occurrences)
+        self.addCleanup(dialog.close)
+        model = dialog.model
+        self.assertEqual([model.index(row).data() for row in range(model.rowCount())],
+                         ['p.a (style.css)', 'p.b (style.css)', '.c (style.css)'])
+        self.assertTrue(model.setData(model.index(1), Qt.Unchecked, Qt.CheckStateRole))
+        dialog.proceed()
+        self.assertFalse(dialogs.SelectorsDialog.stop_plugin)
+        self.assertEqual(
+            [(checked, occurrence[5]) for occurrence, checked in dialogs.SelectorsDialog.orphaned_dict.values()],
+            [(True, 'p.a'), (False, 'p.b'), (True, '.c')]
+        )
+
+    def test_no_selectors(self):
+        dialog = dialogs.SelectorsDialog(FakeBook([]), [])
+        self.addCleanup(dialog.close)
+        dialog.proceed()
+        self.assertFalse(dialogs.SelectorsDialog.stop_plugin)
+        self.assertEqual(dialogs.SelectorsDialog.orphaned_dict, {})
+
+    def test_toggle(self):
+        bk = FakeBook([('css1', ('Styles/a.css', 'text/css', '')),
+                       ('css2', ('Styles/b.css', 'text/css', ''))])
+        css = parse_stylesheets(css1='p.a, p.b { color: red }', css2='.c { color: blue }')
+        occurrences = [occurrence for occurrence, _, _ in a.collect_selectors(css)]
+        dialog = dialogs.SelectorsDialog(bk, occurrences)
+        self.addCleanup(dialog.close)
+        changes = []
+        dialog.model.dataChanged.connect(lambda first, last, roles: changes.append((first.row(), last.row())))
+        dialog.toggleAll.setChecked(False)
+        self.assertEqual(dialog.model.checked_rows(), [False, False, False])
+        dialog.toggle_group('css1', True)
+        self.assertEqual(dialog.model.checked_rows(), [True, True, False])
+        # One signal (and one repaint) for each toggle
+        self.assertEqual(changes, [(0, 2), (0, 1)])
+
+
+class TestNotChangedDlg(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def test_message(self):
+        bk = FakeBook([('css1', ('Styles/a.css', 'text/css', '')),
+                       ('css2', ('Styles/b.css', 'text/css', ''))])
+        dialog = dialogs.NotChangedDlg(bk, {'css2': ValueError('bad declaration')})
+        self.addCleanup(dialog.close)
+        text = '\n'.join(label.text() for label in dialog.findChildren(QtWidgets.QLabel))
+        self.assertIn("I couldn't parse b.css due to\nbad declaration", text)
+        self.assertNotIn('a.css', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import analysis as a
+from featureindex import FeatureIndex, RuleHash, key_selector, selector_requirements
+from selectorcache import CompiledSelectorCache
+from tests.fakebook import FakeBook
+from tests.test_analysis import CHAPTER, orphaned_texts, parse_stylesheets
+
+
+CSS = '''@namespace svg "http://www.w3.org/2000/svg";
+p.first, p.missing, .first.second, #id1, #id2, div > p.third
+{ }
+[data-x], [data-y], [lang="en"], [lang="fr"], [lang|="fr"] { }
+.first:not(p), :not(.missing), p::first-line, *:first-of-type, svg|text { }
+[viewBox], [viewbox], .a\\ b, #id1 ~ span, span:first-child { }
+'''
+
+
+class TestFeatureIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CompiledSelectorCache()
+        self.bk = FakeBook([
+            ('text1', ('Text/c1.xhtml', 'application/xhtml+xml', CHAPTER.format(
+                '1', '<p class="first second" id="id1" data-x="1"/><span/>'))),
+            ('text2', ('Text/c2.xhtml', 'application/xhtml+xml', CHAPTER.format(
+                '2', '<div lang="fr"><p class="\tthird"/></div>'
+                     '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1"><text/></svg>'))),
+        ])
+
+    def requirements(self, selector):
+        return selector_requirements(self.cache.parse(selector))
+
+    def test_selector_requirements(self):
+        self.assertEqual(self.requirements('div#id1 > p.a.b[lang="en"] [data-x^="y"]'), (
+            {'div', 'p'}, {'id1'}, {'a', 'b'}, {'lang', 'data-x'}, {('lang', 'en')}
+        ))
+        self.assertEqual(self.requirements('.a:not(p.b) [x!="y"]'),
+                         (set(), set(), {'a'}, set(), set()))
+        for selector in ('svg|text', '[xlink|href]', 'p::first-line', '.a\\ b', '('):
+            with self.subTest(selector=selector):
+                self.assertIsNone(self.requirements(selector))
+
+    def test_features(self):
+        index = FeatureIndex()
+        document = next(a.iter_markup(self.bk))
+        features = index.add(document, 'html')
+        self.assertIs(index.add(document, 'html'), features)
+        self.assertIn('p', features.tags)
+        self.assertIn('{http://www.w3.org/1999/xhtml}p', index.add(document, 'xml').tags)
+        self.assertEqual(features.ids, {'id1'})
+        self.assertEqual(features.classes, {'first', 'second'})
+        self.assertIn(('data-x', '1'), features.attribute_values)
+
+    def test_lazy_trees(self):
+        index = FeatureIndex()
+        documents = list(a.iter_markup(self.bk, lazy=True))
+        # The book can't be indexed without building every tree
+        index.add_book(documents)
+        self.assertIsNone(index.book)
+        self.assertTrue(index.book_may_match('p.missing', {}, self.cache))
+        self.assertFalse(documents[0].has_tree('html'))
+        # Only the trees where the selectors would be searched are indexed
+        matcher = a.SelectorMatcher(self.cache, index, use_rule_hash=True)
+        matcher.prepare([('p.missing', {}), ('p.first', {})])
+        self.assertFalse(matcher.matches(documents[0], 'p.missing', {}, 0))
+        self.assertTrue(matcher.matches(documents[0], 'p.first', {}, 1))
+        self.assertEqual(matcher.rule_hash.avoided, 1)
+        self.assertEqual(list(documents[0].features), ['html'])
+        self.assertFalse(documents[0].has_tree('xml'))
+        index.add_book(a.iter_markup(self.bk))
+        self.assertFalse(index.book_may_match('p.missing', {}, self.cache))
+
+    def test_key_selector(self):
+        keys = {
+            'div > p#a.b': ('ids', 'a'),
+            'div p.b.c:first-child': ('classes', 'b'),
+            '#a p[lang]': ('tags', 'p'),
+            '#a > *': None,
+            'svg|text': None,
+            'p::first-line': None,
+        }
+        for selector, key in keys.items():
+            with self.subTest(selector=selector):
+                self.assertEqual(key_selector(self.cache.parse(selector)), key)
+
+    def test_rule_hash(self):
+        queries = [('p.first', {}), ('#id1', {}), ('span', {}), ('*', {}),
+                   ('p.first:unknown', {}), ('p.none', {})]
+        rule_hash = RuleHash(queries, self.cache)
+        features = FeatureIndex().add(next(a.iter_markup(self.bk)), 'html')
+        # p.first:unknown can't be translated, so it's always kept
+        self.assertEqual(rule_hash.candidates(features), {0, 1, 2, 3, 4})
+
+    def test_same_verdicts(self):
+        results = []
+        for mode in ('selectors', 'documents'):
+            for index in (None, FeatureIndex()):
+                for use_rule_hash in (False, True):
+                    for native in (False, True):
+                        matcher = a.SelectorMatcher(self.cache, index, use_rule_hash, native)
+                        orphaned = a.find_orphaned_selectors(
+                            parse_stylesheets(css1=CSS), a.iter_markup(self.bk), mode, matcher
+                        )
+                        results.append(orphaned_texts(orphaned))
+                        if use_rule_hash:
+                            self.assertGreater(
+                                matcher.statistics()['searches avoided by rule hash'], 0)
+        self.assertEqual(results[0], ['p.missing', '#id2', '[data-y]', '[lang="en"]',
+                                      '.a\\ b', 'span:first-child'])
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
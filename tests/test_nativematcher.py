@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import unittest
+
+try:
+    import css_parser as cssutils
+except ModuleNotFoundError:
+    import cssutils
+from cssselect.xpath import SelectorError
+from lxml import etree
+
+import analysis as a
+from nativematcher import NativeSelector, UnsupportedSelector
+from selectorcache import CompiledSelectorCache
+
+
+NAMESPACES = {'svg': 'http://www.w3.org/2000/svg', 'h': 'http://www.w3.org/1999/xhtml',
+              'xlink': 'http://www.w3.org/1999/xlink'}
+
+DOCUMENT = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
+<head><title>Test</title></head>
+<body class="  main\tbody ">
+  <h1 id="id1" class="class1">Title</h1>
+  <p class="class1 a-b" lang="en-US" data-x="">First <em>para</em><!-- a comment --></p>
+  <p lang="fr" title="Some Title"></p>
+  <p><!-- only a comment --></p>
+  <div id="d"><p class="x">x</p><span/>tail<span title="a b"/></div>
+  <ul><li>1</li><li class="odd">2</li><li>3</li><li class="odd">4</li><li>5</li></ul>
+  <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 1 1">
+    <text class="c" xlink:href="#d">svg</text><circle/><text/>
+  </svg>
+</body>
+</html>'''
+
+SELECTORS = [
+    '*', 'p', 'P', 'html', 'body.main', '.class1', '.a-b', '#id1', '#D', 'h1#id1.class1',
+    '[lang]', '[lang="fr"]', '[lang|="en"]', '[lang^="en"]', '[lang$="US"]', '[lang*="n-U"]',
+    '[title~="Title"]', '[title~="a"]', '[title~=""]', '[data-x=""]', '[data-x^=""]',
+    '[title="some title" i]', '[title="some title"]', '[title!="a b"]', '[viewBox]',
+    'body p', 'body > p', 'div > p', 'h1 + p', 'h1 + div', 'p ~ div', 'p ~ h1', 'div span + span',
+    ':root', 'html:root', 'p:root', ':empty', 'p:empty', 'span:empty', ':first-child', 'li:last-child',
+    'span:only-child', 'title:only-child', 'html:only-child', 'p:first-of-type', 'p:last-of-type',
+    'span:only-of-type', 'li:nth-child(2n)', 'li:nth-child(odd)', 'li:nth-child(-n+2)',
+    'li:nth-last-child(3)', 'li:nth-child(0n+0)', 'li:nth-child(-2n-1)', 'p:nth-of-type(2)',
+    'li:nth-last-of-type(2n+1)', 'p:contains("para")', 'p:contains("FIRST P")', 'p:contains(comment)', 'div:contains(tail)',
+    ':not(p)', 'p:not(.class1)', 'li:not(:first-child):not(:last-child)', ':not(*)',
+    'p:not(div > p)', 'span:not(span + span)', 'li:is(.odd, :first-child)', ':where(h1, em)',
+    'svg|text', 'svg|*', 'svg|text.c', 'svg|svg > svg|circle', '[xlink|href]', 'h|p', 'h|*:empty',
+    '*|text', '*|p.x', 'h|p:not(h|p.x)', 'svg|text:first-of-type', 'svg|text:last-of-type',
+]
+
+UNSUPPORTED = ['p::first-line', 'p:lang(en)', 'a:link', 'input:checked', 'p:has(em)',
+               '[*|href]', ':scope > p', 'undeclared|p', '\\31 23', 'p:nth-child(n of p)']
+
+
+def xpath_matches(cache, tree, selector, translator):
+    return cache.get(selector, NAMESPACES, translator)(tree)
+
+
+def native_matches(tree, native):
+    return [element for element in tree.iter(native.tag) if native.match(element)]
+
+
+def random_document(rnd, elements=60):
+    """
+    Returns the text of a random xhtml document.
+    """
+    tags = ['div', 'p', 'span', 'em', 'li']
+    classes = ['a', 'b', 'c', 'a-b']
+    root = etree.Element('{http://www.w3.org/1999/xhtml}html', nsmap={None: 'http://www.w3.org/1999/xhtml'})
+    body = etree.SubElement(root, '{http://www.w3.org/1999/xhtml}body')
+    parents = [body]
+    for i in range(elements):
+        if rnd.random() < 0.1:
+            tag = '{http://www.w3.org/2000/svg}text'
+        else:
+            tag = '{http://www.w3.org/1999/xhtml}' + rnd.choice(tags)
+        element = etree.SubElement(rnd.choice(parents), tag)
+        if rnd.random() < 0.5:
+            element.set('class', ' '.join(rnd.sample(classes, rnd.randint(1, 2))))
+        if rnd.random() < 0.2:
+            element.set('id', 'i{}'.format(rnd.randint(0, 5)))
+        if rnd.random() < 0.3:
+            element.set('lang', rnd.choice(['en', 'en-GB', 'fr', '']))
+        if rnd.random() < 0.3:
+            element.text = rnd.choice(['', 'word', 'two words'])
+        if rnd.random() < 0.2:
+            element.append(etree.Comment('comment'))
+        parents.append(element)
+    return etree.tostring(root, encoding='unicode')
+
+
+def random_selector(rnd):
+    """
+    Returns a random selector, made with the syntax supported by the native matcher.
+    """
+    def compound():
+        text = rnd.choice(['', '*', 'p', 'div', 'span', 'li', 'svg|text', 'svg|*', '*|em'])
+        for _ in range(rnd.randint(0 if text else 1, 2)):
+            text += rnd.choice([
+                '.a', '.b', '.a-b', '#i1', '#i2', '[lang]', '[lang="en"]', '[lang|="en"]',
+                '[lang^="e"]', '[lang$="GB"]', '[lang*="n"]', '[class~="b"]', '[lang=""]',
+                ':first-child', ':last-child', ':only-child', ':empty', ':root',
+                ':nth-child(2n+1)', ':nth-last-child(-n+3)', ':nth-child(3)',
+                ':not(.a)', ':not(p)', ':not(div > *)', ':is(.b, span)', ':contains("word")',
+            ])
+        return text
+    selector = compound()
+    for _ in range(rnd.randint(0, 2)):
+        selector += rnd.choice([' ', ' > ', ' + ', ' ~ ']) + compound()
+    return selector
+
+
+class TestNativeMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CompiledSelectorCache()
+        data = DOCUMENT.encode('utf-8')
+        self.trees = [etree.HTML(data), etree.XML(data)]
+
+    def assertParity(self, trees, selector):
+        parsed = self.cache.parse(selector)
+        native = NativeSelector(parsed, NAMESPACES)
+        for tree, translator in zip(trees, ('xhtml', 'xml')):
+            with self.subTest(selector=selector, translator=translator):
+                try:
+                    expected = xpath_matches(self.cache, tree, selector, translator)
+                except SelectorError:
+                    # Not translatable by cssselect: nothing to compare with
+                    continue
+                self.assertEqual(native_matches(tree, native), expected)
+                self.assertEqual(native.exists(tree), bool(expected))
+
+    def test_parity(self):
+        for selector in SELECTORS:
+            self.assertParity(self.trees, selector)
+
+    def test_resource_parity(self):
+        css = cssutils.parseFile(os.path.join(os.path.dirname(__file__), 'resources', 'base.css'))
+        for rule in a.style_rules(css):
+            for selector in rule.selectorList:
+                self.assertParity(self.trees, selector.selectorText)
+
+    def test_generated_parity(self):
+        rnd = random.Random(20250101)
+        for _ in range(5):
+            data = random_document(rnd).encode('utf-8')
+            trees = [etree.HTML(data), etree.XML(data)]
+            for _ in range(60):
+                self.assertParity(trees, random_selector(rnd))
+
+    def test_of_type_on_universal(self):
+        # cssselect can't translate these, the native matcher can
+        native = NativeSelector(self.cache.parse('*:first-of-type'))
+        self.assertEqual([e.tag for e in native_matches(self.trees[0], native) if e.tag in ('p', 'div')],
+                         ['p', 'div', 'p'])
+        native = NativeSelector(self.cache.parse('.class1:nth-of-type(2)'))
+        self.assertFalse(native.exists(self.trees[0]))
+
+    def test_unsupported(self):
+        for selector in UNSUPPORTED:
+            with self.subTest(selector=selector):
+                with self.assertRaises(UnsupportedSelector):
+                    parsed = self.cache.parse(selector)
+                    if parsed is None:
+                        raise UnsupportedSelector(selector)
+                    NativeSelector(parsed, NAMESPACES)
+                self.assertIsNone(self.cache.native(selector, NAMESPACES))
+
+    def test_selector_exists(self):
+        html = self.trees[0]
+        # Kept by the XPath search, since cssselect can't translate it
+        self.assertTrue(a.selector_exists(html, 'h1:only-of-type ~ *:last-of-type.none', {},
+                                          True, self.cache))
+        self.assertFalse(a.selector_exists(html, 'h1:only-of-type ~ *:last-of-type.none', {},
+                                           True, self.cache, native=True))
+        # Unsupported by the native matcher: searched with XPath
+        self.assertTrue(a.selector_exists(html, 'p:lang(fr)', {}, True, self.cache, native=True))
+        self.assertFalse(a.selector_exists(html, 'p:lang(de)', {}, True, self.cache, native=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
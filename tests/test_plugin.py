@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import subprocess
+import sys
 import unittest
 import os
 
+from lxml import etree
+
 try:
     import css_parser as cssutils
     new_parser = True
@@ -11,8 +15,14 @@ except ModuleNotFoundError:
     import cssutils
     new_parser = False
 
-import plugin as p
+from analysis import (
+    NEVER_MATCH, style_rules, css_namespaces, iter_markup, document_trees, selector_in_document,
+    ignore_selectors, add_default_prefix, clean_generic_prefixes, collect_selectors
+)
 import customcssutils
+from cssparsing import ParsedStylesheetCache
+from pipeline import pre_parse_css, delete_selectors
+from tests.fakebook import FakeBook
 
 
 class TestPlugin(unittest.TestCase):
@@ -24,29 +34,29 @@ class TestPlugin(unittest.TestCase):
                                                    'resources', 'base.css'))
 
     def test_css_namespaces(self):
-        self.assertEqual(p.css_namespaces(self.css), ({}, ''))
+        self.assertEqual(css_namespaces(self.css), ({}, ''))
         self.css.namespaces['svg'] = 'https://www.w3.org/2000/svg'
-        self.assertEqual(p.css_namespaces(self.css),
+        self.assertEqual(css_namespaces(self.css),
                          ({'svg': 'https://www.w3.org/2000/svg'}, ''))
         self.css.namespaces[''] = 'https://www.w3.org/1999/xhtml'
-        self.assertEqual(p.css_namespaces(self.css),
+        self.assertEqual(css_namespaces(self.css),
                          ({'svg': 'https://www.w3.org/2000/svg',
                            'a': 'https://www.w3.org/1999/xhtml'}, 'a'))
 
     def test_ignore_selectors(self):
-        for pseudo_class in p.NEVER_MATCH:
+        for pseudo_class in NEVER_MATCH:
             self.css.insertRule('{} {{}}'.format(pseudo_class))
-        for i in range(0, len(self.css.cssRules) - len(p.NEVER_MATCH)):
+        for i in range(0, len(self.css.cssRules) - len(NEVER_MATCH)):
             self.css.deleteRule(0)
         for rule in self.css:
             with self.subTest(rule=rule):
-                self.assertTrue(p.ignore_selectors(rule.selectorText))
+                self.assertTrue(ignore_selectors(rule.selectorText))
 
     def test_add_default_prefix(self):
         # Some selectors directly given to the tested function
-        self.assertEqual(p.add_default_prefix('aa', 'p.ex1 > strong.ex2'),
+        self.assertEqual(add_default_prefix('aa', 'p.ex1 > strong.ex2'),
                          'aa|p.ex1 > aa|strong.ex2')
-        self.assertEqual(p.add_default_prefix('aa', '.ex1:nth-child(2n+1) > '
+        self.assertEqual(add_default_prefix('aa', '.ex1:nth-child(2n+1) > '
                                                     'svg|text.\ startingSpace \t:not(p) '
                                                     '.\:notANotSelector\(.\\201C quoted\\201D'),
                          '.ex1:nth-child(2n+1) > '
@@ -57,15 +67,202 @@ class TestPlugin(unittest.TestCase):
         self.assertTrue('svg' in self.css.namespaces)
         self.css.add(cssutils.css.CSSStyleRule(selectorText='p+p.\\201C quoted\\201D \nspan',
                                                style=cssutils.css.CSSStyleDeclaration('')))
-        self.assertEqual(p.add_default_prefix('aa', self.css.cssRules[-1].selectorText),
+        self.assertEqual(add_default_prefix('aa', self.css.cssRules[-1].selectorText),
                          'aa|p + aa|p.“quoted” aa|span')
         self.css.add('.ex1:nth-child(2n+1) > svg|text.\ startingSpace \t:not(p) '
                      '.\:notANotSelector\(.\\201C quoted\\201D {}')
-        self.assertEqual(p.add_default_prefix('aa', self.css.cssRules[-1].selectorText),
+        self.assertEqual(add_default_prefix('aa', self.css.cssRules[-1].selectorText),
                          '.ex1:nth-child(2n+1) > svg|text.\ startingSpace :not(aa|p) '
                          '.\:notANotSelector\(.“quoted”')
 
     def test_clean_generic_prefixes(self):
-        self.assertEqual(p.clean_generic_prefixes('|div svg|a'), 'div svg|a')
-        self.assertEqual(p.clean_generic_prefixes('*|text xhtml|p'), 'text p')
-        self.assertEqual(p.clean_generic_prefixes('html|canvas svg|text'), 'html|canvas svg|text')
+        self.assertEqual(clean_generic_prefixes('|div svg|a'), 'div svg|a')
+        self.assertEqual(clean_generic_prefixes('*|text xhtml|p'), 'text p')
+        self.assertEqual(clean_generic_prefixes('html|canvas svg|text'), 'html|canvas svg|text')
+
+    def test_pre_parse_css(self):
+        bk = FakeBook([
+            ('css1', ('Styles/a.css', 'text/css', '@namespace svg "http://www.w3.org/2000/svg";\np { }')),
+            ('css2', ('Styles/b.css', 'text/css', 'p { color: ; }')),
+            ('css3', ('Styles/c.css', 'text/css', '@page :first { margin: 0 } @unknown { } p { }')),
+        ])
+        parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+        css_to_skip, css_to_parse, css_warnings = pre_parse_css(bk, parser)
+        self.assertEqual(list(css_to_parse), ['css1', 'css3'])
+        self.assertEqual(css_to_parse['css1']['namespaces'],
+                         {'svg': 'http://www.w3.org/2000/svg'})
+        self.assertEqual(css_to_parse['css1']['default_prefix'], '')
+        self.assertEqual(len(list(style_rules(css_to_parse['css3']['stylesheet']))), 1)
+        self.assertEqual(css_warnings['css3'][0], '@unknown')
+        # Every stylesheet is read (and parsed) only once
+        self.assertEqual(bk.reads, {'css1': 1, 'css2': 1, 'css3': 1})
+
+    def test_pre_parse_css_in_parallel(self):
+        bk = FakeBook([
+            ('css1', ('Styles/a.css', 'text/css', '@namespace svg "http://www.w3.org/2000/svg";\n'
+                                                  '@media print { svg|text, p.a { color: red } }')),
+            ('css2', ('Styles/b.css', 'text/css', 'p { color: ; }')),
+            ('css3', ('Styles/c.css', 'text/css', 'p { }\n@unknown { } h1, h2 { margin: 0 }')),
+        ])
+        parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+        serial = pre_parse_css(bk, parser)
+        parallel = pre_parse_css(bk, parser, workers=2)
+        self.assertEqual(list(parallel[0]), list(serial[0]))
+        self.assertEqual(repr(parallel[0]['css2']), repr(serial[0]['css2']))
+        self.assertEqual(parallel[2], serial[2])
+        self.assertEqual(list(parallel[1]), list(serial[1]))
+        for css_id, css in parallel[1].items():
+            self.assertEqual(css['namespaces'], serial[1][css_id]['namespaces'])
+            self.assertEqual(css['stylesheet'].cssText, serial[1][css_id]['stylesheet'].cssText)
+        # Stylesheets from worker processes can be edited like the others
+        stylesheet = parallel[1]['css1']['stylesheet']
+        rule = next(style_rules(stylesheet))
+        del rule.selectorList[0]
+        self.assertIs(rule.parentStyleSheet, stylesheet)
+        self.assertIn(b'p.a', stylesheet.cssText)
+        self.assertNotIn(b'svg|text', stylesheet.cssText)
+
+    def test_pre_parse_css_with_cache(self):
+        bk = FakeBook([
+            ('css1', ('Styles/a.css', 'text/css', 'p.a, p.b { color: red }')),
+            ('css2', ('Styles/b.css', 'text/css', 'p { color: ; }')),
+        ])
+        parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+        cache = ParsedStylesheetCache()
+        first = pre_parse_css(bk, parser, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        del next(style_rules(first[1]['css1']['stylesheet'])).selectorList[0]
+        second = pre_parse_css(bk, parser, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(list(second[0]), ['css2'])
+        # Every stylesheet from the cache is a new copy
+        self.assertIn(b'p.a', second[1]['css1']['stylesheet'].cssText)
+
+    def test_delete_selectors(self):
+        bk = FakeBook([
+            ('css1', ('Styles/a.css', 'text/css', 'p.a, p.b, p.c, p.d { color: red }\n.e { color: blue }')),
+            ('css2', ('Styles/b.css', 'text/css', 'div { color: red }')),
+        ])
+        parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+        css_to_parse = pre_parse_css(bk, parser)[1]
+        occurrences = [occurrence for occurrence, _, _ in collect_selectors(css_to_parse)]
+        # Not in the order of the stylesheet
+        to_delete = [occurrences[i] for i in (4, 3, 0, 2)]
+        css_to_change, deleted, css_not_changed = delete_selectors(bk, to_delete)
+        self.assertEqual(css_not_changed, {})
+        self.assertEqual(deleted, to_delete)
+        self.assertEqual(list(css_to_change), ['css1'])
+        self.assertEqual(bk.written, css_to_change)
+        css = css_to_change['css1'].decode('utf-8')
+        self.assertIn('p.b', css)
+        for selector in ('p.a', 'p.c', 'p.d', '.e'):
+            self.assertNotIn(selector, css)
+
+    def test_cached_serializer(self):
+        self.addCleanup(cssutils.setSerializer, cssutils.ser)
+        serializer = customcssutils.MyCSSSerializer()
+        cssutils.setSerializer(serializer)
+        parsed = cssutils.CSSParser(raiseExceptions=True, validate=False).parseString(
+            'p.a, p.b { color: red }\n@media print { .c, .d { color: blue } }')
+        css = parsed.cssText
+        self.assertEqual(parsed.cssText, css)
+        rules = list(style_rules(parsed))
+        del rules[0].selectorList[0]
+        del rules[1].selectorList[1]
+        cached = parsed.cssText
+        self.assertNotIn(b'p.a', cached)
+        self.assertNotIn(b'.d', cached)
+        serializer.invalidate()
+        self.assertEqual(parsed.cssText, cached)
+        # Changes of the declarations and of the selectors are seen at once
+        rules[1].style.setProperty('color', 'green')
+        self.assertIn('green', rules[1].cssText)
+        rules[1].selectorList[0].selectorText = 'div.e'
+        self.assertIn('div.e', rules[1].cssText)
+        # A new selector is never mistaken for a deleted one
+        for i in range(20):
+            del rules[0].selectorList[0]
+            rules[0].selectorList.appendSelector('p.x{}'.format(i))
+            self.assertEqual(rules[0].cssText.split(' {')[0], 'p.x{}'.format(i))
+
+    def test_no_qt_on_import(self):
+        # Qt is imported only when a dialog is shown
+        code = ('import sys, plugin; '
+                'sys.exit(any(name.split(".")[0] in ("PySide6", "PyQt6", "PyQt5", "PySide2")'
+                ' for name in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.run([sys.executable, '-c', code], cwd=root).returncode, 0)
+
+
+XHTML = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Test</title></head>
+<body>
+  <p class="a"><div class="b">text</div></p>
+  <svg xmlns="http://www.w3.org/2000/svg"><text class="c">svg</text></svg>
+</body>
+</html>'''
+
+
+class TestMarkupDocument(unittest.TestCase):
+
+    def setUp(self):
+        self.bk = FakeBook([
+            ('css1', ('Styles/a.css', 'text/css', 'p { }')),
+            ('text1', ('Text/a.xhtml', 'application/xhtml+xml', XHTML)),
+            ('svg1', ('Images/a.svg', 'image/svg+xml', '<svg xmlns="http://www.w3.org/2000/svg"/>')),
+            ('nons', ('Text/b.xhtml', 'application/xhtml+xml', '<html><body><p/></body></html>')),
+        ])
+        self.svg_ns = {'svg': 'http://www.w3.org/2000/svg'}
+
+    def test_iter_markup(self):
+        documents = list(iter_markup(self.bk, True, lazy=True))
+        self.assertEqual([d.file_id for d in documents], ['text1', 'svg1', 'nons'])
+        self.assertEqual([d.is_xhtml for d in documents], [True, False, True])
+        for document in documents:
+            document.html, document.xml
+        # Every markup file is read once, whatever the number of trees
+        self.assertEqual(self.bk.reads, {'text1': 1, 'svg1': 1, 'nons': 1})
+        self.assertEqual([d.file_id for d in iter_markup(self.bk, False)], ['text1', 'nons'])
+
+    def test_document_trees(self):
+        document, nons = [d for d in iter_markup(self.bk, False, lazy=True)]
+        self.assertTrue(document.in_default_namespace)
+        self.assertFalse(nons.in_default_namespace)
+        self.assertEqual(document_trees(document, 'svg|text'), ('xml',))
+        self.assertEqual(document_trees(document, '[xml|lang]'), ('xml',))
+        self.assertEqual(document_trees(document, '[lang|="en"]'), ('html', 'xml'))
+        self.assertEqual(document_trees(document, '[title="a|b"]'), ('html', 'xml'))
+        self.assertEqual(document_trees(document, 'p.a > .b'), ('html',))
+        self.assertEqual(document_trees(document, '.a > .b'), ('html', 'xml'))
+        self.assertEqual(document_trees(document, '.b:not(p)'), ('html', 'xml'))
+        self.assertEqual(document_trees(nons, 'p.a > .b'), ('html', 'xml'))
+
+    def test_lazy_trees(self):
+        document = next(iter_markup(self.bk, lazy=True))
+        self.assertTrue(selector_in_document(document, 'p.a', {}))
+        self.assertIsNone(document._xml)
+        self.assertTrue(selector_in_document(document, 'svg|text.c', self.svg_ns))
+        self.assertIsNotNone(document._xml)
+        # The html parser closes p before div: only the xml tree matches
+        self.assertTrue(selector_in_document(document, '.a > .b', {}))
+        self.assertFalse(selector_in_document(document, 'p.a > .b', {}))
+
+    def test_malformed_markup(self):
+        self.bk.files['bad'] = ('Text/bad.xhtml', 'application/xhtml+xml', '<html><p></html>')
+        documents = iter_markup(self.bk, lazy=True)
+        document = [d for d in documents if d.file_id == 'bad'][0]
+        with self.assertRaises(etree.XMLSyntaxError) as cm:
+            document.xml
+        self.assertEqual(cm.exception.href, 'Text/bad.xhtml')
+        with self.assertRaises(etree.XMLSyntaxError):
+            list(iter_markup(self.bk, lazy=False))
+
+    def test_empty_markup(self):
+        for text in ('', '<!-- nothing -->'):
+            self.bk.files['empty'] = ('Text/empty.xhtml', 'application/xhtml+xml', text)
+            document = [d for d in iter_markup(self.bk, lazy=True) if d.file_id == 'empty'][0]
+            with self.assertRaises(etree.XMLSyntaxError) as cm:
+                selector_in_document(document, 'p', {})
+            self.assertEqual(cm.exception.href, 'Text/empty.xhtml')
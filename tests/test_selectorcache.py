@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gc
+import random
+import unittest
+
+from cssselect.xpath import SelectorError
+from lxml import etree
+
+from analysis import selector_exists
+from selectorcache import CompiledSelectorCache, existence_xpath
+from tests.test_nativematcher import (
+    DOCUMENT, NAMESPACES, SELECTORS, UNSUPPORTED, random_document, random_selector
+)
+
+
+class TestCompiledSelectorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CompiledSelectorCache()
+        self.html = etree.HTML('<html><body><p class="ex1">text</p></body></html>')
+
+    def test_translated_once(self):
+        first = self.cache.get('p.ex1', {}, 'xhtml')
+        self.assertIs(self.cache.get(' p.ex1 ', {}, 'xhtml'), first)
+        self.assertEqual(self.cache.info(), (1, 1, 1))
+        self.assertIsNot(self.cache.get('p.ex1', {}, 'xml'), first)
+        self.assertIsNot(self.cache.get('p.ex1', {'svg': 'http://www.w3.org/2000/svg'}, 'xhtml'), first)
+        self.assertEqual(self.cache.info(), (1, 3, 3))
+
+    def test_untranslatable_selector(self):
+        for i in range(2):
+            with self.assertRaises(SelectorError):
+                self.cache.get('*:first-of-type', {}, 'xhtml')
+        self.assertEqual(self.cache.info(), (1, 1, 1))
+
+    def test_selector_exists(self):
+        self.assertTrue(selector_exists(self.html, 'p.ex1', {}, True, self.cache))
+        self.assertFalse(selector_exists(self.html, 'p.ex2', {}, True, self.cache))
+        self.assertTrue(selector_exists(self.html, '*:first-of-type', {}, True, self.cache))
+        self.assertTrue(selector_exists(self.html, 'p.ex1', {}, True, self.cache))
+        self.assertEqual(self.cache.info(), (1, 3, 3))
+
+    def test_extension_functions(self):
+        # The first tree is freed before the selector is evaluated again
+        for i in range(20):
+            tree = etree.HTML('<html><body><p>Text {}</p></body></html>'.format(i))
+            self.assertEqual(len(self.cache.get('p:contains("text")', {}, 'html')(tree)), 1)
+            del tree
+            gc.collect()
+        self.assertEqual(self.cache.info(), (19, 1, 1))
+
+    def test_existence_xpath(self):
+        self.assertEqual(existence_xpath('p.ex1, div p'), (
+            "boolean(descendant-or-self::p[@class and contains(@class, 'ex1') and "
+            "contains(concat(' ', normalize-space(@class), ' '), ' ex1 ')][1] | "
+            "descendant-or-self::*[(self::p) and ancestor::*[self::div]][1])"
+        ))
+        with self.assertRaises(SelectorError):
+            existence_xpath('p::first-line')
+
+    def test_same_results(self):
+        data = DOCUMENT.encode('utf-8')
+        trees = [(etree.HTML(data), etree.XML(data))]
+        selectors = [SELECTORS + UNSUPPORTED]
+        rnd = random.Random(20250102)
+        for _ in range(3):
+            data = random_document(rnd).encode('utf-8')
+            trees.append((etree.HTML(data), etree.XML(data)))
+            selectors.append([random_selector(rnd) for _ in range(60)])
+        for (html, xml), document_selectors in zip(trees, selectors):
+            for selector in document_selectors:
+                for tree, translator in ((html, 'xhtml'), (xml, 'xml')):
+                    with self.subTest(selector=selector, translator=translator):
+                        try:
+                            expected = bool(self.cache.get(selector, NAMESPACES, translator)(tree))
+                        except SelectorError:
+                            with self.assertRaises(SelectorError):
+                                self.cache.exists(selector, NAMESPACES, translator)
+                            continue
+                        except etree.XPathEvalError:
+                            continue
+                        self.assertIs(self.cache.exists(selector, NAMESPACES, translator)(tree),
+                                      expected)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import css_parser as cssutils
+except ModuleNotFoundError:
+    import cssutils
+
+from analysis import collect_selectors, style_rules
+import pipeline
+import sourcespans as s
+from tests.fakebook import FakeBook
+
+
+CSS = '''@charset "utf-8";
+@namespace svg url(http://www.w3.org/2000/svg);
+/* comment, with { brace */
+p.a, p.b,
+p.c { color: red; content: "}" }
+  .gone { color: blue }
+@media print {
+    div[title="a,b"] > p.x, span:not(.y, .z) { margin: 0 }
+    .z { }
+}
+@font-face { font-family: X; src: url(x.ttf) }
+h1{a:b}.last{c:d}
+'''
+
+NAMESPACES_CSS = '''@namespace url(http://www.w3.org/1999/xhtml);
+@namespace svg url("http://www.w3.org/2000/svg");
+@supports (display: grid) { p { display: grid } }
+svg|text, *|p, p  >  a:not( .x ), a[href ^= "x"], p::first-line, .\\:x, p:nth-child( 2n + 1 ) {}
+div>p+p ~ span.a#b { color: red }
+'''
+
+
+class TestSourceSpans(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = cssutils.CSSParser(raiseExceptions=True, validate=False)
+
+    def selector_texts(self, css_string):
+        return [[css_string[start:end] for start, end in span.selectors]
+                for span in s.style_rule_spans(css_string)]
+
+    def test_spans(self):
+        self.assertEqual(self.selector_texts(CSS), [
+            ['p.a', 'p.b', 'p.c'], ['.gone'], ['div[title="a,b"] > p.x', 'span:not(.y, .z)'],
+            ['.z'], ['h1'], ['.last'],
+        ])
+        spans = s.style_rule_spans(CSS)
+        self.assertEqual(CSS[spans[1].start:spans[1].end], '.gone { color: blue }')
+        parsed_rules = list(style_rules(self.parser.parseString(CSS)))
+        self.assertTrue(s.spans_match(CSS, spans, parsed_rules))
+        self.assertFalse(s.spans_match(CSS, spans[1:], parsed_rules[1:] + parsed_rules[:1]))
+        # Same number of rules and selectors, but not the same selectors
+        other = CSS.replace('.gone', '.went')
+        self.assertFalse(s.spans_match(other, s.style_rule_spans(other), parsed_rules))
+        # The text serialized by cssutils is different, but the selectors are the same
+        spans = s.style_rule_spans(NAMESPACES_CSS)
+        parsed_rules = list(style_rules(self.parser.parseString(NAMESPACES_CSS)))
+        self.assertTrue(s.spans_match(NAMESPACES_CSS, spans, parsed_rules))
+
+    def test_remove_selectors(self):
+        spans = s.style_rule_spans(CSS)
+        css = s.remove_selectors(CSS, spans, {0: {0, 2}, 1: {0}, 2: {1}, 3: {0}, 5: {0}})
+        self.assertEqual(css, '''@charset "utf-8";
+@namespace svg url(http://www.w3.org/2000/svg);
+/* comment, with { brace */
+p.b { color: red; content: "}" }
+@media print {
+    div[title="a,b"] > p.x { margin: 0 }
+}
+@font-face { font-family: X; src: url(x.ttf) }
+h1{a:b}
+''')
+        self.assertEqual(s.remove_selectors(CSS, spans, {}), CSS)
+
+    def test_remove_emptied_groups(self):
+        css_string = '''p { }
+@media print {
+    .a, .b { }
+    @media (min-width: 10em) { .c { } }
+}
+@media screen { /* kept */ .d { } }
+@media speech { }
+'''
+        scanned = s.scan_stylesheet(css_string)
+        self.assertEqual([(group.rules, group.groups) for group in scanned.groups],
+                         [([2], []), ([1], [0]), ([3], []), ([], [])])
+        css = s.remove_selectors(css_string, scanned.rules, {1: {0, 1}, 2: {0}, 3: {0}},
+                                 scanned.groups)
+        self.assertEqual(css, '''p { }
+@media screen { /* kept */  }
+@media speech { }
+''')
+        # A group with some rules left is kept
+        css = s.remove_selectors(css_string, scanned.rules, {2: {0}}, scanned.groups)
+        self.assertEqual(css, css_string.replace('    @media (min-width: 10em) { .c { } }\n', ''))
+
+    def test_delete_selectors(self):
+        bk = FakeBook([('css1', ('Styles/a.css', 'text/css', CSS))])
+        css_to_parse = pipeline.pre_parse_css(bk, self.parser)[1]
+        occurrences = [occurrence for occurrence, _, _ in collect_selectors(css_to_parse)]
+        css_to_change = pipeline.delete_selectors(bk, occurrences[3:4], css_to_parse, True)[0]
+        self.assertEqual(css_to_change['css1'], CSS.replace('  .gone { color: blue }\n', ''))
+        # The parsed stylesheet is changed, too
+        self.assertNotIn(b'.gone', css_to_parse['css1']['stylesheet'].cssText)
+
+    def test_scan_only(self):
+        for css_string in (CSS, NAMESPACES_CSS):
+            bk = FakeBook([('css1', ('Styles/a.css', 'text/css', css_string))])
+            parsed = pipeline.pre_parse_css(bk, self.parser)
+            scanned = pipeline.pre_parse_css(bk, self.parser, scan_only=True)
+            self.assertEqual(scanned[2], parsed[2])
+            self.assertIsNone(scanned[1]['css1']['stylesheet'])
+            for key in ('namespaces', 'default_prefix'):
+                self.assertEqual(scanned[1]['css1'][key], parsed[1]['css1'][key])
+            occurrences = list(collect_selectors(scanned[1]))
+            self.assertEqual(
+                [(occurrence[5], selector_ns, namespaces) for occurrence, selector_ns, namespaces in occurrences],
+                [(occurrence[5], selector_ns, namespaces)
+                 for occurrence, selector_ns, namespaces in collect_selectors(parsed[1])]
+            )
+            # Only the stylesheets with selectors to delete are parsed
+            to_delete = [occurrence for occurrence, _, _ in occurrences][1::2]
+            expected = pipeline.delete_selectors(
+                bk, [occurrence for occurrence, _, _ in collect_selectors(parsed[1])][1::2])[0]
+            css_to_change, deleted, _ = pipeline.delete_selectors(bk, to_delete, scanned[1])
+            self.assertEqual(css_to_change, expected)
+            self.assertEqual([occurrence[5] for occurrence in deleted],
+                             [occurrence[5] for occurrence in to_delete])
+            self.assertIsNotNone(scanned[1]['css1']['stylesheet'])
+
+    def test_scan_only_errors(self):
+        bk = FakeBook([('css1', ('Styles/a.css', 'text/css', 'p.a, .1b { color: red }')),
+                       ('css2', ('Styles/b.css', 'text/css', 'p.a, p.b { color: red !importan }'))])
+        css_to_skip, css_to_parse, _ = pipeline.pre_parse_css(bk, self.parser, scan_only=True)
+        self.assertEqual(list(css_to_skip), ['css1'])
+        # Errors in the declarations are found only when parsing
+        occurrences = [occurrence for occurrence, _, _ in collect_selectors(css_to_parse)]
+        css_to_change, deleted, css_not_changed = pipeline.delete_selectors(bk, occurrences[:1], css_to_parse)
+        self.assertEqual((css_to_change, deleted), ({}, []))
+        self.assertEqual(list(css_not_changed), ['css2'])
+        self.assertEqual(bk.written, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import analysis as a
+from selectorcache import CompiledSelectorCache
+from verdictcache import VerdictCache
+from tests.fakebook import FakeBook
+from tests.test_analysis import CHAPTER, CSS, orphaned_texts, parse_stylesheets
+
+
+class TestVerdictCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.bk = FakeBook([
+            ('text1', ('Text/c1.xhtml', 'application/xhtml+xml',
+                       CHAPTER.format('1', '<p class="first"/><div><p class="second"/></div>'))),
+            ('text2', ('Text/c2.xhtml', 'application/xhtml+xml',
+                       CHAPTER.format('2', '<svg xmlns="http://www.w3.org/2000/svg"><text/></svg>'))),
+        ])
+
+    def test_persistence(self):
+        verdicts = VerdictCache(self.directory, '1')
+        verdicts.set('doc', 'sel1', True)
+        verdicts.set('doc', 'sel2', False)
+        verdicts.close()
+        verdicts = VerdictCache(self.directory, '1')
+        self.assertIs(verdicts.get('doc', 'sel1'), True)
+        self.assertIs(verdicts.get('doc', 'sel2'), False)
+        self.assertIsNone(verdicts.get('doc', 'sel3'))
+        self.assertEqual((verdicts.hits, verdicts.misses), (2, 1))
+        verdicts.close()
+        # A new version of the plugin or of its dependencies clears everything
+        verdicts = VerdictCache(self.directory, '2')
+        self.assertIsNone(verdicts.get('doc', 'sel1'))
+        verdicts.close()
+
+    def test_eviction(self):
+        verdicts = VerdictCache(self.directory, '1', max_age=1, max_entries=3)
+        for i in range(5):
+            verdicts.set('doc{}'.format(i), 'sel', True)
+        verdicts.flush(evict=False)
+        with verdicts._connection:
+            verdicts._connection.execute("UPDATE verdicts SET used = ? WHERE document = 'doc0'",
+                                         (time.time() - 2 * 86400,))
+            verdicts._connection.execute("UPDATE verdicts SET used = used - 10 WHERE document = 'doc1'")
+        verdicts._documents.clear()
+        verdicts.close()
+        verdicts = VerdictCache(self.directory, '1')
+        self.assertEqual([verdicts.get('doc{}'.format(i), 'sel') for i in range(5)],
+                         [None, None, True, True, True])
+        verdicts.close()
+
+    def test_digest(self):
+        lazy = next(a.iter_markup(self.bk, lazy=True))
+        self.assertIsNone(lazy._digest)
+        eager = next(a.iter_markup(self.bk, precompute=('digest',)))
+        self.assertEqual(eager.digest, lazy.digest)
+        # The raw data of eager documents is gone: the digest is computed only if asked for
+        with self.assertRaises(ValueError):
+            next(a.iter_markup(self.bk)).digest
+
+    def run_analysis(self):
+        verdicts = VerdictCache(self.directory, '1')
+        matcher = a.SelectorMatcher(CompiledSelectorCache(), verdicts=verdicts)
+        orphaned = a.find_orphaned_selectors(parse_stylesheets(css1=CSS),
+                                             a.iter_markup(self.bk, lazy=True), 'documents', matcher)
+        verdicts.close()
+        return orphaned_texts(orphaned), verdicts
+
+    def test_incremental_runs(self):
+        first, verdicts = self.run_analysis()
+        self.assertEqual(verdicts.hits, 0)
+        second, verdicts = self.run_analysis()
+        self.assertEqual(second, first)
+        self.assertEqual(verdicts.misses, 0)
+        # Only the searches in the changed document are done again
+        self.bk.files['text2'] = ('Text/c2.xhtml', 'application/xhtml+xml',
+                                  CHAPTER.format('2', '<span class="unused"/>'))
+        third, verdicts = self.run_analysis()
+        self.assertEqual(third, ['p.unused', 'svg|text', 'svg|circle'])
+        self.assertGreater(verdicts.hits, 0)
+        # p.unused, span.unused, svg|text and svg|circle, unmatched in text1
+        self.assertEqual(verdicts.misses, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
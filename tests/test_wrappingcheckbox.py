@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    from plugin_utils import QtCore, QtGui, QtWidgets
+except ImportError:
+    # The bindings of the Qt version in SIGIL_QT_RUNTIME_VERSION
+    raise unittest.SkipTest('Qt bindings not available')
+
+import wrappingcheckbox as w
+
+
+class TestWrappingLabel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def setUp(self):
+        w.text_layouts.clear()
+
+    def test_shared_layout(self):
+        text = 'p.first-class-name span.second (style.css)'
+        label = w.WrappingLabel(text)
+        self.assertEqual(''.join(label._text['words']), text)
+        self.assertIs(w.WrappingLabel(text)._text, label._text)
+        font = QtGui.QFont(label.font())
+        font.setPointSize(font.pointSize() + 10)
+        label.setFont(font)
+        self.assertIsNot(w.WrappingLabel(text)._text, label._text)
+        self.assertGreater(max(label._text['lengths']), max(w.WrappingLabel(text)._text['lengths']))
+        self.assertEqual(w.text_layouts.breakable_word('abc'), 'a\u200Bb\u200Bc')
+
+    def test_length_index(self):
+        label = w.WrappingLabel('a bb cccc dddddddd eeeeeeeeeeeeeeee')
+        lengths = label._text['sorted_lengths']
+        widths = [0, 1, *lengths[1:-1], *(length + 1 for length in lengths[1:-1]), 999999]
+        for width in widths:
+            label.resize(int(width) + 5, 20)
+            label._update_length_index()
+            expected = next(i for i in range(len(lengths)) if lengths[i] <= label.width() - 5 <= lengths[i + 1])
+            self.assertEqual(label._length_index, expected, width)
+
+
+class TestWrappingItemDelegate(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def test_visible_rows_measured(self):
+        texts = ['p.row{} (style.css)'.format(row) for row in range(3000)]
+        texts[1] = ' '.join('span.long-class-name-{}'.format(n) for n in range(20))
+        model = QtCore.QStringListModel(texts)
+        view = QtWidgets.QListView()
+        self.addCleanup(view.close)
+        view.setModel(model)
+        delegate = w.WrappingItemDelegate(view)
+        view.setItemDelegate(delegate)
+        view.setResizeMode(QtWidgets.QListView.Adjust)
+        view.resize(300, 200)
+        view.show()
+        one_line = view.visualRect(model.index(0)).height()
+        for _ in range(5):
+            self.app.processEvents()
+        # Only the rows painted so far have their text laid out
+        self.assertLess(len(delegate._heights), 50)
+        self.assertGreater(view.visualRect(model.index(1)).height(), 2 * one_line)
+        self.assertEqual(view.visualRect(model.index(2)).height(), one_line)
+        view.scrollToBottom()
+        for _ in range(5):
+            self.app.processEvents()
+        self.assertIn(texts[-1], [text for text, font in delegate._heights])
+        self.assertLess(len(delegate._heights), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
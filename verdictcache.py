@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# Copyright (c) 2025 Francesco Martini
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import cssselect
+from lxml import etree
+
+
+DATABASE_NAME = 'verdicts.sqlite'
+
+
+def analysis_version(plugin_version):
+    """
+    The version of everything that can change the verdicts: the plugin,
+    cssselect (the translation to XPath) and lxml/libxml2 (the parsers).
+    """
+    return '{}|{}|{}|{}'.format(
+        plugin_version, getattr(cssselect, '__version__', ''),
+        '.'.join(map(str, etree.LXML_VERSION)),
+        '.'.join(map(str, etree.LIBXML_VERSION))
+    )
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class VerdictCache:
+    """
+    Results of the searches of selectors in markup files, stored in a
+    sqlite database and kept from one run of the plugin to the next one.
+    Documents are identified by the hash of their content (so a file
+    that changed is searched again), selectors by the hash of their
+    normalized text, namespaces and matching options.
+    The whole database is cleared when version (see analysis_version())
+    changes. Verdicts not used for max_age days are deleted and, if there
+    are more than max_entries of them, the least recently used ones too.
+    New verdicts are written by flush().
+    """
+
+    def __init__(self, directory, version, max_age=30, max_entries=1000000):
+        self.path = os.path.join(directory, DATABASE_NAME)
+        self.version = version
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # document key -> {selector key: matched}
+        self._documents = {}
+        self._new = []
+        os.makedirs(directory, exist_ok=True)
+        # The plugin searches the selectors in a worker thread (one at a time)
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS verdicts (
+                document TEXT, selector TEXT, matched INTEGER, used REAL,
+                PRIMARY KEY (document, selector)
+            );
+        ''')
+        with self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != version:
+                self._connection.execute('DELETE FROM verdicts')
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def config(self):
+        """
+        Arguments to open the same cache in another process.
+        """
+        return (os.path.dirname(self.path), self.version, self.max_age, self.max_entries)
+
+    @staticmethod
+    def document_key(document):
+        return '{}{}'.format(document.digest, 'h' if document.is_xhtml else 'x')
+
+    @staticmethod
+    def selector_key(selector, namespaces_dict, options=''):
+        return digest('{}\n{}\n{}'.format(
+            selector.strip(), sorted((namespaces_dict or {}).items()), options))
+
+    def _verdicts(self, document_key):
+        try:
+            return self._documents[document_key]
+        except KeyError:
+            verdicts = dict(self._connection.execute(
+                'SELECT selector, matched FROM verdicts WHERE document = ?',
+                (document_key,)
+            ))
+            self._documents[document_key] = verdicts
+            return verdicts
+
+    def get(self, document_key, selector_key):
+        """
+        Returns the stored verdict (True or False), or None if the selector
+        has never been searched in the document.
+        """
+        matched = self._verdicts(document_key).get(selector_key)
+        if matched is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(matched)
+
+    def set(self, document_key, selector_key, matched):
+        self._verdicts(document_key)[selector_key] = matched
+        self._new.append((document_key, selector_key, int(matched)))
+
+    def flush(self, evict=True):
+        """
+        Writes the new verdicts, marks the documents searched in this run
+        as recently used and, if evict is True, deletes the old verdicts.
+        """
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)',
+                ((document, selector, matched, now) for document, selector, matched in self._new)
+            )
+            self._connection.executemany(
+                'UPDATE verdicts SET used = ? WHERE document = ?',
+                ((now, document) for document in self._documents)
+            )
+            if evict:
+                self._connection.execute('DELETE FROM verdicts WHERE used < ?',
+                                         (now - self.max_age * 86400,))
+                self._connection.execute(
+                    'DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts '
+                    'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+                )
+        self._new = []
+
+    def close(self, evict=True):
+        self.flush(evict)
+        self._connection.close()
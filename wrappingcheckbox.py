@@ -14,7 +14,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from bisect import bisect_left
+from collections import OrderedDict
 from functools import reduce
+import math
 
 from plugin_utils import QtWidgets, Qt, QtCore, QtGui
 
@@ -146,16 +149,16 @@ class WrappingLabel(QtWidgets.QLabel):
 
     def setFont(self, font):
         super().setFont(font)
-        self._text = self._preprocess_text(''.join(self._text['words']))
+        self._text = self._preprocess_text(self._text['text'])
         self._length_index = -1
         self._reset_text()
 
     def _update_length_index(self):
         available_width = self.width() - 5
-        for i in range(len(self._text['sorted_lengths'])):
-            if self._text['sorted_lengths'][i] <= available_width <= self._text['sorted_lengths'][i + 1]:
-                self._length_index = i
-                break
+        lengths = self._text['sorted_lengths']
+        if lengths[0] <= available_width <= lengths[-1]:
+            # The first i with lengths[i] <= available_width <= lengths[i + 1]
+            self._length_index = max(bisect_left(lengths, available_width) - 1, 0)
 
     def _reset_text(self):
         new_text = self._compose_text(self.width() - 5)
@@ -170,51 +173,243 @@ class WrappingLabel(QtWidgets.QLabel):
         words = []
         for i, word in enumerate(self._text['words']):
             if available_width < self._text['lengths'][i]:
-                next_word = self._text['breakable_words'][i]
+                next_word = text_layouts.breakable_word(word)
             else:
                 next_word = word
             words.append(next_word)
         return ''.join(words)
 
     def _preprocess_text(self, text):
-        words = tokenize_text(text, QtCore.QTextBoundaryFinder.BoundaryType.Line)
-        lengths = compute_words_length(words, self.font())
-        breakable_words = []
-        for word in words:
-            graphemes = tokenize_text(word, QtCore.QTextBoundaryFinder.BoundaryType.Grapheme)
-            breakable_words.append('\u200B'.join(graphemes))
-        sorted_lengths = [0, *sorted(list(set(lengths))), 999999]
-        return {
+        return text_layouts.get(text, self.font())
+
+
+class WrappingItemDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Item delegate of a list view with checkable rows, whose text is
+    wrapped (like in WrappingLabel) at line break opportunities or, for
+    words wider than the view, anywhere. The height of the rows depends
+    on the width of the view, so the view should relayout its items when
+    resized (QListView.Adjust). A click anywhere in a row toggles it.
+    The text of a row is laid out only when the row is painted: until
+    then its height is taken to be one line, and the view is asked to
+    relayout its items when a painted row turns out to be taller.
+    """
+
+    def __init__(self, parent=None, vertical_margin=6):
+        super().__init__(parent)
+        self.vertical_margin = vertical_margin
+        # (text, font key) -> height of the rows painted so far, for the view width
+        self._heights = {}
+        self._heights_width = None
+        self._relayout_index = None
+
+    def _style(self, option):
+        widget = option.widget
+        return widget.style() if widget is not None else QtWidgets.QApplication.style()
+
+    def _text_rect(self, option):
+        style = self._style(option)
+        margin = style.pixelMetric(QtWidgets.QStyle.PM_FocusFrameHMargin, option, option.widget) + 1
+        rect = style.subElementRect(QtWidgets.QStyle.SE_ItemViewItemText, option, option.widget)
+        return QtCore.QRectF(rect).adjusted(margin, self.vertical_margin, -margin, -self.vertical_margin)
+
+    def _view_width(self, option):
+        view = self.parent()
+        width = view.viewport().width() if view is not None else option.rect.width()
+        if width != self._heights_width:
+            self._heights.clear()
+            self._heights_width = width
+        return width
+
+    def _row_height(self, option, width, text_height):
+        option = QtWidgets.QStyleOptionViewItem(option)
+        option.rect = QtCore.QRect(0, 0, width, 2 * self.vertical_margin + 1)
+        check_height = self._style(option).pixelMetric(
+            QtWidgets.QStyle.PM_IndicatorHeight, option, option.widget)
+        return math.ceil(max(text_height, check_height)) + 2 * self.vertical_margin
+
+    def _measure(self, option, width):
+        """
+        Lays out the text of the row of option, if it wasn't yet, and
+        returns True if its height isn't the one the row was given by the view.
+        """
+        key = (option.text, option.font.key())
+        if key in self._heights:
+            return False
+        text_option = QtWidgets.QStyleOptionViewItem(option)
+        text_option.rect = QtCore.QRect(0, 0, width, 2 * self.vertical_margin + 1)
+        text_height = wrapped_text_height(option.text, option.font,
+                                          self._text_rect(text_option).width())
+        self._heights[key] = self._row_height(option, width, text_height)
+        return self._heights[key] != option.rect.height()
+
+    def sizeHint(self, option, index):
+        option = QtWidgets.QStyleOptionViewItem(option)
+        self.initStyleOption(option, index)
+        width = self._view_width(option)
+        height = self._heights.get((option.text, option.font.key()))
+        if height is None:
+            height = self._row_height(option, width, QtGui.QFontMetricsF(option.font).height())
+        return QtCore.QSize(width, height)
+
+    def _relayout(self):
+        index, self._relayout_index = self._relayout_index, None
+        if index.isValid():
+            self.sizeHintChanged.emit(QtCore.QModelIndex(index))
+
+    def paint(self, painter, option, index):
+        option = QtWidgets.QStyleOptionViewItem(option)
+        self.initStyleOption(option, index)
+        if self._measure(option, self._view_width(option)) and self._relayout_index is None:
+            # The view lays out its rows again (all of them, but only the
+            # painted ones are measured) once painting is done
+            self._relayout_index = QtCore.QPersistentModelIndex(index)
+            QtCore.QTimer.singleShot(0, self._relayout)
+        text = option.text
+        # The style draws the background, the check indicator and the focus
+        option.text = ''
+        self._style(option).drawControl(QtWidgets.QStyle.CE_ItemViewItem, option, painter, option.widget)
+        painter.save()
+        if option.state & QtWidgets.QStyle.State_Selected:
+            painter.setPen(option.palette.color(QtGui.QPalette.HighlightedText))
+        else:
+            painter.setPen(option.palette.color(QtGui.QPalette.Text))
+        painter.setFont(option.font)
+        painter.drawText(self._text_rect(option), text, wrapping_text_option())
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if not index.flags() & Qt.ItemIsUserCheckable:
+            return super().editorEvent(event, model, option, index)
+        if event.type() in (QtCore.QEvent.MouseButtonPress, QtCore.QEvent.MouseButtonDblClick):
+            # The row is toggled on release
+            return event.button() == Qt.LeftButton
+        if event.type() == QtCore.QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            checked = Qt.CheckState(index.data(Qt.CheckStateRole)) == Qt.Checked
+            return model.setData(index, Qt.Unchecked if checked else Qt.Checked, Qt.CheckStateRole)
+        return super().editorEvent(event, model, option, index)
+
+
+class TextLayoutCache:
+    """
+    The words of texts (split at line break opportunities) and their
+    widths, by text and font, shared by every WrappingLabel so that the
+    same text isn't tokenized and measured again (e.g. by setFont() or
+    by another label). The grapheme split of a word, needed only when
+    the word is wider than the label, is computed when first asked for.
+    Only the max_entries most recently used texts are kept.
+    """
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._layouts = OrderedDict()
+        self._breakable_words = OrderedDict()
+
+    def get(self, text, font):
+        key = (text, font.key())
+        try:
+            self._layouts.move_to_end(key)
+            return self._layouts[key]
+        except KeyError:
+            pass
+        words = tuple(tokenize_text(text, QtCore.QTextBoundaryFinder.BoundaryType.Line))
+        lengths = tuple(compute_words_length(words, font))
+        layout = {
+            'text': text,
             'words': words,
-            'breakable_words': breakable_words,
             'lengths': lengths,
-            'sorted_lengths': sorted_lengths,
+            'sorted_lengths': (0, *sorted(set(lengths)), 999999),
         }
+        self._layouts[key] = layout
+        while len(self._layouts) > self.max_entries:
+            self._layouts.popitem(last=False)
+        return layout
 
+    def breakable_word(self, word):
+        """
+        word with a zero width space between its graphemes.
+        """
+        try:
+            self._breakable_words.move_to_end(word)
+            return self._breakable_words[word]
+        except KeyError:
+            pass
+        graphemes = tokenize_text(word, QtCore.QTextBoundaryFinder.BoundaryType.Grapheme)
+        breakable = '\u200B'.join(graphemes)
+        self._breakable_words[word] = breakable
+        while len(self._breakable_words) > self.max_entries:
+            self._breakable_words.popitem(last=False)
+        return breakable
 
-def tokenize_text(text, boundary_type, boundary_reasons=None):
+    def clear(self):
+        self._layouts.clear()
+        self._breakable_words.clear()
+
+
+text_layouts = TextLayoutCache()
+
+
+def wrapping_text_option():
+    option = QtGui.QTextOption()
+    option.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
+    return option
+
+
+def wrapped_text_height(text, font, width):
     """
-    Divide text in a list of tokens based on boundary_type.
-    boundary_types: Grapheme, Word, Line or Sentence
+    Height of text, written with the QFont font, when wrapped as
+    WrappingItemDelegate does in lines no wider than width.
     """
-    if boundary_reasons is None:
+    layout = QtGui.QTextLayout(text, font)
+    layout.setTextOption(wrapping_text_option())
+    layout.beginLayout()
+    height = 0
+    while True:
+        line = layout.createLine()
+        if not line.isValid():
+            break
+        line.setLineWidth(max(width, 1))
+        height += line.height()
+    layout.endLayout()
+    return height
+
+
+_default_boundary_reasons = None
+
+
+def default_boundary_reasons():
+    """
+    Every QTextBoundaryFinder boundary reason (computed once).
+    """
+    global _default_boundary_reasons
+    if _default_boundary_reasons is None:
         try:
             # BreakOpportunity doesn't come up while iterating over BoundaryReason flags
             # (PySide 6.9), so I use it as the initializer of the reduce function
-            boundary_reasons = reduce(
+            _default_boundary_reasons = reduce(
                 lambda x, y: x | y,
                 QtCore.QTextBoundaryFinder.BoundaryReasons,
                 QtCore.QTextBoundaryFinder.BreakOpportunity
             )
         except TypeError:
             # PyQt5 doesn't allow iterations over Qt enums
-            boundary_reasons = (
+            _default_boundary_reasons = (
                 QtCore.QTextBoundaryFinder.StartOfItem
                 | QtCore.QTextBoundaryFinder.EndOfItem
                 | QtCore.QTextBoundaryFinder.MandatoryBreak
                 | QtCore.QTextBoundaryFinder.SoftHyphen
                 | QtCore.QTextBoundaryFinder.BreakOpportunity
             )
+    return _default_boundary_reasons
+
+
+def tokenize_text(text, boundary_type, boundary_reasons=None):
+    """
+    Divide text in a list of tokens based on boundary_type.
+    boundary_types: Grapheme, Word, Line or Sentence
+    """
+    if boundary_reasons is None:
+        boundary_reasons = default_boundary_reasons()
     tbf = QtCore.QTextBoundaryFinder(boundary_type, text)
     tokens = []
     pos = prev = tbf.position()